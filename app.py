@@ -1,163 +1,46 @@
-import streamlit as st
-import openai
-import snowflake.connector
-import pandas as pd
-import json
+import math
+import os
+import time
+import uuid
 from datetime import datetime, timedelta
-from typing import Optional, Tuple
-import re
-
-# =============================================================================
-# CONFIGURATION
-# =============================================================================
+from functools import wraps
+from typing import Optional
 
-TABLE_NAME = "mako_data_lake.public.combined_events_enriched"
-DEFAULT_LIMIT = 100
-APP_NAME = "Keshet Digital Query Studio"
-
-# Important columns with detailed descriptions
-IMPORTANT_COLUMNS = {
-    "date": {
-        "description": "Event date",
-        "type": "DATE",
-        "values": None
-    },
-    "event_time": {
-        "description": "Event timestamp",
-        "type": "TIMESTAMP_NTZ(9)",
-        "values": None
-    },
-    "event_name": {
-        "description": "The event name",
-        "type": "VARCHAR",
-        "values": "page_view, play, click, ads, engagement"
-    },
-    "calculated_visit_id": {
-        "description": "The user's visit ID calculated since start of the visit until 30 minutes of inactivity. This is the relevant visit_id to use for session analysis.",
-        "type": "NUMBER",
-        "values": None
-    },
-    "user_id": {
-        "description": "The user's ID. Users have the same ID that is dependent on the device.",
-        "type": "VARCHAR",
-        "values": None
-    },
-    "item_id": {
-        "description": "The item ID the event happened for. For example, a page view for a specific article.",
-        "type": "VARCHAR",
-        "values": None
-    },
-    "channel_id": {
-        "description": "The channel that the item is connected to.",
-        "type": "VARCHAR",
-        "values": None
-    },
-    "content_type": {
-        "description": "The content type of the item.",
-        "type": "VARCHAR",
-        "values": None
-    },
-    "visit_first_event": {
-        "description": "1 if this is the first event in the user's visit, null otherwise. Useful for counting visits.",
-        "type": "NUMBER",
-        "values": "1 or null"
-    },
-    "push_id": {
-        "description": "The ID of the push notification the user started the visit from.",
-        "type": "NUMBER",
-        "values": None
-    },
-    "play_id": {
-        "description": "The ID of the play event. Stays the same as long as the user is watching the same video.",
-        "type": "VARCHAR",
-        "values": None
-    },
-    "action": {
-        "description": "The action the user did. Mostly relevant during play events.",
-        "type": "VARCHAR",
-        "values": "skip_backwards, skip_forward, error, mute, share, display, start, resume, change_display, pause, seek, startover, complete, play, close, live_rt, fallback, change_state, unmute, skip, change_speed, continue_watch"
-    },
-    "reason": {
-        "description": "The reason for the action. Mostly relevant for the action field.",
-        "type": "VARCHAR",
-        "values": "scroll, end_manual_next_episode, user_idle, next_episode, back, auto_swipe, app_background, dvr_back, more_episodes, user, buffering, midroll, share, user_player_pause, epg, preroll, dvr, swipe, auto_next_episode, click"
-    },
-    "previous_action": {
-        "description": "The action of the previous event.",
-        "type": "VARCHAR",
-        "values": "skip_backwards, skip_forward, error, mute, share, display, start, resume, change_display, pause, seek, startover, complete, play, close, live_rt, fallback, change_state, unmute, skip, change_speed, continue_watch"
-    },
-    "previous_reason": {
-        "description": "The reason of the previous event.",
-        "type": "VARCHAR",
-        "values": "scroll, end_manual_next_episode, user_idle, next_episode, back, auto_swipe, app_background, dvr_back, more_episodes, user, buffering, midroll, share, user_player_pause, epg, preroll, dvr, swipe, auto_next_episode, click"
-    },
-    "type": {
-        "description": "The ad type.",
-        "type": "VARCHAR",
-        "values": "video, display"
-    },
-    "sub_type": {
-        "description": "The ad subtype.",
-        "type": "VARCHAR",
-        "values": "preroll, cube, article, monster, jambo, native, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast, video_paused_ad, midroll"
-    },
-    "ENGAGEMENT_TYPE": {
-        "description": "The type of engagement.",
-        "type": "VARCHAR",
-        "values": "share, comment, feelings, interaction"
-    },
-    "ENGAGEMENT_DETAILS": {
-        "description": "The details of the engagement type.",
-        "type": "VARCHAR",
-        "values": "whatsapp, open_sticky_player, twitter, allow_push_notifications, deny_push_notifications, sticky_player_off, copy_link, events_summary, contact_us, loved, comment, close_sticky_player, sticky_player_on, arrow_up, reply, didnt_love, facebook, x_sticky_player"
-    },
-    "SITE": {
-        "description": "The site where the visit happened.",
-        "type": "VARCHAR",
-        "values": "n12, 12plus, v1, mako"
-    },
-    "ABSOLUTE_VISIT_REF": {
-        "description": "The referrer website.",
-        "type": "VARCHAR",
-        "values": "facebook, google, direct, etc."
-    },
-    "DEVICE_TYPE": {
-        "description": "The device type used.",
-        "type": "VARCHAR",
-        "values": "tablet, Unknown, mobile, web, smart_tv"
-    },
-    "DEVICE_OS": {
-        "description": "The OS of the device.",
-        "type": "VARCHAR",
-        "values": "Windows, hisense, iOS, Linux, Tizen, Apple TVOS, Android, iPadOS, Chrome OS, PlayStation 4, browser, macOS, webos, tizen, tvOS"
-    },
-    "IL_OR_ABROAD": {
-        "description": "Indicator for the user's location - Israel or abroad.",
-        "type": "VARCHAR",
-        "values": "unknown, abroad, il"
-    },
-    "PLATFORM": {
-        "description": "The platform the user is visiting from.",
-        "type": "VARCHAR",
-        "values": "mobile-app, smart_tv-app, tablet-browser, unknown, browser, tablet-app, mobile-browser"
-    }
-}
+import pandas as pd
+import streamlit as st
 
-EXAMPLE_QUERIES = [
-    "How many unique users visited mako in the last 5 days?",
-    "What's the breakdown of events by device type?",
-    "What percentage of visits came from Israel vs abroad?",
-    "How many video plays started vs completed?",
-    "What are the top referral sources?",
-    "Show engagement breakdown by type",
-    "Average events per visit by platform"
-]
+from query_studio.config import (
+    APPROXIMATE_DISTINCT_DEFAULT, APP_NAME, COST_WARN_BYTES, COST_WARN_PARTITION_RATIO, DEFAULT_LIMIT,
+    EXAMPLE_QUERIES, EXPORT_DOWNLOAD_MAX_BYTES, HISTORY_DEFAULT_USER, HISTORY_PAGE_SIZE,
+    INCREMENTAL_EXECUTION_DEFAULT, METRICS_ADDRESS, METRICS_PORT, PERF_PANEL_QUERY_PARAM, PREVIEW_ROWS,
+    QUERY_BYTES_SCANNED_INTERVAL_SECONDS, QUERY_POLL_BACKOFF, QUERY_POLL_INTERVAL_SECONDS,
+    QUERY_POLL_MAX_INTERVAL_SECONDS, RESULT_PAGE_ROWS, ROLLUPS_ENABLED, SPECULATIVE_PREVIEW_DEFAULT,
+    STATS_APPROX_DISTINCT_ROWS, UNLOAD_MIN_ROWS, UNLOAD_URL_EXPIRY_SECONDS, set_secrets,
+)
+from query_studio.tracing import Trace, current_trace, start_metrics_server, start_trace, trace_span, traced
+from query_studio.sql_analysis import rewrite_outer_limit, validate_sql_safety
+from query_studio.caching import (
+    canonicalize_sql, get_result_cache, get_sql_cache, hash_text, result_cache_mode,
+)
+from query_studio.db import (
+    cancel_query, estimate_query_cost, fetch_query_result, format_bytes, get_all_columns, get_connection_pool,
+    get_query_progress, submit_query,
+)
+from query_studio.incremental import plan_incremental
+from query_studio.rollups import resolve_execution_sql, rollup_estimates_distinct_counts
+from query_studio.stats import get_column_stats, pushdown_column_stats
+from query_studio.generation import fix_failed_query, get_schema_description, last_prompt_usage
+from query_studio.history import QueryHistoryStore, get_history_store
+from query_studio.exports import EXPORT_FORMATS, prepare_export, stage_export_file, unload_export
+from query_studio.charts import chart_spec, prepare_chart_data, warehouse_chart_data
+from query_studio.pipeline import execute_query_cached, generate_checked_sql, last_sql_checks
+from query_studio.speculative import get_speculative_preview_runner, speculation_allowed
 
 # =============================================================================
 # STYLING
 # =============================================================================
 
+@traced()
 def apply_custom_css():
     st.markdown("""
     <style>
@@ -439,322 +322,193 @@ def apply_custom_css():
 
 
 # =============================================================================
-# DATABASE FUNCTIONS
-# =============================================================================
-
-@st.cache_resource
-def get_snowflake_connection():
-    """Create a Snowflake connection using key-pair authentication."""
-    from cryptography.hazmat.backends import default_backend
-    from cryptography.hazmat.primitives import serialization
-    
-    private_key_pem = st.secrets["snowflake"]["private_key"]
-    private_key = serialization.load_pem_private_key(
-        private_key_pem.encode(),
-        password=None,
-        backend=default_backend()
-    )
-    
-    private_key_bytes = private_key.private_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-    
-    return snowflake.connector.connect(
-        account=st.secrets["snowflake"]["account"],
-        user=st.secrets["snowflake"]["user"],
-        private_key=private_key_bytes,
-        warehouse=st.secrets["snowflake"]["warehouse"],
-        database=st.secrets["snowflake"]["database"],
-        schema=st.secrets["snowflake"]["schema"],
-        role=st.secrets["snowflake"]["role"]
-    )
-
-
-@st.cache_data(ttl=3600)
-def get_all_columns():
-    """Fetch all columns from the table."""
-    try:
-        conn = get_snowflake_connection()
-        cursor = conn.cursor()
-        cursor.execute(f"DESCRIBE TABLE {TABLE_NAME}")
-        columns = cursor.fetchall()
-        cursor.close()
-        return [(col[0], col[1]) for col in columns]
-    except Exception as e:
-        st.error(f"Error fetching columns: {e}")
-        return []
-
-
-def execute_query(sql: str) -> pd.DataFrame:
-    """Execute SQL query and return results as a dataframe."""
-    conn = get_snowflake_connection()
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    columns = [desc[0] for desc in cursor.description]
-    data = cursor.fetchall()
-    cursor.close()
-    return pd.DataFrame(data, columns=columns)
-
-
-def estimate_query_cost(sql: str) -> dict:
-    """Estimate query cost/size before execution based on SQL analysis."""
-    sql_lower = sql.lower()
-    
-    # Check for date filter
-    has_date_filter = any(pattern in sql_lower for pattern in [
-        "date =", "date=", "date >", "date<", "date >", "date <",
-        "where date", "and date", "between"
-    ])
-    
-    # Check for LIMIT
-    has_limit = "limit" in sql_lower
-    
-    # Extract limit value if present
-    limit_match = re.search(r'limit\s+(\d+)', sql_lower)
-    limit_value = int(limit_match.group(1)) if limit_match else None
-    
-    return {
-        "has_date_filter": has_date_filter,
-        "has_limit": has_limit,
-        "limit_value": limit_value
-    }
-
-
-def get_column_stats(df: pd.DataFrame) -> dict:
-    """Calculate column statistics for the result set."""
-    stats = {}
-    for col in df.columns:
-        col_stats = {
-            "distinct": df[col].nunique(),
-            "nulls": df[col].isnull().sum()
-        }
-        if pd.api.types.is_numeric_dtype(df[col]):
-            col_stats["min"] = df[col].min()
-            col_stats["max"] = df[col].max()
-            col_stats["mean"] = df[col].mean()
-        stats[col] = col_stats
-    return stats
-
-
-# =============================================================================
-# AI FUNCTIONS
+# UI COMPONENTS
 # =============================================================================
 
-def build_schema_description(all_columns: list) -> str:
-    """Build a schema description for the LLM."""
-    lines = []
-    for col_name, col_type in all_columns:
-        important_info = IMPORTANT_COLUMNS.get(col_name) or IMPORTANT_COLUMNS.get(col_name.upper()) or IMPORTANT_COLUMNS.get(col_name.lower())
-        if important_info:
-            desc = f"- {col_name} ({important_info['type']}): {important_info['description']}"
-            if important_info['values']:
-                desc += f" Possible values: {important_info['values']}"
-            lines.append(desc)
-        else:
-            lines.append(f"- {col_name} ({col_type})")
-    return "\n".join(lines)
-
-
-def generate_sql(user_question: str, schema_description: str, limit: int) -> Tuple[str, str]:
-    """Generate SQL and explanation from natural language using OpenAI."""
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    # Business rules and data relationships
-    business_rules = """
-BUSINESS RULES AND DATA RELATIONSHIPS:
-
-1. AD TYPES AND SUB-TYPES:
-   - type = 'video' includes sub_types: preroll, midroll, video_paused_ad, native, bumper, 
-   - type = 'display' includes sub_types: cube, article, monster, jambo, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast
-   - When querying for a specific ad format (e.g., "native ads"), always filter by BOTH type AND sub_type
-
-2. VISIT COUNTING:
-   - Use COUNT(DISTINCT calculated_visit_id) for visit counts
+@st.cache_data(max_entries=50, show_spinner=False)
+def column_stats_for(result_id: str, _df: pd.DataFrame) -> pd.DataFrame:
+    """Column statistics memoized per result set."""
+    return get_column_stats(_df)
 
-3. USER COUNTING:
-   - user_id is device-dependent, meaning the same person on different devices will have different user_ids
-   - For unique user counts, use COUNT(DISTINCT user_id)
 
-4. VIDEO PLAY ANALYSIS:
-   - play_id stays constant for an entire video viewing session
-   - action = 'start' indicates video play started
-   - action = 'complete' indicates video was watched to completion
-   - To calculate completion rate: COUNT(action='complete') / COUNT(action='start')
-   - To calculate the play duration for each play_id you need to sum play_time_from_last_event across the play_id. Relevant for play events only
-
-5. SITES:
-   - SITE values: 'mako', 'n12', '12plus', 'v1'
-   - These are different properties/brands under Keshet Media Group
-"""
+def user_history_store() -> QueryHistoryStore:
+    """This viewer's history store.
     
-    system_prompt = f"""You are a Snowflake SQL expert. Generate SQL queries based on natural language questions.
-
-Table: {TABLE_NAME}
+    Signed-in viewers share the persistent store, keyed by email. Anonymous
+    viewers can't be told apart, so each session gets an in-memory store of
+    its own that goes away with the session.
+    """
+    if current_user() != HISTORY_DEFAULT_USER:
+        return get_history_store()
+    if "session_history" not in st.session_state:
+        st.session_state["session_history"] = QueryHistoryStore(":memory:")
+    return st.session_state["session_history"]
 
-Schema:
-{schema_description}
 
-{business_rules}
+def current_user() -> str:
+    """Who history is stored for: the signed-in viewer's email when the deployment has auth."""
+    user_info = getattr(st, "user", None) or getattr(st, "experimental_user", None)
+    try:
+        email = user_info.get("email") if user_info is not None else None
+    except Exception:
+        email = None
+    return email or HISTORY_DEFAULT_USER
 
-QUERY RULES:
-1. Always use the exact table name: {TABLE_NAME}
-2. CRITICAL: Always filter by a date range. Default to date = '{yesterday}' (yesterday) unless the user specifies a different date range. Every query MUST have a date filter.
-3. Always add LIMIT {limit} at the end unless the user specifies a different limit
-4. Use ONLY SELECT statements. Never use INSERT, UPDATE, DELETE, DROP, CREATE, ALTER, or any other modifying statements.
-5. Use valid Snowflake SQL syntax
-6. Column names are case-insensitive in Snowflake but preserve the case as shown in the schema
-7. Apply the business rules above when constructing queries
-8. IMPORTANT: Format the SQL query with proper line breaks for readability:
-   - SELECT clause on its own line(s)
-   - FROM clause on its own line
-   - WHERE clause on its own line
-   - GROUP BY on its own line (if used)
-   - ORDER BY on its own line (if used)
-   - LIMIT on its own line
 
-Example format:
-SELECT 
-    column1,
-    column2,
-    COUNT(*) as count
-FROM table_name
-WHERE date = '2024-01-01'
-GROUP BY column1, column2
-ORDER BY count DESC
-LIMIT 100
+def cancel_speculative_preview():
+    """Cancel this session's speculative preview, if any."""
+    preview = st.session_state.pop("speculative_preview", None)
+    if preview is not None:
+        get_speculative_preview_runner().cancel(preview)
 
-Respond in JSON format:
-{{
-    "sql": "YOUR SQL QUERY HERE with proper newlines using \\n",
-    "explanation": "A brief, clear explanation of what this query does and why you structured it this way"
-}}
-"""
 
-    client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-    
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_question}
-        ],
-        temperature=0,
-        response_format={"type": "json_object"}
-    )
-    
-    result = json.loads(response.choices[0].message.content)
-    return result.get("sql", ""), result.get("explanation", "")
+def speculation_user() -> str:
+    """Whose cap a speculative preview counts against: the signed-in user, else this session."""
+    user = current_user()
+    if user == HISTORY_DEFAULT_USER:
+        return f"session:{st.session_state['session_key']}"
+    return user
 
 
-def fix_failed_query(original_question: str, failed_sql: str, error_message: str, schema_description: str, limit: int) -> Tuple[str, str]:
-    """Attempt to fix a failed query."""
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+def update_speculative_preview(sql: str, cost_info: dict, use_rollups: bool, incremental: bool,
+                               approximate: bool = APPROXIMATE_DISTINCT_DEFAULT):
+    """Keep this session's speculative preview in line with the SQL on screen.
     
-    # Business rules and data relationships
-    business_rules = """
-BUSINESS RULES AND DATA RELATIONSHIPS:
-
-1. AD TYPES AND SUB-TYPES:
-   - type = 'video' includes sub_types: preroll, midroll, video_paused_ad
-   - type = 'display' includes sub_types: cube, article, monster, jambo, native, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast
-   - When querying for a specific ad format (e.g., "native ads"), always filter by BOTH type AND sub_type
-
-2. VISIT COUNTING:
-   - To count visits/sessions, use: SUM(visit_first_event) or COUNT(*) WHERE visit_first_event = 1
-   - Do NOT use COUNT(DISTINCT calculated_visit_id) for visit counts, use visit_first_event instead
-
-3. USER COUNTING:
-   - user_id is device-dependent, meaning the same person on different devices will have different user_ids
-   - For unique user counts, use COUNT(DISTINCT user_id)
-
-4. VIDEO PLAY ANALYSIS:
-   - play_id stays constant for an entire video viewing session
-   - action = 'start' indicates video play started
-   - action = 'complete' indicates video was watched to completion
-   - To calculate completion rate: COUNT(action='complete') / COUNT(action='start')
-
-5. SITES:
-   - SITE values: 'mako', 'n12', '12plus', 'v1'
-   - These are different properties/brands under Keshet Media Group
-"""
-    
-    system_prompt = f"""You are a Snowflake SQL expert. A query failed and you need to fix it.
-
-Table: {TABLE_NAME}
-
-Schema:
-{schema_description}
-
-{business_rules}
+    A preview for different SQL (regenerated or edited) is cancelled, and
+    a new one is started if the SQL passed validation and the cost gate.
+    """
+    preview = st.session_state.get("speculative_preview")
+    if preview is not None and preview["sql"] == sql:
+        return
+    cancel_speculative_preview()
+    if sql is None or not speculation_allowed(cost_info) or not validate_sql_safety(sql)[0]:
+        return
+    preview = get_speculative_preview_runner().start(speculation_user(), sql, use_rollups, incremental, approximate)
+    if preview is not None:
+        st.session_state["speculative_preview"] = preview
 
-Original question: {original_question}
 
-Failed SQL:
-{failed_sql}
+def wait_for_speculative_preview(sql: str):
+    """Let a speculative preview of sql finish so the Preview button reads it from the result cache."""
+    preview = st.session_state.get("speculative_preview")
+    if preview is None or preview["sql"].strip() != sql.strip() or preview["future"] is None:
+        return
+    try:
+        preview["future"].result()
+    except Exception:
+        # Fall back to running the preview normally
+        st.session_state.pop("speculative_preview", None)
 
-Error message:
-{error_message}
 
-Rules:
-1. Fix the SQL to resolve the error
-2. Keep the original intent of the query
-3. Always include a date filter (default: date = '{yesterday}')
-4. Always add LIMIT {limit}
-5. Use ONLY SELECT statements
-6. Apply the business rules above
-7. Format the SQL query with proper line breaks:
-   - SELECT clause on its own line(s)
-   - FROM clause on its own line
-   - WHERE clause on its own line
-   - GROUP BY on its own line (if used)
-   - ORDER BY on its own line (if used)
-   - LIMIT on its own line
+@st.cache_data(max_entries=50, show_spinner=False)
+def chart_data_for(result_id: str, _df: pd.DataFrame) -> dict:
+    """Chart data memoized per result set."""
+    return prepare_chart_data(_df)
 
-Respond in JSON format:
-{{
-    "sql": "YOUR FIXED SQL QUERY HERE with proper newlines using \\n",
-    "explanation": "What was wrong and how you fixed it"
-}}
-"""
 
-    client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-    
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": "Please fix this query"}
-        ],
-        temperature=0,
-        response_format={"type": "json_object"}
-    )
+def store_query_result(df: pd.DataFrame, meta: dict, sql: str, question: str,
+                       duration_seconds: Optional[float] = None, bytes_scanned: Optional[int] = None):
+    """Make a query result current and add it to the history."""
+    st.session_state["query_results"] = df
+    st.session_state["query_meta"] = meta
+    st.session_state["query_sql"] = sql
+    st.session_state.pop("failed_query", None)
     
-    result = json.loads(response.choices[0].message.content)
-    return result.get("sql", ""), result.get("explanation", "")
+    user_history_store().add(current_user(), question, sql, st.session_state.get("sql_explanation", ""), meta,
+                             duration_seconds=duration_seconds, bytes_scanned=bytes_scanned)
+    st.session_state["history_page"] = 0
 
 
-def validate_sql_safety(sql: str) -> Tuple[bool, str]:
-    """Validate that SQL is safe (SELECT only)."""
-    sql_upper = sql.upper().strip()
+def fragment(run_every: Optional[float] = None):
+    """st.fragment whose own reruns are traced.
     
-    dangerous_keywords = ['INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'TRUNCATE', 'EXEC', 'EXECUTE', 'GRANT', 'REVOKE']
-    
-    for keyword in dangerous_keywords:
-        if re.search(rf'\b{keyword}\b', sql_upper):
-            return False, f"Query contains forbidden keyword: {keyword}"
+    A widget inside a fragment reruns just the fragment, without main(), so
+    the fragment starts its own "fragment" trace for the performance panel
+    and metrics. As part of a full rerun it is an ordinary span.
+    """
+    def decorator(func):
+        traced_func = traced()(func)
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace() is not None:
+                return traced_func(*args, **kwargs)
+            trace = None
+            try:
+                with start_trace("fragment", fragment=func.__name__) as trace:
+                    return traced_func(*args, **kwargs)
+            finally:
+                if trace is not None:
+                    remember_trace(trace)
+        return st.fragment(wrapper, run_every=run_every)
+    return decorator
+
+
+@fragment(run_every=QUERY_POLL_INTERVAL_SECONDS)
+def render_running_query(running: dict):
+    """Show progress of an asynchronously executing query until it finishes.
+    
+    Refreshes as a fragment rerun every QUERY_POLL_INTERVAL_SECONDS, but
+    asks Snowflake for the status with exponential backoff (up to
+    QUERY_POLL_MAX_INTERVAL_SECONDS) and for bytes scanned at most every
+    QUERY_BYTES_SCANNED_INTERVAL_SECONDS. Only the finished query reruns
+    the whole app to show its results.
+    """
+    query_id = running["query_id"]
+    now = time.time()
+    progress = running.get("progress")
+    if progress is None or now >= running["next_poll_at"]:
+        with_bytes_scanned = now >= running.get("next_bytes_scanned_at", 0)
+        try:
+            progress = get_query_progress(query_id, with_bytes_scanned=with_bytes_scanned)
+        except Exception as e:
+            st.session_state.pop("running_query", None)
+            st.session_state["failed_query"] = {"sql": running["sql"], "error": str(e)}
+            st.rerun()
+        if with_bytes_scanned:
+            running["next_bytes_scanned_at"] = now + QUERY_BYTES_SCANNED_INTERVAL_SECONDS
+        if progress["bytes_scanned"] is None:
+            progress["bytes_scanned"] = running.get("bytes_scanned")
+        polls = running.get("polls", 0)
+        running["polls"] = polls + 1
+        running["next_poll_at"] = now + min(QUERY_POLL_INTERVAL_SECONDS * QUERY_POLL_BACKOFF ** polls,
+                                            QUERY_POLL_MAX_INTERVAL_SECONDS)
+        running["progress"] = progress
+    
+    running["bytes_scanned"] = progress["bytes_scanned"]
+    if progress["running"]:
+        elapsed = time.time() - running["started_at"]
+        status_col, cancel_col = st.columns([3, 1])
+        with status_col:
+            st.info(f"Running for {elapsed:.0f}s — {format_bytes(progress['bytes_scanned'])} scanned")
+            st.caption(f"Query ID: {query_id}")
+        with cancel_col:
+            if st.button("Cancel", use_container_width=True):
+                cancel_query(query_id)
+                st.session_state.pop("running_query", None)
+                st.toast("Query cancelled")
+                st.rerun()
+        return
     
-    if not sql_upper.startswith('SELECT'):
-        return False, "Only SELECT queries are allowed"
+    st.session_state.pop("running_query", None)
+    try:
+        with trace_span("fetch_result", query_id=query_id, bytes_scanned=running.get("bytes_scanned")) as span:
+            df, meta = fetch_query_result(query_id)
+            span["rows"] = meta["total_rows"]
+        meta["rollup"] = running.get("rollup")
+        meta["approximate"] = rollup_estimates_distinct_counts(running["sql"], meta["rollup"])
+    except Exception as e:
+        st.session_state["failed_query"] = {"sql": running["sql"], "error": str(e)}
+        st.rerun()
     
-    return True, "Query is safe"
-
+    get_result_cache().put(running["sql"], df, meta, mode=running["cache_mode"])
+    store_query_result(df, meta, running["sql"], running["question"],
+                       duration_seconds=time.time() - running["started_at"],
+                       bytes_scanned=running.get("bytes_scanned"))
+    st.rerun()
 
-# =============================================================================
-# UI COMPONENTS
-# =============================================================================
 
+@traced()
 def render_header():
     """Render the app header."""
     st.markdown("""
@@ -765,6 +519,7 @@ def render_header():
     """, unsafe_allow_html=True)
 
 
+@traced()
 def render_example_queries():
     """Render clickable example queries."""
     st.markdown("##### Try an example")
@@ -777,6 +532,7 @@ def render_example_queries():
                 st.rerun()
 
 
+@traced()
 def render_sidebar():
     """Render the sidebar with history and favorites."""
     with st.sidebar:
@@ -786,57 +542,157 @@ def render_sidebar():
         limit = st.slider("Max rows", min_value=10, max_value=1000, value=DEFAULT_LIMIT, step=10)
         st.session_state["query_limit"] = limit
         
-        st.markdown("---")
+        st.session_state["async_execution"] = st.toggle(
+            "Run queries in the background",
+            value=st.session_state.get("async_execution", True),
+            help="Shows progress while the query runs and lets you cancel it"
+        )
+        st.session_state["use_rollups"] = st.toggle(
+            "Use rollup tables",
+            value=st.session_state.get("use_rollups", ROLLUPS_ENABLED),
+            help="Answer covered aggregate queries from precomputed daily rollups"
+        )
+        st.session_state["incremental_execution"] = st.toggle(
+            "Incremental re-execution",
+            value=st.session_state.get("incremental_execution", INCREMENTAL_EXECUTION_DEFAULT),
+            help="Re-query only new days of aggregate queries and reuse cached results for closed days"
+        )
+        st.session_state["approximate_distinct"] = st.toggle(
+            "Allow approximate distinct counts",
+            value=st.session_state.get("approximate_distinct", APPROXIMATE_DISTINCT_DEFAULT),
+            help="Let rollups and incremental runs answer COUNT(DISTINCT) with HyperLogLog estimates; "
+                 "otherwise such queries run on the raw events"
+        )
+        st.session_state["speculative_preview_enabled"] = st.toggle(
+            "Preview in the background",
+            value=st.session_state.get("speculative_preview_enabled", SPECULATIVE_PREVIEW_DEFAULT),
+            help="Start the preview query as soon as SQL is generated, so Preview is instant"
+        )
         
-        # Query History
-        st.markdown("### Query History")
-        if "query_history" in st.session_state and st.session_state["query_history"]:
-            for i, item in enumerate(reversed(st.session_state["query_history"][-10:])):
-                with st.container():
-                    col1, col2 = st.columns([4, 1])
-                    with col1:
-                        if st.button(f"{item['question'][:35]}...", key=f"hist_{i}", use_container_width=True):
-                            st.session_state["user_question"] = item["question"]
-                            st.session_state["generated_sql"] = item["sql"]
-                            st.session_state["sql_explanation"] = item.get("explanation", "")
-                            st.session_state["gen_counter"] = st.session_state.get("gen_counter", 0) + 1
-                            st.rerun()
-                    with col2:
-                        if st.button("★", key=f"fav_{i}"):
-                            if "favorites" not in st.session_state:
-                                st.session_state["favorites"] = []
-                            if item not in st.session_state["favorites"]:
-                                st.session_state["favorites"].append(item)
-                                st.toast("Added to favorites")
-        else:
-            st.caption("No queries yet")
+        cache_stats = get_sql_cache().stats()
+        st.caption(
+            f"SQL cache: {cache_stats['exact_hits'] + cache_stats['similar_hits']} hits "
+            f"({cache_stats['similar_hits']} similar), {cache_stats['misses']} misses, "
+            f"{cache_stats['entries']} stored"
+        )
+        pool_stats = get_connection_pool().stats()
+        st.caption(
+            f"Snowflake pool: {pool_stats['in_use']}/{pool_stats['max_size']} in use, "
+            f"p95 wait {pool_stats['wait_p95_seconds'] * 1000:.0f} ms"
+        )
+        if st.session_state["speculative_preview_enabled"]:
+            preview_stats = get_speculative_preview_runner().stats()
+            st.caption(
+                f"Background previews: {preview_stats['completed']} ready, {preview_stats['cancelled']} cancelled, "
+                f"{preview_stats['in_flight']} running"
+            )
         
         st.markdown("---")
-        
-        # Favorites
-        st.markdown("### Favorites")
-        if "favorites" in st.session_state and st.session_state["favorites"]:
-            for i, item in enumerate(st.session_state["favorites"]):
+        render_history()
+
+
+@fragment()
+def render_history():
+    """History and favorites in the sidebar; searching and paging rerun only this fragment."""
+    # Query History
+    history = user_history_store()
+    user = current_user()
+    st.markdown("### Query History")
+    if user == HISTORY_DEFAULT_USER:
+        st.caption("Not signed in: history and favorites are kept for this session only")
+    search = st.text_input("Search history", placeholder="Search questions and SQL",
+                           label_visibility="collapsed", key="history_search")
+    if search != st.session_state.get("history_last_search", ""):
+        st.session_state["history_last_search"] = search
+        st.session_state["history_page"] = 0
+    page = st.session_state.get("history_page", 0)
+    total = history.count(user, search)
+    items = history.page(user, offset=page * HISTORY_PAGE_SIZE, search=search)
+    if items:
+        for item in items:
+            with st.container():
                 col1, col2 = st.columns([4, 1])
                 with col1:
-                    if st.button(f"{item['question'][:35]}...", key=f"favitem_{i}", use_container_width=True):
+                    details = datetime.fromtimestamp(item["created_at"]).strftime("%Y-%m-%d %H:%M")
+                    if item["total_rows"] is not None:
+                        details += f" · {item['total_rows']:,} rows"
+                    if item["duration_seconds"] is not None:
+                        details += f" · {item['duration_seconds']:.1f}s"
+                    if item["bytes_scanned"] is not None:
+                        details += f" · {format_bytes(item['bytes_scanned'])} scanned"
+                    if st.button(f"{item['question'][:35]}...", key=f"hist_{item['id']}",
+                                 help=details, use_container_width=True):
                         st.session_state["user_question"] = item["question"]
                         st.session_state["generated_sql"] = item["sql"]
-                        st.session_state["sql_explanation"] = item.get("explanation", "")
+                        st.session_state["sql_explanation"] = item["explanation"]
+                        st.session_state.pop("prompt_usage", None)
+                        st.session_state.pop("sql_checks", None)
                         st.session_state["gen_counter"] = st.session_state.get("gen_counter", 0) + 1
                         st.rerun()
                 with col2:
-                    if st.button("×", key=f"delfav_{i}"):
-                        st.session_state["favorites"].remove(item)
-                        st.rerun()
-        else:
-            st.caption("No favorites yet")
+                    if st.button("★", key=f"fav_{item['id']}"):
+                        if history.add_favorite(user, item["question"], item["sql"], item["explanation"]):
+                            st.toast("Added to favorites")
+        
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        if pages > 1:
+            prev_col, page_col, next_col = st.columns([1, 2, 1])
+            # Callbacks run before the fragment reruns, so the new page shows without another rerun
+            with prev_col:
+                st.button("‹", key="history_prev", disabled=page == 0,
+                          on_click=lambda: st.session_state.update(history_page=page - 1))
+            with page_col:
+                st.caption(f"Page {page + 1} of {pages}")
+            with next_col:
+                st.button("›", key="history_next", disabled=page >= pages - 1,
+                          on_click=lambda: st.session_state.update(history_page=page + 1))
+    else:
+        st.caption("No matching queries" if search else "No queries yet")
+    
+    st.markdown("---")
+    
+    # Favorites
+    st.markdown("### Favorites")
+    favorites = history.favorites(user)
+    if favorites:
+        for item in favorites:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                if st.button(f"{item['question'][:35]}...", key=f"favitem_{item['id']}", use_container_width=True):
+                    st.session_state["user_question"] = item["question"]
+                    st.session_state["generated_sql"] = item["sql"]
+                    st.session_state["sql_explanation"] = item["explanation"]
+                    st.session_state.pop("prompt_usage", None)
+                    st.session_state.pop("sql_checks", None)
+                    st.session_state["gen_counter"] = st.session_state.get("gen_counter", 0) + 1
+                    st.rerun()
+            with col2:
+                st.button("×", key=f"delfav_{item['id']}", on_click=history.remove_favorite, args=(user, item["id"]))
+    else:
+        st.caption("No favorites yet")
 
 
+@traced()
 def render_cost_estimation(cost_info: dict):
     """Render query cost estimation."""
+    if cost_info.get("blocked"):
+        st.markdown(f"""
+        <div class="error-box">
+            <strong>Execution blocked</strong><br/>{cost_info['block_reason']}
+        </div>
+        """, unsafe_allow_html=True)
+        return
+    
     warnings = []
     
+    bytes_assigned = cost_info.get("bytes_assigned")
+    if bytes_assigned is not None and bytes_assigned > COST_WARN_BYTES:
+        warnings.append(f"Query will scan about {format_bytes(bytes_assigned)}")
+    
+    partition_ratio = cost_info.get("partition_ratio")
+    if partition_ratio is not None and partition_ratio > COST_WARN_PARTITION_RATIO:
+        warnings.append(f"Scans {partition_ratio:.0%} of table partitions — the date filter prunes little")
+    
     if not cost_info.get("has_date_filter"):
         warnings.append("No date filter detected — query may scan large amounts of data")
     
@@ -861,58 +717,229 @@ def render_cost_estimation(cost_info: dict):
             <div><strong>Query validated</strong> — Date filter and limit{limit_info} detected.</div>
         </div>
         """, unsafe_allow_html=True)
-
-
-def render_column_stats(stats: dict):
-    """Render column statistics in an expander."""
-    with st.expander("Column Statistics"):
-        stat_df = []
-        for col, col_stats in stats.items():
-            row = {
-                "Column": col,
-                "Distinct Values": col_stats["distinct"],
-                "Null Count": col_stats["nulls"]
-            }
-            if "min" in col_stats:
-                row["Min"] = col_stats["min"]
-                row["Max"] = col_stats["max"]
-                row["Mean"] = round(col_stats["mean"], 2) if col_stats["mean"] else None
-            stat_df.append(row)
-        st.dataframe(pd.DataFrame(stat_df), use_container_width=True, hide_index=True)
-
-
-def render_visualization(df: pd.DataFrame):
-    """Render auto-generated visualization based on data."""
-    # Determine best chart type based on data
-    numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-    categorical_cols = df.select_dtypes(include=['object', 'category']).columns.tolist()
-    
-    if len(df) == 0:
-        st.info("No data to visualize")
+    
+    if cost_info.get("partitions_total") is not None:
+        st.caption(
+            f"Plan: {cost_info['partitions_assigned']:,} of {cost_info['partitions_total']:,} partitions, "
+            f"~{format_bytes(cost_info['bytes_assigned'])} to scan"
+        )
+    elif cost_info.get("plan_error"):
+        st.caption("Scan size unavailable — the query plan could not be computed")
+
+
+@fragment()
+def render_column_stats(df: pd.DataFrame, meta: dict, sql: Optional[str] = None):
+    """Render column statistics; they are only computed while the toggle is on.
+    
+    Statistics are computed locally over the rows held in memory, or in
+    Snowflake over the stored result (the default for truncated results).
+    Results without a stored copy, such as incremental merges, are always
+    complete in memory and computed locally.
+    """
+    stats_col, pushdown_col = st.columns([1, 1])
+    with stats_col:
+        show = st.toggle("Column statistics", key="show_column_stats")
+    with pushdown_col:
+        pushdown = sql is not None and bool(meta.get("query_id")) and st.toggle(
+            "Compute in Snowflake",
+            value=bool(meta.get("truncated")),
+            key="column_stats_pushdown",
+            disabled=not show,
+            help="Statistics over the full result without downloading it"
+        )
+    if not show:
         return
     
-    # If we have a clear category + numeric pattern, show a bar chart
-    if len(categorical_cols) >= 1 and len(numeric_cols) >= 1:
-        cat_col = categorical_cols[0]
-        num_col = numeric_cols[0]
-        
-        # Limit categories for readability
-        if df[cat_col].nunique() <= 20:
-            chart_data = df.groupby(cat_col)[num_col].sum().reset_index()
-            chart_data = chart_data.sort_values(num_col, ascending=False).head(15)
-            st.bar_chart(chart_data.set_index(cat_col))
-        else:
-            st.info("Too many categories for visualization. Showing top 15.")
-            chart_data = df.groupby(cat_col)[num_col].sum().reset_index()
-            chart_data = chart_data.sort_values(num_col, ascending=False).head(15)
-            st.bar_chart(chart_data.set_index(cat_col))
+    with st.spinner("Computing column statistics..."):
+        try:
+            if pushdown:
+                numeric_columns = tuple(df.select_dtypes(include="number").columns)
+                stats = pushdown_column_stats(hash_text(canonicalize_sql(sql)), tuple(df.columns), numeric_columns,
+                                              meta["query_id"])
+            else:
+                result_id = meta.get("result_id") or hash_text(str(id(df)))
+                stats = column_stats_for(result_id, df)
+        except Exception as e:
+            st.error(f"Could not compute column statistics: {e}")
+            return
+    st.dataframe(stats.drop(columns="Approximate"), use_container_width=True, hide_index=True)
+    if pushdown:
+        st.caption(f"Computed in Snowflake over all {stats.attrs.get('rows', 0):,} rows — distinct counts are estimates")
+    else:
+        if meta.get("truncated"):
+            st.caption(f"Computed over the first {len(df):,} rows held in the app")
+        if stats["Approximate"].any():
+            st.caption(f"Distinct counts are HyperLogLog estimates (more than {STATS_APPROX_DISTINCT_ROWS:,} rows)")
+
+
+@traced()
+def render_results_table(df: pd.DataFrame):
+    """Render the results one page at a time."""
+    page_count = max(1, math.ceil(len(df) / RESULT_PAGE_ROWS))
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)
+    start = (page - 1) * RESULT_PAGE_ROWS
+    st.dataframe(df.iloc[start:start + RESULT_PAGE_ROWS], use_container_width=True, hide_index=True, height=300)
+
+
+@fragment()
+def render_export_options(df: pd.DataFrame, meta: dict, sql: Optional[str] = None):
+    """Render export controls; files are only built and read when requested.
+    
+    Results of at least UNLOAD_MIN_ROWS rows are unloaded by Snowflake to a
+    stage by default and downloaded from presigned URLs. Export files built
+    here that exceed EXPORT_DOWNLOAD_MAX_BYTES are uploaded to the stage
+    too, rather than read into memory for st.download_button.
+    """
+    if "result_id" not in meta:
+        meta = {**meta, "result_id": hash_text(str(id(df)))}
+    
+    exp_col1, exp_col2 = st.columns(2)
+    with exp_col1:
+        export_format = st.selectbox("Export format", list(EXPORT_FORMATS), label_visibility="collapsed")
+    
+    if sql is not None and meta.get("query_id") and EXPORT_FORMATS[export_format]["unload_format"] is not None:
+        unload = st.toggle("Unload in Snowflake", value=meta.get("total_rows", len(df)) >= UNLOAD_MIN_ROWS,
+                           key="export_unload", help="Write compressed files to a Snowflake stage and download them from there")
+    else:
+        unload = False
     
-    # If only numeric, show line or area chart
-    elif len(numeric_cols) >= 1:
-        st.line_chart(df[numeric_cols])
+    if unload:
+        unload_key = (meta["result_id"], export_format)
+        with exp_col2:
+            if st.button(f"Unload {export_format} files", use_container_width=True):
+                with st.spinner("Unloading in Snowflake..."):
+                    try:
+                        files = unload_export(meta["result_id"], export_format, meta["query_id"])
+                        st.session_state["unload_files"] = {"key": unload_key, "files": files}
+                    except Exception as e:
+                        st.error(f"Unload failed: {e}")
+        unloaded = st.session_state.get("unload_files")
+        if unloaded and unloaded["key"] == unload_key:
+            for file in unloaded["files"]:
+                st.markdown(f"[{file['file']}]({file['url']}) ({format_bytes(file['bytes'])})")
+            st.caption(f"Links expire after {UNLOAD_URL_EXPIRY_SECONDS // 60} minutes")
+        return
     
+    with exp_col2:
+        # The file is only read into the page on the run after a click, not on every rerun
+        if not st.button(f"Prepare {export_format} export", use_container_width=True):
+            return
+        with st.spinner(f"Preparing {export_format} export..."):
+            try:
+                path = prepare_export(df, meta, export_format)
+                files = None
+                if os.path.getsize(path) > EXPORT_DOWNLOAD_MAX_BYTES:
+                    files = stage_export_file(meta["result_id"], export_format, path)
+            except Exception as e:
+                st.error(f"Export failed: {e}")
+                return
+        if files is not None:
+            for file in files:
+                st.markdown(f"[{file['file']}]({file['url']}) ({format_bytes(file['bytes'])})")
+            st.caption(f"Link expires after {UNLOAD_URL_EXPIRY_SECONDS // 60} minutes")
+            return
+        with open(path, "rb") as f:
+            st.download_button(
+                label=f"Download {export_format}",
+                data=f,
+                file_name=f"query_results.{EXPORT_FORMATS[export_format]['extension']}",
+                mime=EXPORT_FORMATS[export_format]["mime"],
+                use_container_width=True
+            )
+
+
+@traced()
+def render_visualization(df: pd.DataFrame, meta: dict, sql: Optional[str] = None):
+    """Render auto-generated visualization based on data.
+    
+    Charts can be aggregated in Snowflake over the stored result (the
+    default for truncated results) instead of from the rows held in memory.
+    """
+    result_id = meta.get("result_id") or hash_text(str(id(df)))
+    spec = chart_spec(df)
+    chart = None
+    if sql is not None and meta.get("query_id") and spec["kind"] is not None and spec["dimension"] is not None:
+        if st.toggle("Aggregate in Snowflake", value=bool(meta.get("truncated")), key="chart_pushdown",
+                     help="Build the chart from the full result in the warehouse"):
+            with st.spinner("Aggregating in Snowflake..."):
+                try:
+                    chart = warehouse_chart_data(sql, meta, spec)
+                except Exception as e:
+                    st.warning(f"Warehouse aggregation failed, charting the rows in memory: {e}")
+    if chart is None:
+        chart = chart_data_for(result_id, df)
+    
+    if chart["kind"] is None:
+        st.info(chart["note"])
+        return
+    if chart["note"]:
+        st.caption(chart["note"])
+    if chart["kind"] == "bar":
+        st.bar_chart(chart["data"])
     else:
-        st.info("No suitable columns found for automatic visualization")
+        st.line_chart(chart["data"])
+
+
+@fragment()
+def render_result_view(df: pd.DataFrame, meta: dict, sql: Optional[str] = None):
+    """Table or chart of the results; switching between them reruns only this fragment."""
+    _, view_col = st.columns([2, 1])
+    with view_col:
+        view_mode = st.radio("View", ["Table", "Chart"], horizontal=True, label_visibility="collapsed")
+    if view_mode == "Table":
+        render_results_table(df)
+    else:
+        render_visualization(df, meta, sql)
+
+
+def trace_breakdown(trace: dict) -> pd.DataFrame:
+    """Spans of a trace as a table, children indented under their parents."""
+    spans = trace["spans"]
+    depths = {}
+    for span in spans:
+        depths[span["span_id"]] = depths.get(span["parent_id"], -1) + 1
+    return pd.DataFrame([
+        {
+            "Stage": "\u00a0\u00a0" * depths[span["span_id"]] + span["name"],
+            "Start (ms)": round(span["start"] * 1000, 1),
+            "Duration (ms)": round(span["duration"] * 1000, 1),
+            "CPU (ms)": round(span["cpu"] * 1000, 1),
+            "Attributes": ", ".join(f"{key}={value}" for key, value in span["attributes"].items() if value is not None)
+                          + (f" error={span['error']}" if span["error"] else ""),
+        }
+        for span in spans
+    ], columns=["Stage", "Start (ms)", "Duration (ms)", "CPU (ms)", "Attributes"])
+
+
+def render_performance_panel():
+    """Timing breakdown of the last pipeline run and the previous rerun (shown with ?perf=1)."""
+    if st.query_params.get(PERF_PANEL_QUERY_PARAM) != "1":
+        return
+    with st.expander("Performance", expanded=True):
+        for key, title in [("last_run_trace", "Last run"), ("last_rerun_trace", "Previous rerun")]:
+            trace = st.session_state.get(key)
+            if trace is None:
+                continue
+            tags = ", ".join(f"{name}={value}" for name, value in trace["attributes"].items())
+            st.markdown(f"**{title}** — {trace['duration'] * 1000:,.0f} ms, {trace['cpu'] * 1000:,.0f} ms CPU"
+                        + (f" ({tags})" if tags else ""))
+            st.dataframe(trace_breakdown(trace), use_container_width=True, hide_index=True)
+        if METRICS_PORT:
+            st.caption(f"Prometheus metrics at http://{METRICS_ADDRESS}:{METRICS_PORT}/metrics")
+
+
+# Top-level spans that make a rerun a pipeline run worth keeping for the performance panel
+RUN_SPANS = {"generate", "preview", "execute", "fetch_result", "fix"}
+
+
+def remember_trace(trace: Trace):
+    """Keep a finished rerun's trace for the performance panel."""
+    trace_dict = trace.to_dict()
+    st.session_state["last_rerun_trace"] = trace_dict
+    if any(span["name"] in RUN_SPANS and span["parent_id"] is None for span in trace_dict["spans"]):
+        st.session_state["last_run_trace"] = trace_dict
 
 
 # =============================================================================
@@ -926,22 +953,41 @@ def main():
         layout="wide",
         initial_sidebar_state="expanded"
     )
+    set_secrets(st.secrets)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
     
+    # Every rerun is traced; st.rerun() leaves through here too, so the trace is kept in finally
+    trace = None
+    try:
+        with start_trace("rerun") as trace:
+            render_app()
+    finally:
+        if trace is not None:
+            remember_trace(trace)
+
+
+def render_app():
     apply_custom_css()
     render_header()
     render_sidebar()
     
     # Initialize session state
-    if "query_history" not in st.session_state:
-        st.session_state["query_history"] = []
     if "gen_counter" not in st.session_state:
         st.session_state["gen_counter"] = 0
     if "query_limit" not in st.session_state:
         st.session_state["query_limit"] = DEFAULT_LIMIT
+    if "session_key" not in st.session_state:
+        st.session_state["session_key"] = uuid.uuid4().hex
     
     # Fetch schema
-    with st.spinner("Loading table schema..."):
-        all_columns = get_all_columns()
+    with st.spinner("Loading table schema..."), trace_span("schema_load") as span:
+        try:
+            all_columns = get_all_columns()
+        except Exception as e:
+            st.error(f"Error fetching columns: {e}")
+            all_columns = []
+        span["columns"] = len(all_columns)
     
     if not all_columns:
         st.error("Could not fetch table schema. Please check your Snowflake connection.")
@@ -1016,18 +1062,28 @@ def main():
         
         # Generate query (either from button or auto-generate from example)
         if (generate_btn or auto_generate) and user_question:
+            # Streamed output shows up here while the explanation is still being written
+            sql_preview = st.empty()
+            explanation_preview = st.empty()
+            cancel_speculative_preview()
             with st.spinner("Generating SQL..."):
-                schema_description = build_schema_description(all_columns)
-                sql, explanation = generate_sql(user_question, schema_description, st.session_state["query_limit"])
+                with trace_span("generate", question_hash=hash_text(user_question)):
+                    sql, explanation, is_safe, safety_msg = generate_checked_sql(
+                        user_question, all_columns, st.session_state["query_limit"],
+                        on_sql=lambda sql: sql_preview.code(sql, language="sql"),
+                        on_explanation=lambda text: explanation_preview.caption(text),
+                        use_rollups=st.session_state.get("use_rollups", ROLLUPS_ENABLED),
+                        approximate=st.session_state.get("approximate_distinct", APPROXIMATE_DISTINCT_DEFAULT)
+                    )
                 
-                # Validate safety
-                is_safe, safety_msg = validate_sql_safety(sql)
                 if not is_safe:
                     st.error(f"{safety_msg}")
                 else:
                     st.session_state["generated_sql"] = sql
                     st.session_state["sql_explanation"] = explanation
                     st.session_state["current_question"] = user_question
+                    st.session_state["prompt_usage"] = last_prompt_usage()
+                    st.session_state["sql_checks"] = last_sql_checks()
                     st.session_state["gen_counter"] += 1
                     st.rerun()
     
@@ -1045,11 +1101,33 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
             
+            if "prompt_usage" in st.session_state:
+                usage = st.session_state["prompt_usage"]
+                if usage is None:
+                    st.caption("SQL served from cache — no AI call")
+                else:
+                    st.caption(
+                        f"Prompt {usage['prompt_tokens'] or 0:,} tokens ({usage['cached_prompt_tokens']:,} cached), "
+                        f"completion {usage['completion_tokens'] or 0:,} tokens"
+                    )
+            
             st.markdown("<br/>", unsafe_allow_html=True)
             
+            use_rollups = st.session_state.get("use_rollups", ROLLUPS_ENABLED)
+            incremental_execution = st.session_state.get("incremental_execution", INCREMENTAL_EXECUTION_DEFAULT)
+            approximate_distinct = st.session_state.get("approximate_distinct", APPROXIMATE_DISTINCT_DEFAULT)
+            cache_mode = result_cache_mode(use_rollups, incremental_execution, approximate_distinct)
+            
             # Cost estimation / Query Validation
             st.markdown("##### Query Validation")
-            cost_info = estimate_query_cost(st.session_state["generated_sql"])
+            checks = st.session_state.get("sql_checks")
+            if (checks and checks["sql"] == st.session_state["generated_sql"] and checks["use_rollups"] == use_rollups
+                    and checks["approximate"] == approximate_distinct and checks["cost_info"] is not None):
+                cost_info = checks["cost_info"]
+            else:
+                cost_info = estimate_query_cost(
+                    resolve_execution_sql(st.session_state["generated_sql"], use_rollups, approximate_distinct)[0]
+                )
             render_cost_estimation(cost_info)
             
             st.markdown("<br/>", unsafe_allow_html=True)
@@ -1064,113 +1142,155 @@ def main():
                 label_visibility="collapsed"
             )
             
+            # Only the generated SQL is speculated on; editing it cancels the background preview
+            if st.session_state.get("speculative_preview_enabled", SPECULATIVE_PREVIEW_DEFAULT):
+                unedited = edited_sql.strip() == st.session_state["generated_sql"].strip()
+                update_speculative_preview(st.session_state["generated_sql"] if unedited else None,
+                                           cost_info, use_rollups, incremental_execution, approximate_distinct)
+            else:
+                cancel_speculative_preview()
+            
             # Preview and Execute buttons
             btn_col1, btn_col2, btn_col3 = st.columns([1, 1, 1])
             with btn_col1:
-                preview_btn = st.button("Preview (10 rows)", use_container_width=True)
+                preview_btn = st.button(f"Preview ({PREVIEW_ROWS} rows)", use_container_width=True)
             with btn_col2:
                 execute_btn = st.button("Execute", type="primary", use_container_width=True)
             with btn_col3:
                 if st.button("Clear", use_container_width=True):
-                    for key in ["generated_sql", "sql_explanation", "query_results", "current_question"]:
+                    if "running_query" in st.session_state:
+                        cancel_query(st.session_state["running_query"]["query_id"])
+                    cancel_speculative_preview()
+                    for key in ["generated_sql", "sql_explanation", "query_results", "query_meta", "query_sql", "unload_files", "current_question",
+                                "running_query", "failed_query", "prompt_usage", "sql_checks"]:
                         if key in st.session_state:
                             del st.session_state[key]
                     st.rerun()
             
             # Preview execution
             if preview_btn:
-                preview_sql = re.sub(r'LIMIT\s+\d+', 'LIMIT 10', edited_sql, flags=re.IGNORECASE)
-                if 'LIMIT' not in preview_sql.upper():
-                    preview_sql = preview_sql.rstrip(';') + ' LIMIT 10'
-                
-                with st.spinner("Running preview..."):
-                    try:
-                        df = execute_query(preview_sql)
-                        st.markdown("##### Preview Results (first 10 rows)")
-                        st.dataframe(df, use_container_width=True, hide_index=True, height=200)
-                    except Exception as e:
-                        st.error(f"Preview failed: {e}")
+                is_safe, safety_msg = validate_sql_safety(edited_sql)
+                if not is_safe:
+                    st.error(f"{safety_msg}")
+                else:
+                    with st.spinner("Running preview..."):
+                        try:
+                            with trace_span("preview") as span:
+                                wait_for_speculative_preview(edited_sql)
+                                preview_sql = rewrite_outer_limit(edited_sql, PREVIEW_ROWS)
+                                df, preview_meta = execute_query_cached(preview_sql, use_rollups,
+                                                                        incremental_execution, approximate_distinct)
+                                span.update(query_id=preview_meta.get("query_id"), rows=len(df),
+                                            from_cache=preview_meta["from_cache"])
+                            st.markdown(f"##### Preview Results (first {PREVIEW_ROWS} rows)")
+                            if preview_meta["from_cache"]:
+                                st.caption("Served from cache")
+                            st.dataframe(df, use_container_width=True, hide_index=True, height=200)
+                        except Exception as e:
+                            st.error(f"Preview failed: {e}")
             
             # Full execution
             if execute_btn:
                 is_safe, safety_msg = validate_sql_safety(edited_sql)
+                question = st.session_state.get("current_question", user_question)
+                cached = get_result_cache().get(edited_sql, cache_mode) if is_safe else None
+                execution_sql, rollup = edited_sql, None
+                if is_safe and cached is None:
+                    execution_sql, rollup = resolve_execution_sql(edited_sql, use_rollups, approximate_distinct)
+                edited_cost = estimate_query_cost(execution_sql) if is_safe and cached is None else {}
+                # Incremental runs are several local steps, so they run in the foreground
+                incremental = (is_safe and cached is None and rollup is None and incremental_execution
+                               and plan_incremental(edited_sql, approximate_distinct) is not None)
                 if not is_safe:
                     st.error(f"{safety_msg}")
+                elif edited_cost.get("blocked"):
+                    st.error(edited_cost["block_reason"])
+                elif cached is not None:
+                    df, meta = cached
+                    meta["from_cache"] = True
+                    store_query_result(df, meta, edited_sql, question, duration_seconds=0.0)
+                elif st.session_state.get("async_execution", True) and not incremental:
+                    try:
+                        with trace_span("execute", question_hash=hash_text(question or ""), mode="async") as span:
+                            span["query_id"] = query_id = submit_query(execution_sql)
+                        st.session_state["running_query"] = {
+                            "query_id": query_id,
+                            "rollup": rollup,
+                            "cache_mode": cache_mode,
+                            "sql": edited_sql,
+                            "question": question,
+                            "started_at": time.time(),
+                        }
+                        st.session_state.pop("failed_query", None)
+                    except Exception as e:
+                        st.session_state["failed_query"] = {"sql": edited_sql, "error": str(e)}
                 else:
                     with st.spinner("Executing query..."):
                         try:
-                            df = execute_query(edited_sql)
-                            st.session_state["query_results"] = df
-                            
-                            # Add to history
-                            history_item = {
-                                "question": st.session_state.get("current_question", user_question),
-                                "sql": edited_sql,
-                                "explanation": st.session_state.get("sql_explanation", ""),
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            st.session_state["query_history"].append(history_item)
-                            
+                            started = time.perf_counter()
+                            with trace_span("execute", question_hash=hash_text(question or ""),
+                                            bytes_estimated=edited_cost.get("bytes_assigned")) as span:
+                                df, meta = execute_query_cached(edited_sql, use_rollups, incremental_execution,
+                                                                approximate_distinct)
+                                span.update(query_id=meta.get("query_id"), rows=meta["total_rows"])
+                            store_query_result(df, meta, edited_sql, question,
+                                               duration_seconds=time.perf_counter() - started)
                         except Exception as e:
-                            st.error(f"Query execution failed: {e}")
-                            
-                            if st.button("Try to fix automatically"):
-                                with st.spinner("Attempting to fix query..."):
-                                    schema_description = build_schema_description(all_columns)
-                                    fixed_sql, fix_explanation = fix_failed_query(
-                                        st.session_state.get("current_question", user_question),
-                                        edited_sql,
-                                        str(e),
-                                        schema_description,
-                                        st.session_state["query_limit"]
-                                    )
-                                    st.session_state["generated_sql"] = fixed_sql
-                                    st.session_state["sql_explanation"] = fix_explanation
-                                    st.session_state["gen_counter"] += 1
-                                    st.rerun()
+                            st.session_state["failed_query"] = {"sql": edited_sql, "error": str(e)}
+            
+            if "running_query" in st.session_state:
+                render_running_query(st.session_state["running_query"])
+            
+            # Failed execution
+            if "failed_query" in st.session_state:
+                failed = st.session_state["failed_query"]
+                st.error(f"Query execution failed: {failed['error']}")
+                
+                if st.button("Try to fix automatically"):
+                    with st.spinner("Attempting to fix query..."), trace_span("fix"):
+                        schema_description = get_schema_description(all_columns)
+                        fixed_sql, fix_explanation = fix_failed_query(
+                            st.session_state.get("current_question", user_question),
+                            failed["sql"],
+                            failed["error"],
+                            schema_description,
+                            st.session_state["query_limit"]
+                        )
+                        st.session_state.pop("failed_query", None)
+                        st.session_state["prompt_usage"] = last_prompt_usage()
+                        st.session_state["generated_sql"] = fixed_sql
+                        st.session_state["sql_explanation"] = fix_explanation
+                        st.session_state["gen_counter"] += 1
+                        st.rerun()
             
             # Display results
             if "query_results" in st.session_state:
                 st.markdown("---")
                 df = st.session_state["query_results"]
+                meta = st.session_state.get("query_meta", {})
                 
                 # Results header with stats
-                res_col1, res_col2 = st.columns([2, 1])
-                with res_col1:
-                    st.markdown(f"##### Results ({len(df):,} rows)")
-                with res_col2:
-                    view_mode = st.radio("View", ["Table", "Chart"], horizontal=True, label_visibility="collapsed")
-                
-                # Column stats
-                stats = get_column_stats(df)
-                render_column_stats(stats)
-                
-                # Results display
-                if view_mode == "Table":
-                    st.dataframe(df, use_container_width=True, hide_index=True, height=300)
-                else:
-                    render_visualization(df)
-                
-                # Export options
-                exp_col1, exp_col2 = st.columns(2)
-                with exp_col1:
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv,
-                        file_name="query_results.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
-                with exp_col2:
-                    json_data = df.to_json(orient="records", indent=2)
-                    st.download_button(
-                        label="Download JSON",
-                        data=json_data,
-                        file_name="query_results.json",
-                        mime="application/json",
-                        use_container_width=True
+                st.markdown(f"##### Results ({meta.get('total_rows', len(df)):,} rows)")
+                if meta.get("from_cache"):
+                    st.caption("Served from cache")
+                if meta.get("rollup"):
+                    st.caption(f"Answered from rollup table {meta['rollup']}")
+                if meta.get("incremental"):
+                    run_info = meta["incremental"]
+                    st.caption(
+                        f"Incremental run: queried {run_info['days_queried']} of {run_info['days']} days, "
+                        f"the rest from cached daily results"
                     )
+                if meta.get("approximate"):
+                    st.warning("Distinct counts in this result are HyperLogLog estimates, not exact counts. "
+                               "Turn off \"Allow approximate distinct counts\" for exact counts.")
+                if meta.get("truncated"):
+                    st.caption(f"Showing the first {len(df):,} rows in the app — exports include all rows")
+                
+                # Stats, table/chart and exports are fragments: using one reruns only that panel
+                render_column_stats(df, meta, st.session_state.get("query_sql"))
+                render_result_view(df, meta, st.session_state.get("query_sql"))
+                render_export_options(df, meta, st.session_state.get("query_sql"))
         else:
             # Empty state for right side
             st.markdown("""
@@ -1188,6 +1308,8 @@ def main():
                 <div style="font-size: 0.9rem; margin-top: 0.5rem;">Ask a question or select an example to get started</div>
             </div>
             """, unsafe_allow_html=True)
+        
+        render_performance_panel()
 
 
 if __name__ == "__main__":
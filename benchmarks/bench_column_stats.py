@@ -0,0 +1,97 @@
+"""Time column statistics on synthetic results shaped like event rows.
+
+Compares the per-column loop the app used before with get_column_stats()
+(vectorized, HyperLogLog distinct counts above STATS_APPROX_DISTINCT_ROWS):
+time and peak traced memory of one computation, the cost of a rerun once
+the stats are memoized per result (column_stats_for), and the worst
+relative error of the distinct-count estimates. Runs offline; no Snowflake
+access is needed.
+
+Usage:
+    python benchmarks/bench_column_stats.py --rows 100000 300000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from query_studio import stats  # noqa: E402
+
+
+def synthetic_result(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "DATE": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 30, rows), unit="D"),
+        "USER_ID": rng.integers(0, rows // 3, rows).astype(str),
+        "DEVICE_TYPE": rng.choice(["tablet", "mobile", "web", "smart_tv"], rows),
+        "ITEM_ID": rng.integers(0, 100_000, rows),
+        "EVENTS": rng.integers(1, 500, rows),
+        "PLAY_TIME": rng.exponential(120.0, rows),
+    })
+    df.loc[::7, "PLAY_TIME"] = np.nan
+    return df
+
+
+def loop_column_stats(df: pd.DataFrame) -> dict:
+    """The original implementation: one pass per statistic per column."""
+    result = {}
+    for col in df.columns:
+        col_stats = {"distinct": df[col].nunique(), "nulls": df[col].isnull().sum()}
+        if pd.api.types.is_numeric_dtype(df[col]):
+            col_stats["min"] = df[col].min()
+            col_stats["max"] = df[col].max()
+            col_stats["mean"] = df[col].mean()
+        result[col] = col_stats
+    return result
+
+
+def best_of(func, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def peak_mb(func) -> float:
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 300_000, 1_000_000])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'loop ms':>9} {'engine ms':>10} {'rerun ms':>9} "
+          f"{'loop peak MB':>13} {'engine peak MB':>15} {'max distinct err':>17}")
+    for rows in args.rows:
+        df = synthetic_result(rows)
+        loop_ms = best_of(lambda: loop_column_stats(df), args.repeats)
+        engine_ms = best_of(lambda: stats.get_column_stats(df), args.repeats)
+        app.column_stats_for(f"bench-{rows}", df)
+        rerun_ms = best_of(lambda: app.column_stats_for(f"bench-{rows}", df), args.repeats)
+        loop_mb = peak_mb(lambda: loop_column_stats(df))
+        engine_mb = peak_mb(lambda: stats.get_column_stats(df))
+        
+        exact = df.nunique()
+        estimated = stats.get_column_stats(df).set_index("Column")["Distinct Values"]
+        error = max(abs(estimated[col] - exact[col]) / exact[col] for col in df.columns if exact[col])
+        print(f"{rows:>10,} {loop_ms:>9.1f} {engine_ms:>10.1f} {rerun_ms:>9.2f} "
+              f"{loop_mb:>13.1f} {engine_mb:>15.1f} {error:>16.2%}")
+
+
+if __name__ == "__main__":
+    main()
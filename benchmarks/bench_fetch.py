@@ -0,0 +1,83 @@
+"""Compare the Arrow and row-tuple fetch paths of execute_query().
+
+Runs a synthetic query shaped like combined_events_enriched rows through
+Snowflake's GENERATOR table function, so it needs the same secrets as the
+app but no access to the events table. Every (mode, rows) case runs in a
+fresh process so peak RSS is measured per case.
+
+Usage:
+    python benchmarks/bench_fetch.py --rows 1000 10000 100000 1000000
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SYNTHETIC_EVENTS_SQL = """
+SELECT
+    DATEADD(day, -UNIFORM(1, 30, RANDOM()), CURRENT_DATE()) AS date,
+    DATEADD(second, -UNIFORM(1, 86400, RANDOM()), CURRENT_TIMESTAMP()::TIMESTAMP_NTZ) AS event_time,
+    ARRAY_CONSTRUCT('page_view', 'play', 'click', 'ads', 'engagement')[UNIFORM(0, 4, RANDOM())]::VARCHAR AS event_name,
+    SEQ8() AS calculated_visit_id,
+    UUID_STRING() AS user_id,
+    UNIFORM(1, 100000, RANDOM())::VARCHAR AS item_id,
+    UNIFORM(1, 50, RANDOM())::VARCHAR AS channel_id,
+    IFF(UNIFORM(0, 9, RANDOM()) = 0, 1, NULL) AS visit_first_event,
+    ARRAY_CONSTRUCT('tablet', 'mobile', 'web', 'smart_tv')[UNIFORM(0, 3, RANDOM())]::VARCHAR AS device_type,
+    ARRAY_CONSTRUCT('mako', 'n12', '12plus', 'v1')[UNIFORM(0, 3, RANDOM())]::VARCHAR AS site,
+    UNIFORM(0, 3600, RANDOM())::NUMBER(10, 2) AS play_time_from_last_event
+FROM TABLE(GENERATOR(ROWCOUNT => {rows}))
+"""
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(mode: str, rows: int, queue):
+    from query_studio import db
+
+    # Open the pooled connection before measuring
+    with db.get_connection_pool().connection():
+        pass
+    baseline_mb = peak_rss_mb()
+
+    start = time.perf_counter()
+    df = db.execute_query(SYNTHETIC_EVENTS_SQL.format(rows=rows), fetch_mode=mode)
+    elapsed = time.perf_counter() - start
+
+    queue.put({
+        "mode": mode,
+        "rows": len(df),
+        "seconds": elapsed,
+        "rows_per_sec": len(df) / elapsed if elapsed else 0.0,
+        "peak_rss_delta_mb": peak_rss_mb() - baseline_mb,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--modes", nargs="+", default=["rows", "arrow"], choices=["rows", "arrow"])
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'mode':<6} {'rows':>10} {'seconds':>9} {'rows/sec':>12} {'peak RSS +MB':>13}")
+    for rows in args.rows:
+        for mode in args.modes:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run_case, args=(mode, rows, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print(f"{result['mode']:<6} {result['rows']:>10,} {result['seconds']:>9.2f} "
+                  f"{result['rows_per_sec']:>12,.0f} {result['peak_rss_delta_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
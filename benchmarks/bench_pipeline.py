@@ -0,0 +1,226 @@
+"""Benchmark the question -> SQL -> execute -> stats -> export pipeline offline.
+
+Runs against the local stand-ins in benchmarks/standins.py: a DuckDB
+database holding a synthetic combined_events_enriched table of --rows rows,
+and a deterministic fake OpenAI client answering with the SQL from the
+questions fixture after --llm-latency-ms. No credentials are needed.
+
+Every question goes through each stage --iterations times with the app's
+caches reset, then once more under tracemalloc to measure peak memory per
+stage (Python/NumPy heap peak plus Arrow buffers still held when the stage
+ends). Reports throughput and p50/p95/p99 latency per stage.
+--save-baseline stores the report as JSON; --baseline compares against a
+stored report and fails if a stage's p95 latency or peak memory regressed
+past --tolerance. Baselines are machine-specific: record one on the machine
+that runs the comparison.
+
+Usage:
+    python benchmarks/bench_pipeline.py --rows 1000000 --iterations 5
+    python benchmarks/bench_pipeline.py --save-baseline benchmarks/baselines/pipeline.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baselines/pipeline.json --tolerance 0.5
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CACHE_ROOT = tempfile.mkdtemp(prefix="bench_pipeline_")
+os.environ["QUERY_STUDIO_CACHE_DIR"] = CACHE_ROOT
+
+import pyarrow as pa  # noqa: E402
+
+import standins  # noqa: E402
+from query_studio import caching, charts, config, db, exports, pipeline, sql_analysis, stats  # noqa: E402
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pipeline_questions.jsonl")
+STAGES = ["generate", "validate", "estimate", "execute", "stats", "chart", "export"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def reset_caches(run: int):
+    """Fresh SQL, result and partial caches (in a new directory) and empty plan/parse caches."""
+    caching.CACHE_DIR = os.path.join(CACHE_ROOT, f"run{run}")
+    caching.get_sql_cache.cache_clear()
+    caching.get_result_cache.cache_clear()
+    caching.get_partial_cache.cache_clear()
+    db.explain_query.clear()
+    sql_analysis.parse_sql.cache_clear()
+    sql_analysis._analyze_sql.cache_clear()
+
+
+def run_question(item: dict, all_columns: list, export_format: str, measure):
+    """Run one question through every stage; measure(stage, func) runs and records a stage."""
+    sql = measure("generate", lambda: pipeline.generate_checked_sql(item["question"], all_columns, config.DEFAULT_LIMIT)[0])
+    measure("validate", lambda: sql_analysis.validate_sql_safety(sql))
+    measure("estimate", lambda: db.estimate_query_cost(sql))
+    df, meta = measure("execute", lambda: db.execute_query_paged(sql))
+    measure("stats", lambda: stats.get_column_stats(df))
+    measure("chart", lambda: charts.prepare_chart_data(df))
+    path = os.path.join(CACHE_ROOT, f"export.{exports.EXPORT_FORMATS[export_format]['extension']}")
+    measure("export", lambda: exports.write_export(db.iter_result_batches(df, meta), export_format, path))
+    return len(df)
+
+
+def time_stages(questions: list, all_columns: list, iterations: int, export_format: str) -> dict:
+    timings = {stage: [] for stage in STAGES}
+
+    def measure(stage, func):
+        started = time.perf_counter()
+        result = func()
+        timings[stage].append(time.perf_counter() - started)
+        return result
+
+    rows, started = 0, time.perf_counter()
+    for run in range(iterations):
+        reset_caches(run)
+        for item in questions:
+            rows += run_question(item, all_columns, export_format, measure)
+    wall_seconds = time.perf_counter() - started
+    return {"timings": timings, "wall_seconds": wall_seconds, "questions": iterations * len(questions), "rows": rows}
+
+
+def measure_memory(questions: list, all_columns: list, export_format: str) -> dict:
+    peaks = {stage: 0 for stage in STAGES}
+    pool = pa.default_memory_pool()
+
+    def measure(stage, func):
+        tracemalloc.reset_peak()
+        heap_before, arrow_before = tracemalloc.get_traced_memory()[0], pool.bytes_allocated()
+        result = func()
+        heap_peak, arrow_after = tracemalloc.get_traced_memory()[1], pool.bytes_allocated()
+        peaks[stage] = max(peaks[stage], heap_peak - heap_before + max(arrow_after - arrow_before, 0))
+        return result
+
+    reset_caches(-1)
+    tracemalloc.start()
+    try:
+        for item in questions:
+            run_question(item, all_columns, export_format, measure)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def build_report(args, timed: dict, peaks: dict) -> dict:
+    stages = {}
+    for stage in STAGES:
+        values = timed["timings"][stage]
+        stages[stage] = {
+            "count": len(values),
+            "throughput_per_s": len(values) / sum(values) if sum(values) else 0.0,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "peak_mb": peaks[stage] / 1024 ** 2,
+        }
+    return {
+        "config": {
+            "rows": args.rows,
+            "days": args.days,
+            "iterations": args.iterations,
+            "db_latency_ms": args.db_latency_ms,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_tokens_per_second": args.llm_tokens_per_second,
+            "export_format": args.export_format,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "stages": stages,
+        "end_to_end": {
+            "questions": timed["questions"],
+            "questions_per_s": timed["questions"] / timed["wall_seconds"],
+            "result_rows": timed["rows"],
+        },
+    }
+
+
+def print_report(report: dict):
+    print(f"{'stage':<10} {'n':>5} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>9}")
+    for stage, timing in report["stages"].items():
+        print(f"{stage:<10} {timing['count']:>5} {timing['throughput_per_s']:>9.1f} {timing['p50_ms']:>9.2f} "
+              f"{timing['p95_ms']:>9.2f} {timing['p99_ms']:>9.2f} {timing['peak_mb']:>9.1f}")
+    end_to_end = report["end_to_end"]
+    print(f"\n{end_to_end['questions']} questions at {end_to_end['questions_per_s']:.2f}/s "
+          f"({end_to_end['result_rows']:,} result rows)")
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """Stages whose p95 latency or peak memory regressed past the tolerance."""
+    regressions = []
+    changed = [key for key in ("rows", "days", "db_latency_ms", "llm_latency_ms", "llm_tokens_per_second", "export_format")
+               if baseline["config"].get(key) != report["config"].get(key)]
+    if changed:
+        print(f"WARNING: baseline was recorded with different settings: {', '.join(changed)}")
+    for stage, timing in report["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        if timing["p95_ms"] > base["p95_ms"] * (1 + tolerance) and timing["p95_ms"] - base["p95_ms"] > min_delta_ms:
+            regressions.append(f"{stage}: p95 {base['p95_ms']:.2f} -> {timing['p95_ms']:.2f} ms")
+        # Allow 1 MB of slack so tiny stages don't flap
+        if timing["peak_mb"] > base["peak_mb"] * (1 + tolerance) + 1:
+            regressions.append(f"{stage}: peak memory {base['peak_mb']:.1f} -> {timing['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="JSONL of {question, sql}")
+    parser.add_argument("--rows", type=int, default=200_000, help="Rows in the synthetic events table")
+    parser.add_argument("--days", type=int, default=30, help="Days of synthetic events, ending yesterday")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="Added to every Snowflake statement")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="Time to the first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=2000.0)
+    parser.add_argument("--export-format", choices=list(exports.EXPORT_FORMATS), default="Parquet")
+    parser.add_argument("--save-baseline", help="Write the report to this JSON file")
+    parser.add_argument("--baseline", help="Compare against this JSON report and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="Ignore p95 regressions smaller than this")
+    args = parser.parse_args()
+
+    questions = standins.load_questions(args.questions)
+    started = time.perf_counter()
+    standins.install_standins(questions, rows=args.rows, days=args.days,
+                              db_latency_seconds=args.db_latency_ms / 1000,
+                              llm_latency_seconds=args.llm_latency_ms / 1000,
+                              llm_tokens_per_second=args.llm_tokens_per_second)
+    all_columns = db.get_all_columns()
+    print(f"Loaded {args.rows:,} synthetic rows in {time.perf_counter() - started:.1f}s\n")
+
+    timed = time_stages(questions, all_columns, args.iterations, args.export_format)
+    peaks = measure_memory(questions, all_columns, args.export_format)
+    report = build_report(args, timed, peaks)
+    print_report(report)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("\nFAIL: regressions against baseline")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Time SQL parsing and analysis for typical generated queries.
+
+Measures cold (parse + analysis) and warm (cached) analyze_sql() calls and
+the outer LIMIT rewrite, and fails if the cold p95 exceeds the budget.
+Runs offline; no Snowflake or OpenAI access is needed.
+
+Usage:
+    python benchmarks/bench_sql_analysis.py --iterations 200 --budget-ms 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_studio import sql_analysis  # noqa: E402
+
+TYPICAL_QUERIES = [
+    """SELECT
+    COUNT(DISTINCT user_id) AS unique_users
+FROM mako_data_lake.public.combined_events_enriched
+WHERE date >= DATEADD(day, -5, CURRENT_DATE()) AND SITE = 'mako'
+LIMIT 100""",
+    """SELECT
+    DEVICE_TYPE,
+    COUNT(*) AS events
+FROM mako_data_lake.public.combined_events_enriched
+WHERE date = '2024-01-01'
+GROUP BY DEVICE_TYPE
+ORDER BY events DESC
+LIMIT 100""",
+    """SELECT
+    IL_OR_ABROAD,
+    SUM(visit_first_event) AS visits,
+    ROUND(100 * SUM(visit_first_event) / SUM(SUM(visit_first_event)) OVER (), 2) AS pct
+FROM mako_data_lake.public.combined_events_enriched
+WHERE date BETWEEN '2024-01-01' AND '2024-01-07'
+GROUP BY IL_OR_ABROAD
+LIMIT 100""",
+    """SELECT
+    COUNT_IF(action = 'start') AS started,
+    COUNT_IF(action = 'complete') AS completed
+FROM mako_data_lake.public.combined_events_enriched
+WHERE date = '2024-01-01' AND event_name = 'play'
+LIMIT 100""",
+    """WITH visits AS (
+    SELECT
+        PLATFORM,
+        calculated_visit_id,
+        COUNT(*) AS events
+    FROM mako_data_lake.public.combined_events_enriched
+    WHERE date = '2024-01-01'
+    GROUP BY PLATFORM, calculated_visit_id
+)
+SELECT
+    PLATFORM,
+    AVG(events) AS avg_events_per_visit
+FROM visits
+GROUP BY PLATFORM
+ORDER BY avg_events_per_visit DESC
+LIMIT 100""",
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def time_ms(func, iterations, clear_cache):
+    timings = []
+    for _ in range(iterations):
+        if clear_cache:
+            sql_analysis.parse_sql.cache_clear()
+            sql_analysis._analyze_sql.cache_clear()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--budget-ms", type=float, default=5.0, help="Maximum allowed cold p95 per query")
+    args = parser.parse_args()
+
+    over_budget = False
+    print(f"{'query':<6} {'cold mean':>10} {'cold p95':>9} {'warm mean':>10} {'limit rewrite':>14}  (ms)")
+    for i, sql in enumerate(TYPICAL_QUERIES):
+        cold = time_ms(lambda: sql_analysis.analyze_sql(sql), args.iterations, clear_cache=True)
+        warm = time_ms(lambda: sql_analysis.analyze_sql(sql), args.iterations, clear_cache=False)
+        rewrite = time_ms(lambda: sql_analysis.rewrite_outer_limit(sql, 10), args.iterations, clear_cache=False)
+        cold_p95 = percentile(cold, 0.95)
+        over_budget |= cold_p95 > args.budget_ms
+        print(f"{i:<6} {statistics.mean(cold):>10.3f} {cold_p95:>9.3f} "
+              f"{statistics.mean(warm):>10.4f} {statistics.mean(rewrite):>14.3f}")
+
+    if over_budget:
+        print(f"FAIL: cold p95 above {args.budget_ms} ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
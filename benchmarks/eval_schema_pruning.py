@@ -0,0 +1,117 @@
+"""Evaluate schema pruning: prompt size reduction and SQL accuracy.
+
+For every question in the fixture, compares the full schema description with
+the pruned one from select_relevant_columns(): prompt size, and recall of the
+columns the question needs. Runs offline against IMPORTANT_COLUMNS by
+default; --live uses the real DESCRIBE TABLE output instead.
+
+With --llm, SQL is also generated from both prompts (bypassing the SQL
+cache). A pruned query counts as accurate when it parses and references
+every expected column; with --execute both queries also run on Snowflake
+and the pruned one must return the same result as the full-schema one.
+
+Usage:
+    python benchmarks/eval_schema_pruning.py --top-k 12
+    python benchmarks/eval_schema_pruning.py --live --llm --execute
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+from datetime import datetime, timedelta
+
+from sqlglot import exp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_studio import config, db, generation, sql_analysis  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "schema_questions.jsonl")
+
+
+def load_questions(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def referenced_columns(sql: str) -> set:
+    """Lower-cased column names referenced by a query, or None if it does not parse."""
+    try:
+        statements = sql_analysis.parse_sql(sql)
+    except Exception:
+        return None
+    return {column.name.lower() for statement in statements for column in statement.find_all(exp.Column)}
+
+
+def same_result(sql_a: str, sql_b: str) -> bool:
+    df_a, df_b = db.execute_query(sql_a), db.execute_query(sql_b)
+    if df_a.shape != df_b.shape:
+        return False
+    df_a.columns = df_b.columns = range(df_a.shape[1])
+    sort = lambda df: df.sort_values(list(df.columns)).reset_index(drop=True)
+    return sort(df_a).round(6).equals(sort(df_b).round(6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=FIXTURE, help="JSONL file of {question, columns}")
+    parser.add_argument("--top-k", type=int, default=config.SCHEMA_TOP_K)
+    parser.add_argument("--live", action="store_true", help="Use the real table schema")
+    parser.add_argument("--llm", action="store_true", help="Generate SQL from both prompts")
+    parser.add_argument("--execute", action="store_true", help="Run both queries and compare results (implies --llm)")
+    args = parser.parse_args()
+    args.llm |= args.execute
+
+    if args.live:
+        all_columns = db.get_all_columns()
+    else:
+        all_columns = [(name, info["type"]) for name, info in config.IMPORTANT_COLUMNS.items()]
+    full_prompt = generation.build_generation_prompt(generation.get_schema_description(all_columns))
+    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    rows = []
+    for item in load_questions(args.questions):
+        selected = generation.select_relevant_columns(item["question"], all_columns, args.top_k)
+        pruned_prompt = generation.build_generation_prompt(generation.get_schema_description(selected))
+        expected = {name.lower() for name in item["columns"]}
+        row = {
+            "question": item["question"],
+            "columns": len(selected),
+            "reduction": 1 - len(pruned_prompt) / len(full_prompt),
+            "recall": len(expected & {name.lower() for name, _ in selected}) / len(expected),
+        }
+
+        if args.llm:
+            sql, _ = generation.request_sql_generation(item["question"], generation.get_schema_description(selected),
+                                                       config.DEFAULT_LIMIT, yesterday)
+            used = referenced_columns(sql)
+            row["accurate"] = used is not None and expected <= used
+            if args.execute and row["accurate"]:
+                full_sql, _ = generation.request_sql_generation(item["question"],
+                                                                generation.get_schema_description(all_columns),
+                                                                config.DEFAULT_LIMIT, yesterday)
+                try:
+                    row["accurate"] = same_result(sql, full_sql)
+                except Exception as e:
+                    print(f"  execution failed for {item['question']!r}: {e}")
+                    row["accurate"] = False
+        rows.append(row)
+
+    print(f"Full prompt: {len(full_prompt):,} chars over {len(all_columns)} columns\n")
+    print(f"{'question':<60} {'cols':>5} {'reduction':>10} {'recall':>7}" + (f" {'accurate':>9}" if args.llm else ""))
+    for row in rows:
+        line = f"{row['question'][:60]:<60} {row['columns']:>5} {row['reduction']:>10.1%} {row['recall']:>7.0%}"
+        if args.llm:
+            line += f" {'yes' if row['accurate'] else 'no':>9}"
+        print(line)
+
+    print(f"\nmean reduction {statistics.mean(row['reduction'] for row in rows):.1%}, "
+          f"mean recall {statistics.mean(row['recall'] for row in rows):.1%}, "
+          f"full recall on {sum(row['recall'] == 1 for row in rows)}/{len(rows)} questions")
+    if args.llm:
+        print(f"SQL accuracy {sum(row['accurate'] for row in rows)}/{len(rows)}")
+
+
+if __name__ == "__main__":
+    main()
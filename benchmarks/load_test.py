@@ -0,0 +1,375 @@
+"""Drive concurrent simulated analyst sessions through the app and report where it saturates.
+
+Each session is a streamlit.testing AppTest running the real app script in
+this process, against the stand-ins from benchmarks/standins.py (DuckDB
+with synthetic events, fake OpenAI client), so sessions share caches,
+connection pool and CPU the way they do on one Streamlit server. A session
+repeats a typical flow: open the app, ask a question, preview, execute,
+show column stats, switch to the chart and back, prepare an export and
+search the history, with --think-ms between interactions.
+
+For every concurrency level in --sessions it reports interactions per
+second, interaction latency, CPU time per rerun and process CPU use. CPU
+time per rerun is broken down by render function from the app's trace
+spans. The saturation point is the first level where adding sessions no
+longer adds throughput. --profile additionally writes a cProfile of every
+rerun (viewable with snakeviz or pstats).
+
+Finally one more session prepares the export of a large result and reruns
+the app; the run fails if the export panel takes more than
+--max-export-rerun-ms at p95 on those reruns, i.e. if the prepared file is
+read again on reruns that didn't ask for it.
+
+Usage:
+    python benchmarks/load_test.py --sessions 1 5 10 20 30 --flows 2
+    python benchmarks/load_test.py --sessions 10 --profile rerun.prof
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["QUERY_STUDIO_CACHE_DIR"] = tempfile.mkdtemp(prefix="load_test_")
+
+from streamlit.runtime import Runtime  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+from streamlit.testing.v1 import app_test  # noqa: E402
+from streamlit.testing.v1.util import patch_config_options  # noqa: E402
+
+import app  # noqa: E402
+import standins  # noqa: E402
+from query_studio import config  # noqa: E402
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pipeline_questions.jsonl")
+# The app script as a session runs it; `app` is the module already set up with the stand-ins
+APP_SCRIPT = "import app\napp.main()\n"
+FLOW = ["open", "generate", "preview", "execute", "stats", "chart", "table", "export", "history_search"]
+# Throughput has saturated when a level adds less than this over the previous one
+SATURATION_GAIN = 1.10
+EXPORT_CHECK_QUESTION = "Export check: every event of the last 30 days"
+EXPORT_CHECK_RERUNS = 5
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+class TraceCollector:
+    """Collects the trace of every rerun, tagged with the session that ran it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.traces = []
+        self._remember_trace = app.remember_trace
+
+    def install(self):
+        def remember_trace(trace):
+            with self._lock:
+                self.traces.append({"session": app.st.session_state.get("session_key"), **trace.to_dict()})
+            self._remember_trace(trace)
+        app.remember_trace = remember_trace
+
+    def take(self) -> list:
+        with self._lock:
+            traces, self.traces = self.traces, []
+        return traces
+
+
+class RerunProfiler:
+    """cProfile of every rerun, merged across sessions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = None
+        self._main = app.main
+
+    def install(self):
+        def main():
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                self._main()
+            finally:
+                profile.disable()
+                with self._lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+        app.main = main
+
+
+def share_server_state():
+    """Let AppTests run concurrently, as sessions do on one server.
+
+    Each AppTest run installs its own mock Runtime singleton and test-mode
+    config patch and removes them when done, which pulls both out from
+    under sessions still running. Keep serving the most recent runtime
+    (they are equivalent) and patch the config once for the whole test.
+    """
+    app_test.patch_config_options = lambda overrides: nullcontext()
+    latest = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest["runtime"] = cls._instance
+        if "runtime" not in latest:
+            raise RuntimeError("Runtime hasn't been created!")
+        return latest["runtime"]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in latest)
+
+
+def find(elements, label_prefix: str):
+    return next((element for element in elements if element.label.startswith(label_prefix)), None)
+
+
+def find_key(elements, key: str):
+    return next((element for element in elements if element.key == key), None)
+
+
+def interact(at: AppTest, step: str, question: str) -> bool:
+    """Perform one flow step on the session's current page; False if its control isn't there."""
+    if step == "generate":
+        button = find(at.button, "Generate Query")
+        if button is None:
+            return False
+        at.text_area(key="question_input").input(question)
+        button.click()
+    elif step in ("preview", "execute", "export"):
+        button = find(at.button, {"preview": "Preview (", "execute": "Execute", "export": "Prepare "}[step])
+        if button is None:
+            return False
+        button.click()
+    elif step == "stats":
+        toggle = find_key(at.toggle, "show_column_stats")
+        if toggle is None:
+            return False
+        toggle.set_value(not toggle.value)
+    elif step in ("chart", "table"):
+        radio = find(at.radio, "View")
+        if radio is None:
+            return False
+        radio.set_value(step.capitalize())
+    elif step == "history_search":
+        search = find_key(at.text_input, "history_search")
+        if search is None:
+            return False
+        search.input(random.choice(["users", "device", "plays", ""]))
+    return True
+
+
+def run_session(index: int, questions: list, flows: int, think_seconds: float, async_execution: bool,
+                timeout: float) -> dict:
+    """Run one simulated analyst; returns interaction latencies and error counts."""
+    rng = random.Random(index)
+    at = AppTest.from_string(APP_SCRIPT, default_timeout=timeout)
+    at.session_state["async_execution"] = async_execution
+    latencies, skipped, errors = [], {}, 0
+    for _ in range(flows):
+        question = rng.choice(questions)["question"]
+        for step in FLOW:
+            if step != "open" and not interact(at, step, question):
+                skipped[step] = skipped.get(step, 0) + 1
+                continue
+            started = time.perf_counter()
+            at.run()
+            latencies.append(time.perf_counter() - started)
+            errors += len(at.exception)
+            time.sleep(think_seconds * rng.uniform(0.5, 1.5))
+    return {"latencies": latencies, "skipped": skipped, "errors": errors}
+
+
+def process_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_level(sessions: int, args, questions: list, collector: TraceCollector) -> dict:
+    collector.take()
+    cpu_started, started = process_cpu_seconds(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = list(executor.map(
+            lambda index: run_session(index, questions, args.flows, args.think_ms / 1000, args.async_execution,
+                                      args.timeout),
+            range(sessions)
+        ))
+    wall_seconds = time.perf_counter() - started
+    cpu_seconds = process_cpu_seconds() - cpu_started
+    traces = collector.take()
+    latencies = [latency for result in results for latency in result["latencies"]]
+    return {
+        "sessions": sessions,
+        "interactions": len(latencies),
+        "interactions_per_s": len(latencies) / wall_seconds,
+        "reruns": len(traces),
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "rerun_cpu_ms": sum(trace["cpu"] for trace in traces) / len(traces) * 1000 if traces else 0.0,
+        "process_cpu_pct": cpu_seconds / wall_seconds * 100,
+        "skipped": {step: sum(result["skipped"].get(step, 0) for result in results)
+                    for step in FLOW if any(step in result["skipped"] for result in results)},
+        "errors": sum(result["errors"] for result in results),
+        "breakdown": render_breakdown(traces),
+    }
+
+
+def export_check_question(rows: int) -> dict:
+    return {"question": EXPORT_CHECK_QUESTION,
+            "sql": f"SELECT *\nFROM {config.TABLE_NAME}\nWHERE date >= DATEADD(day, -30, CURRENT_DATE())\nLIMIT {rows}"}
+
+
+def check_export_reruns(args, collector: TraceCollector) -> dict:
+    """Export panel wall time on plain reruns after a large export was prepared."""
+    at = AppTest.from_string(APP_SCRIPT, default_timeout=args.timeout)
+    at.session_state["async_execution"] = False
+    at.run()
+    for step in ("generate", "execute", "export"):
+        if not interact(at, step, EXPORT_CHECK_QUESTION):
+            raise RuntimeError(f"Export check: no control for {step}")
+        at.run()
+    collector.take()
+    for _ in range(EXPORT_CHECK_RERUNS):
+        at.run()
+    durations = [span["duration"] for trace in collector.take() for span in trace["spans"]
+                 if span["name"] == "render_export_options"]
+    return {"rows": args.rows, "reruns": len(durations), "p50_ms": percentile(durations, 0.50) * 1000,
+            "p95_ms": percentile(durations, 0.95) * 1000, "errors": len(at.exception)}
+
+
+def render_breakdown(traces: list) -> list:
+    """CPU per rerun by top-level span (render functions and pipeline stages), plus the rest."""
+    by_name = {}
+    rerun_cpu = sum(trace["cpu"] for trace in traces)
+    for trace in traces:
+        accounted = 0.0
+        for span in trace["spans"]:
+            if span["parent_id"] is None:
+                by_name.setdefault(span["name"], {"cpu": [], "wall": []})
+                by_name[span["name"]]["cpu"].append(span["cpu"])
+                by_name[span["name"]]["wall"].append(span["duration"])
+                accounted += span["cpu"]
+        by_name.setdefault("(streamlit + rest of script)", {"cpu": [], "wall": []})
+        by_name["(streamlit + rest of script)"]["cpu"].append(max(trace["cpu"] - accounted, 0.0))
+    rows = [
+        {
+            "name": name,
+            "calls": len(values["cpu"]),
+            "cpu_mean_ms": sum(values["cpu"]) / len(values["cpu"]) * 1000,
+            "cpu_p95_ms": percentile(values["cpu"], 0.95) * 1000,
+            "wall_mean_ms": sum(values["wall"]) / len(values["wall"]) * 1000 if values["wall"] else None,
+            "cpu_share_pct": sum(values["cpu"]) / rerun_cpu * 100 if rerun_cpu else 0.0,
+        }
+        for name, values in by_name.items()
+    ]
+    return sorted(rows, key=lambda row: row["cpu_share_pct"], reverse=True)
+
+
+def saturation_point(levels: list) -> dict:
+    """First level that adds less than SATURATION_GAIN throughput over the previous one."""
+    for previous, level in zip(levels, levels[1:]):
+        if level["interactions_per_s"] < previous["interactions_per_s"] * SATURATION_GAIN:
+            return {"saturated": True, "sessions": previous["sessions"], "interactions_per_s": previous["interactions_per_s"],
+                    "latency_p95_ms": previous["latency_p95_ms"]}
+    last = levels[-1]
+    return {"saturated": False, "sessions": last["sessions"], "interactions_per_s": last["interactions_per_s"],
+            "latency_p95_ms": last["latency_p95_ms"]}
+
+
+def print_report(levels: list, saturation: dict):
+    print(f"{'sessions':>8} {'interact':>9} {'per s':>7} {'p50 ms':>8} {'p95 ms':>8} {'reruns':>7} "
+          f"{'CPU/rerun ms':>13} {'proc CPU %':>11} {'errors':>7}  skipped")
+    for level in levels:
+        print(f"{level['sessions']:>8} {level['interactions']:>9} {level['interactions_per_s']:>7.1f} "
+              f"{level['latency_p50_ms']:>8.0f} {level['latency_p95_ms']:>8.0f} {level['reruns']:>7} "
+              f"{level['rerun_cpu_ms']:>13.1f} {level['process_cpu_pct']:>11.0f} {level['errors']:>7}  "
+              f"{', '.join(f'{step} x{count}' for step, count in level['skipped'].items()) or '-'}")
+
+    busiest = levels[-1]
+    print(f"\nCPU per rerun by function at {busiest['sessions']} sessions:")
+    print(f"{'function':<32} {'calls':>6} {'CPU ms':>8} {'p95 ms':>8} {'wall ms':>8} {'share':>7}")
+    for row in busiest["breakdown"]:
+        wall = f"{row['wall_mean_ms']:>8.1f}" if row["wall_mean_ms"] is not None else f"{'-':>8}"
+        print(f"{row['name'][:32]:<32} {row['calls']:>6} {row['cpu_mean_ms']:>8.2f} {row['cpu_p95_ms']:>8.2f} "
+              f"{wall} {row['cpu_share_pct']:>6.1f}%")
+
+    if saturation["saturated"]:
+        print(f"\nThroughput stops scaling past {saturation['sessions']} sessions: "
+              f"{saturation['interactions_per_s']:.1f} interactions/s at p95 {saturation['latency_p95_ms']:.0f} ms")
+    else:
+        print(f"\nNo saturation up to {saturation['sessions']} sessions "
+              f"({saturation['interactions_per_s']:.1f} interactions/s); try more sessions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10, 20, 30], help="Concurrency levels")
+    parser.add_argument("--flows", type=int, default=2, help="Times each session repeats the flow")
+    parser.add_argument("--think-ms", type=float, default=200.0, help="Mean pause between interactions")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="JSONL of {question, sql}")
+    parser.add_argument("--rows", type=int, default=200_000, help="Rows in the synthetic events table")
+    parser.add_argument("--db-latency-ms", type=float, default=20.0, help="Added to every Snowflake statement")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="Time to the first token")
+    parser.add_argument("--async-execution", action="store_true",
+                        help="Run queries in the background as the app does by default; AppTest doesn't run "
+                             "the timed polling fragment, so results arrive with a later interaction")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds allowed per interaction")
+    parser.add_argument("--max-export-rerun-ms", type=float, default=20.0,
+                        help="Fail if the export panel's p95 on reruns after a large export exceeds this")
+    parser.add_argument("--profile", help="Write a merged cProfile of all reruns to this file")
+    parser.add_argument("--output", help="Write the full report as JSON")
+    args = parser.parse_args()
+
+    questions = standins.load_questions(args.questions)
+    standins.install_standins(questions + [export_check_question(args.rows)], rows=args.rows, db_latency_seconds=args.db_latency_ms / 1000,
+                              llm_latency_seconds=args.llm_latency_ms / 1000)
+    share_server_state()
+    collector = TraceCollector()
+    collector.install()
+    profiler = RerunProfiler() if args.profile else None
+    if profiler:
+        profiler.install()
+
+    levels = []
+    with patch_config_options({"global.appTest": True}):
+        for sessions in args.sessions:
+            print(f"Running {sessions} session(s)...", flush=True)
+            levels.append(run_level(sessions, args, questions, collector))
+        print("Checking export reruns...", flush=True)
+        export_check = check_export_reruns(args, collector)
+    saturation = saturation_point(levels)
+    print()
+    print_report(levels, saturation)
+    print(f"\nExport panel on reruns after exporting {export_check['rows']:,} rows: "
+          f"p50 {export_check['p50_ms']:.1f} ms, p95 {export_check['p95_ms']:.1f} ms "
+          f"over {export_check['reruns']} reruns ({export_check['errors']} errors)")
+
+    if profiler and profiler.stats is not None:
+        profiler.stats.dump_stats(args.profile)
+        print(f"\nTop app functions by cumulative time (full profile in {args.profile}):")
+        profiler.stats.sort_stats("cumulative").print_stats(r"app\.py", 20)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"levels": levels, "saturation": saturation, "export_check": export_check}, f, indent=2)
+    if export_check["p95_ms"] > args.max_export_rerun_ms:
+        print(f"FAIL: export panel p95 is over {args.max_export_rerun_ms:.0f} ms on reruns; "
+              f"is the prepared file read on every rerun?")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""Local stand-ins for Snowflake and OpenAI, for benchmarks and load tests.
+
+FakeSnowflake holds a DuckDB database with a synthetic
+combined_events_enriched table (columns and value sets taken from
+config.IMPORTANT_COLUMNS) and hands out connections implementing the part of
+the Snowflake connector API the app uses: execute/execute_async, Arrow
+batches, results by query ID, RESULT_SCAN, DESCRIBE TABLE and EXPLAIN USING
+JSON. Snowflake SQL is translated to DuckDB with sqlglot. Errors are raised
+as snowflake.connector errors so the app handles them as it would live.
+
+FakeOpenAI answers chat completions (plain or streamed) deterministically
+from a question -> SQL mapping, with configurable latency and throughput.
+
+install_standins() points the query_studio modules at both; nothing in the
+app is changed, the pool's connect factory and get_openai_client are simply
+replaced.
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import snowflake.connector
+import sqlglot
+from snowflake.connector.connection import SnowflakeConnection
+from snowflake.connector.constants import QueryStatus
+from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+
+from query_studio import config, db, generation
+
+# Rough on-disk size of one events row, for the EXPLAIN byte estimates
+BYTES_PER_ROW = 120
+ARROW_BATCH_ROWS = 65_536
+
+_RESULT_SCAN_PATTERN = re.compile(r"TABLE\s*\(\s*RESULT_SCAN\s*\(\s*'([^']+)'\s*\)\s*\)", re.IGNORECASE)
+_EXPLAIN_PATTERN = re.compile(r"^\s*EXPLAIN\s+USING\s+JSON\s+", re.IGNORECASE)
+_DESCRIBE_PATTERN = re.compile(r"^\s*DESC(RIBE)?\s+TABLE\s+(\S+)", re.IGNORECASE)
+_CANCEL_PATTERN = re.compile(r"SYSTEM\$CANCEL_QUERY", re.IGNORECASE)
+
+
+def column_values(spec: dict) -> list:
+    """Value set of a categorical column from its IMPORTANT_COLUMNS entry."""
+    values = [value.strip() for value in (spec.get("values") or "").split(",")]
+    return [value for value in values if value and not value.startswith("etc")]
+
+
+def synthetic_events(columns: dict, rows: int, days: int, seed: int = 0) -> pa.Table:
+    """Synthetic combined_events_enriched rows over the last `days` closed days.
+
+    Column names are upper-cased, as Snowflake stores unquoted identifiers.
+    """
+    rng = np.random.default_rng(seed)
+    first_day = np.datetime64(date.today() - timedelta(days=days), "D")
+    day_offsets = rng.integers(0, days, rows)
+    data = {}
+    for name, spec in columns.items():
+        column_type = spec["type"].upper()
+        values = column_values(spec)
+        if column_type == "DATE":
+            data[name] = pa.array(first_day + day_offsets)
+        elif column_type.startswith("TIMESTAMP"):
+            seconds = day_offsets * 86_400 + rng.integers(0, 86_400, rows)
+            data[name] = pa.array(first_day.astype("datetime64[s]") + seconds)
+        elif name == "visit_first_event":
+            data[name] = pa.array(np.where(rng.random(rows) < 0.1, 1, 0), mask=rng.random(rows) >= 0.1)
+        elif column_type == "NUMBER":
+            data[name] = pa.array(rng.integers(0, max(rows // 10, 1), rows))
+        elif values:
+            # Skewed towards the first values, like real traffic
+            weights = 1.0 / np.arange(1, len(values) + 1)
+            picks = rng.choice(len(values), rows, p=weights / weights.sum())
+            data[name] = pa.DictionaryArray.from_arrays(pa.array(picks.astype(np.int32)), values).cast(pa.string())
+        else:
+            ids = rng.integers(0, max(rows // 20, 1), rows)
+            data[name] = pa.array(np.char.add(f"{name[:1]}", ids.astype(str)))
+    return pa.table({name.upper(): values for name, values in data.items()})
+
+
+class FakeSnowflake:
+    """A DuckDB-backed "account": the data, the stored query results and the query statuses.
+
+    latency_seconds is added to every statement, like a network round trip
+    plus compilation in the warehouse.
+    """
+
+    def __init__(self, table_name: str, columns: dict, rows: int = 100_000, days: int = 30,
+                 latency_seconds: float = 0.0, seed: int = 0):
+        self.table_name = table_name
+        self.columns = columns
+        self.rows = rows
+        self.days = days
+        self.latency_seconds = latency_seconds
+        self._db = duckdb.connect(":memory:")
+        self._lock = threading.Lock()
+        self._results = {}
+        self._status = {}
+        self._errors = {}
+        self.counters = {"connects": 0, "statements": 0}
+
+        catalog, schema, table = table_name.split(".")
+        self._db.execute(f"ATTACH ':memory:' AS {catalog}")
+        self._db.execute(f"CREATE SCHEMA {catalog}.{schema}")
+        events = synthetic_events(columns, rows, days, seed)
+        self._db.register("synthetic_events", events)
+        self._db.execute(f"CREATE TABLE {table_name} AS SELECT * FROM synthetic_events")
+        self._db.unregister("synthetic_events")
+
+    def connect(self) -> "FakeSnowflakeConnection":
+        """Connect factory for db.SnowflakeConnectionPool."""
+        with self._lock:
+            self.counters["connects"] += 1
+        return FakeSnowflakeConnection(self)
+
+    # Query bookkeeping shared by all connections
+
+    def store_result(self, query_id: str, table: pa.Table):
+        with self._lock:
+            self._results[query_id] = table
+            self._status[query_id] = QueryStatus.SUCCESS
+
+    def store_error(self, query_id: str, error: Exception):
+        with self._lock:
+            self._errors[query_id] = error
+            self._status[query_id] = QueryStatus.FAILED_WITH_ERROR
+
+    def result(self, query_id: str) -> pa.Table:
+        with self._lock:
+            if query_id in self._errors:
+                raise self._errors[query_id]
+            if query_id not in self._results:
+                raise snowflake.connector.ProgrammingError(f"Result for query {query_id} not found")
+            return self._results[query_id]
+
+    def status(self, query_id: str) -> QueryStatus:
+        with self._lock:
+            return self._status.get(query_id, QueryStatus.NO_DATA)
+
+    def cancel(self, query_id: str):
+        with self._lock:
+            if self._status.get(query_id) == QueryStatus.RUNNING:
+                self._status[query_id] = QueryStatus.ABORTED
+                self._errors[query_id] = snowflake.connector.ProgrammingError("SQL execution canceled")
+
+    # Statement execution
+
+    def run(self, db, sql: str) -> pa.Table:
+        """Run one Snowflake statement against DuckDB and return its result as Arrow."""
+        with self._lock:
+            self.counters["statements"] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+        described = _DESCRIBE_PATTERN.match(sql)
+        if described:
+            return self.describe(described.group(2))
+        if _EXPLAIN_PATTERN.match(sql):
+            return self.explain(db, _EXPLAIN_PATTERN.sub("", sql, count=1))
+        if _CANCEL_PATTERN.search(sql):
+            for query_id in re.findall(r"'([^']+)'", sql):
+                self.cancel(query_id)
+            return pa.table({"SYSTEM$CANCEL_QUERY": ["query cancelled"]})
+
+        sql = self.attach_result_scans(db, sql)
+        try:
+            result = db.execute(to_duckdb(sql))
+            return result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()
+        except (sqlglot.errors.SqlglotError, duckdb.Error) as e:
+            raise snowflake.connector.ProgrammingError(f"SQL compilation error: {e}") from e
+
+    def attach_result_scans(self, db, sql: str) -> str:
+        """Replace TABLE(RESULT_SCAN('<id>')) with the stored result registered as a view."""
+        def replace(match):
+            query_id = match.group(1)
+            view = f"result_{query_id.replace('-', '_')}"
+            db.register(view, self.result(query_id))
+            return view
+        return _RESULT_SCAN_PATTERN.sub(replace, sql)
+
+    def describe(self, table_name: str) -> pa.Table:
+        if table_name.lower() != self.table_name.lower():
+            raise snowflake.connector.ProgrammingError(f"Table '{table_name}' does not exist or not authorized.")
+        return pa.table({
+            "name": [name.upper() for name in self.columns],
+            "type": [spec["type"] for spec in self.columns.values()],
+            "kind": ["COLUMN"] * len(self.columns),
+        })
+
+    def explain(self, db, sql: str) -> pa.Table:
+        """EXPLAIN USING JSON: compiles the query and reports the whole table as assigned."""
+        try:
+            db.execute("EXPLAIN " + to_duckdb(sql))
+        except (sqlglot.errors.SqlglotError, duckdb.Error) as e:
+            raise snowflake.connector.ProgrammingError(f"SQL compilation error: {e}") from e
+        plan = {"GlobalStats": {
+            "partitionsTotal": self.days,
+            "partitionsAssigned": self.days,
+            "bytesAssigned": self.rows * BYTES_PER_ROW,
+        }}
+        return pa.table({"content": [json.dumps(plan)]})
+
+
+def to_duckdb(sql: str) -> str:
+    """Translate one Snowflake statement to DuckDB.
+
+    Unquoted identifiers are upper-cased first, so result columns get the
+    names Snowflake would give them (DuckDB keeps aliases as written).
+    """
+    expression = normalize_identifiers(sqlglot.parse_one(sql, read="snowflake"), dialect="snowflake")
+    return expression.sql(dialect="duckdb")
+
+
+class FakeSnowflakeConnection:
+    """Connection with its own DuckDB cursor on the shared FakeSnowflake database."""
+
+    is_still_running = staticmethod(SnowflakeConnection.is_still_running)
+    is_an_error = staticmethod(SnowflakeConnection.is_an_error)
+
+    def __init__(self, account: FakeSnowflake):
+        self.account = account
+        self._db = account._db.cursor()
+        self._closed = False
+
+    def cursor(self) -> "FakeSnowflakeCursor":
+        return FakeSnowflakeCursor(self)
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        self._db.close()
+
+    def get_query_status(self, query_id: str) -> QueryStatus:
+        return self.account.status(query_id)
+
+    def get_query_status_throw_if_error(self, query_id: str) -> QueryStatus:
+        status = self.account.status(query_id)
+        if self.is_an_error(status):
+            self.account.result(query_id)
+        return status
+
+
+class FakeResultBatch:
+    """A downloadable chunk of a result; like ResultBatch it is read without a connection."""
+
+    def __init__(self, table: pa.Table):
+        self._table = table
+
+    def to_arrow(self, connection=None) -> pa.Table:
+        return self._table
+
+
+class FakeSnowflakeCursor:
+    """The subset of SnowflakeCursor the app uses, backed by an Arrow result table."""
+
+    def __init__(self, connection: FakeSnowflakeConnection):
+        self.connection = connection
+        self.sfqid = None
+        self._table = None
+        self._position = 0
+
+    @property
+    def description(self):
+        if self._table is None:
+            return None
+        return [(name, None, None, None, None, None, True) for name in self._table.column_names]
+
+    @property
+    def rowcount(self):
+        return self._table.num_rows if self._table is not None else -1
+
+    def execute(self, sql: str, params=None):
+        if params:
+            sql = sql.replace("%s", "{}").format(*(f"'{param}'" for param in params))
+        self.sfqid = uuid.uuid4().hex
+        account = self.connection.account
+        if "INFORMATION_SCHEMA.QUERY_HISTORY" in sql.upper():
+            raise snowflake.connector.ProgrammingError("QUERY_HISTORY is not available in the stand-in")
+        try:
+            table = account.run(self.connection._db, sql)
+        except snowflake.connector.Error as e:
+            account.store_error(self.sfqid, e)
+            raise
+        account.store_result(self.sfqid, table)
+        self._set_result(table)
+        return self
+
+    def execute_async(self, sql: str, params=None):
+        """Start the statement on a background thread; poll with get_query_status."""
+        query_id = uuid.uuid4().hex
+        account = self.connection.account
+        with account._lock:
+            account._status[query_id] = QueryStatus.RUNNING
+        db = self.connection.account._db.cursor()
+
+        def run():
+            try:
+                table = account.run(db, sql)
+                if account.status(query_id) == QueryStatus.RUNNING:
+                    account.store_result(query_id, table)
+            except snowflake.connector.Error as e:
+                account.store_error(query_id, e)
+            finally:
+                db.close()
+
+        threading.Thread(target=run, name=f"fake-query-{query_id[:8]}", daemon=True).start()
+        self.sfqid = query_id
+        return {"queryId": query_id}
+
+    def get_results_from_sfqid(self, query_id: str):
+        while self.connection.account.status(query_id) == QueryStatus.RUNNING:
+            time.sleep(0.01)
+        self.sfqid = query_id
+        self._set_result(self.connection.account.result(query_id))
+
+    def _set_result(self, table: pa.Table):
+        self._table = table
+        self._position = 0
+
+    def fetch_arrow_batches(self):
+        for batch in self._table.to_batches(max_chunksize=ARROW_BATCH_ROWS):
+            yield pa.Table.from_batches([batch])
+
+    def get_result_batches(self) -> list:
+        return [FakeResultBatch(pa.Table.from_batches([batch]))
+                for batch in self._table.to_batches(max_chunksize=ARROW_BATCH_ROWS)]
+
+    def fetchmany(self, size: int) -> list:
+        rows = self._table.slice(self._position, size)
+        self._position += rows.num_rows
+        return list(zip(*[column.to_pylist() for column in rows.columns])) if rows.num_rows else []
+
+    def fetchall(self) -> list:
+        return self.fetchmany(self._table.num_rows - self._position)
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        self._table = None
+
+
+class FakeOpenAI:
+    """Deterministic chat completions client.
+
+    The generated SQL is looked up by question in sql_by_question (falling
+    back to default_sql). A response takes latency_seconds before the first
+    token and then streams at tokens_per_second. Repeated system prompts are
+    reported as cached prompt tokens, like OpenAI prompt caching.
+    """
+
+    def __init__(self, sql_by_question: dict, default_sql: str, latency_seconds: float = 0.3,
+                 tokens_per_second: float = 200.0):
+        self.sql_by_question = sql_by_question
+        self.default_sql = default_sql
+        self.latency_seconds = latency_seconds
+        self.tokens_per_second = tokens_per_second
+        self._seen_prompts = set()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model: str, messages: list, stream: bool = False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            system_prompt = messages[0]["content"]
+            cached = system_prompt in self._seen_prompts
+            self._seen_prompts.add(system_prompt)
+        question = messages[-1]["content"].rsplit("Question:", 1)[-1].strip()
+        sql = self.sql_by_question.get(question, self.default_sql)
+        content = json.dumps({"sql": sql, "explanation": f"Answers: {question}"})
+
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(content) // 4,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=len(system_prompt) // 4 if cached else 0),
+        )
+        tokens = [content[i:i + 4] for i in range(0, len(content), 4)]
+        if stream:
+            return self._stream(tokens, usage)
+        time.sleep(self.latency_seconds + len(tokens) / self.tokens_per_second)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def _stream(self, tokens: list, usage):
+        time.sleep(self.latency_seconds)
+        for token in tokens:
+            time.sleep(1 / self.tokens_per_second)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+
+def load_questions(path: str) -> list:
+    """{"question", "sql"} items from a JSONL fixture."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def install_standins(questions: list, rows: int = 100_000, days: int = 30,
+                     db_latency_seconds: float = 0.0, llm_latency_seconds: float = 0.3,
+                     llm_tokens_per_second: float = 200.0, seed: int = 0) -> dict:
+    """Point the app at a FakeSnowflake and a FakeOpenAI built for the given questions."""
+    snowflake_account = FakeSnowflake(config.TABLE_NAME, config.IMPORTANT_COLUMNS, rows=rows, days=days,
+                                      latency_seconds=db_latency_seconds, seed=seed)
+    openai_client = FakeOpenAI({item["question"]: item["sql"] for item in questions}, questions[0]["sql"],
+                               latency_seconds=llm_latency_seconds, tokens_per_second=llm_tokens_per_second)
+    db.create_snowflake_connection = snowflake_account.connect
+    db.get_connection_pool.cache_clear()
+    pool = db.get_connection_pool()
+    generation.get_openai_client = lambda: openai_client
+    return {"snowflake": snowflake_account, "openai": openai_client, "pool": pool}
@@ -0,0 +1,160 @@
+"""Run many natural language questions (or SQL queries) without the UI.
+
+Each item goes through the same pipeline as the app: SQL generation,
+safety validation, cost check and execution. Items run concurrently on a
+bounded worker pool; results are written to one file per item, followed
+by a timing report. Uses the same secrets as the app.
+
+Input formats:
+    questions.txt    one question per line (blank lines and # comments skipped)
+    queries.sql      SQL statements separated by semicolons
+    items.jsonl      {"name": ..., "question": ...} or {"name": ..., "sql": ...} per line
+
+Usage:
+    python cli.py questions.txt --output-dir results --format parquet --workers 4
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlglot
+from sqlglot.tokens import TokenType
+
+from query_studio import config, db, exports, pipeline
+
+OUTPUT_FORMATS = {"parquet": "Parquet", "arrow": "Arrow", "csv": "CSV", "json": "JSON"}
+
+
+def split_sql_statements(text: str) -> list:
+    """Split SQL text on top-level semicolons, keeping each statement as written.
+    
+    Semicolons in literals and comments don't split. Text that can't be
+    tokenized (e.g. an unterminated quote) is split on semicolons that end a
+    line instead; a broken statement then fails on its own when it runs.
+    """
+    try:
+        tokens = sqlglot.tokenize(text, read="snowflake")
+    except sqlglot.errors.TokenError:
+        pieces = re.split(r";[ \t]*(?:\n|$)", text)
+        return [piece.strip() for piece in pieces if piece.strip()]
+    
+    statements, start, has_tokens = [], 0, False
+    for token in tokens:
+        if token.token_type == TokenType.SEMICOLON:
+            if has_tokens:
+                statements.append(text[start:token.start].strip())
+            start, has_tokens = token.end + 1, False
+        else:
+            has_tokens = True
+    if has_tokens:
+        statements.append(text[start:].strip())
+    return statements
+
+
+def load_items(path: str, as_sql: bool) -> list:
+    """Read the input file into a list of {"name", "question" | "sql"} items."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+
+    if path.endswith(".jsonl"):
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    elif path.endswith(".sql"):
+        items = [{"sql": statement} for statement in split_sql_statements(text)]
+    else:
+        lines = [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith("#")]
+        items = [{"sql": line} if as_sql else {"question": line} for line in lines]
+
+    for i, item in enumerate(items, start=1):
+        item.setdefault("name", f"{i:03d}")
+        if not item.get("question") and not item.get("sql"):
+            raise ValueError(f"Item {item['name']} has neither a question nor SQL")
+    return items
+
+
+def run_item(item: dict, all_columns: list, limit: int, output_dir: str, output_format: str, use_rollups: bool,
+             approximate: bool) -> dict:
+    started = time.perf_counter()
+    df, report = pipeline.run_pipeline(all_columns, limit, question=item.get("question"), sql=item.get("sql"),
+                                       use_rollups=use_rollups, approximate=approximate)
+    report["name"] = item["name"]
+
+    if df is not None:
+        export_format = OUTPUT_FORMATS[output_format]
+        path = os.path.join(output_dir, f"{item['name']}.{exports.EXPORT_FORMATS[export_format]['extension']}")
+        write_started = time.perf_counter()
+        try:
+            exports.write_export(db.iter_result_batches(df, report["meta"]), export_format, path)
+            report["output"] = path
+        except Exception as e:
+            report.update(status="error", error=f"Writing results failed: {e}")
+        report["timings"]["write"] = time.perf_counter() - write_started
+
+    report["timings"]["total"] = time.perf_counter() - started
+    return report
+
+
+def print_report(reports: list, wall_seconds: float):
+    stages = ["generate", "validate", "estimate", "execute", "write", "total"]
+    print(f"{'name':<20} {'status':<8} " + " ".join(f"{stage:>9}" for stage in stages) + f" {'rows':>10}")
+    for report in reports:
+        timings = " ".join(
+            f"{report['timings'][stage]:>9.2f}" if stage in report["timings"] else f"{'-':>9}" for stage in stages
+        )
+        rows = report["meta"].get("total_rows")
+        print(f"{report['name'][:20]:<20} {report['status']:<8} {timings} {rows if rows is not None else '-':>10}")
+        if report["error"]:
+            print(f"{'':<20} {report['error']}")
+
+    ok = sum(report["status"] == "ok" for report in reports)
+    busy = sum(report["timings"]["total"] for report in reports)
+    print(f"\n{ok}/{len(reports)} succeeded in {wall_seconds:.1f}s wall time "
+          f"({busy:.1f}s of pipeline time, {busy / wall_seconds if wall_seconds else 0:.1f}x concurrency)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="File of questions (.txt), SQL (.sql) or items (.jsonl)")
+    parser.add_argument("--sql", action="store_true", help="Treat lines of a .txt input as SQL instead of questions")
+    parser.add_argument("--output-dir", default="results")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="parquet")
+    parser.add_argument("--workers", type=int, default=4, help="Questions processed concurrently")
+    parser.add_argument("--limit", type=int, default=config.DEFAULT_LIMIT, help="Row limit for generated SQL")
+    parser.add_argument("--no-rollups", action="store_true", help="Always query the raw events table")
+    parser.add_argument("--approximate", action="store_true",
+                        help="Let rollups answer COUNT(DISTINCT) with HyperLogLog estimates")
+    args = parser.parse_args()
+
+    items = load_items(args.input, args.sql)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        all_columns = db.get_all_columns()
+    except Exception as e:
+        print(f"Error fetching columns: {e}", file=sys.stderr)
+        all_columns = []
+    if not all_columns and any(item.get("question") for item in items):
+        sys.exit("Could not fetch table schema. Please check your Snowflake connection.")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        reports = list(executor.map(
+            lambda item: run_item(item, all_columns, args.limit, args.output_dir, args.format, not args.no_rollups,
+                                  args.approximate),
+            items
+        ))
+    wall_seconds = time.perf_counter() - started
+
+    print_report(reports, wall_seconds)
+    with open(os.path.join(args.output_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2, default=str)
+
+    if any(report["status"] != "ok" for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
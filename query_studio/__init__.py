@@ -0,0 +1,5 @@
+"""The non-UI parts of Query Studio, importable without Streamlit.
+
+app.py is the Streamlit UI on top of these modules; cli.py and
+refresh_rollups.py use them directly.
+"""
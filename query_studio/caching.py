@@ -0,0 +1,440 @@
+"""Caches: generated SQL per question, query results with date-aware TTLs, and a memo decorator."""
+
+import hashlib
+import inspect
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import suppress
+from datetime import date, timedelta
+from functools import lru_cache, wraps
+from typing import Optional, Tuple
+
+import pandas as pd
+
+from .config import (
+    APPROXIMATE_DISTINCT_DEFAULT, CACHE_DIR, INCREMENTAL_PARTIAL_CACHE_MAX_DISK_BYTES,
+    INCREMENTAL_PARTIAL_CACHE_MAX_MEMORY_BYTES, LATE_DATA_DAYS, QUERY_RESULT_RETENTION_SECONDS,
+    RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS, RESULT_CACHE_MAX_DISK_BYTES, RESULT_CACHE_MAX_MEMORY_BYTES,
+    RESULT_CACHE_OPEN_DAYS_TTL_SECONDS, RESULT_CACHE_SPILL_BYTES, RESULT_CACHE_SWEEP_INTERVAL_SECONDS,
+    SQL_CACHE_MAX_ENTRIES, SQL_CACHE_SIMILARITY_THRESHOLD, SQL_CACHE_TTL_SECONDS,
+)
+from .sql_analysis import analyze_sql
+
+
+def memoize(ttl: Optional[float] = None, max_entries: Optional[int] = None):
+    """Process-wide memo of a function's results, like st.cache_data but usable without Streamlit.
+    
+    Arguments whose names start with an underscore are left out of the key,
+    so they may be unhashable. Results expire after ttl seconds and the
+    least recently used are dropped past max_entries; exceptions are not
+    cached. Results are shared rather than copied, so callers must not
+    modify them in place.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        entries = OrderedDict()
+        lock = threading.Lock()
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = tuple(value for name, value in bound.arguments.items() if not name.startswith("_"))
+            now = time.monotonic()
+            with lock:
+                entry = entries.get(key)
+                if entry is not None and (ttl is None or now - entry[0] < ttl):
+                    entries.move_to_end(key)
+                    return entry[1]
+            value = func(*args, **kwargs)
+            with lock:
+                entries[key] = (now, value)
+                entries.move_to_end(key)
+                while max_entries is not None and len(entries) > max_entries:
+                    entries.popitem(last=False)
+            return value
+        
+        wrapper.clear = entries.clear
+        return wrapper
+    return decorator
+
+
+_QUESTION_STOPWORDS = frozenset([
+    "a", "an", "the", "of", "for", "in", "on", "at", "to", "from", "by", "with",
+    "is", "are", "was", "were", "be", "do", "does", "did", "what", "whats",
+    "which", "how", "show", "me", "give", "list", "please", "can", "you", "i",
+    "we", "our", "and", "s", "that", "this", "there"
+])
+
+_NEGATION_WORDS = frozenset(["not", "no", "without", "except", "excluding", "non"])
+
+
+def normalize_question(question: str) -> str:
+    """Normalize question text so trivial differences map to the same cache key."""
+    text = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(text.split())
+
+
+def question_terms(normalized_question: str) -> set:
+    """Content terms of a normalized question, used for similarity matching."""
+    terms = set()
+    for word in normalized_question.split():
+        if word in _QUESTION_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.add(word)
+    return terms
+
+
+def question_similarity(terms_a: set, terms_b: set) -> float:
+    """Jaccard similarity of two term sets.
+    
+    Numbers and negations change the meaning of a question, so term sets that
+    disagree on them are never considered similar.
+    """
+    if not terms_a or not terms_b:
+        return 0.0
+    numbers_a = {t for t in terms_a if t.isdigit()}
+    numbers_b = {t for t in terms_b if t.isdigit()}
+    if numbers_a != numbers_b or (terms_a & _NEGATION_WORDS) != (terms_b & _NEGATION_WORDS):
+        return 0.0
+    return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+
+def hash_text(text: str) -> str:
+    """Short stable hash used in cache keys."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class SqlGenerationCache:
+    """Persistent LRU/TTL cache of generated SQL keyed on the question and its context.
+    
+    Entries are scoped by schema key, row limit and the resolved "yesterday"
+    date. Lookups first try the exact normalized question and then fall back
+    to the most similar stored question in the same scope.
+    """
+
+    def __init__(self, path: str, max_entries: int = SQL_CACHE_MAX_ENTRIES,
+                 ttl_seconds: int = SQL_CACHE_TTL_SECONDS,
+                 similarity_threshold: float = SQL_CACHE_SIMILARITY_THRESHOLD):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.counters = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sql_cache (
+                cache_key TEXT PRIMARY KEY,
+                scope_key TEXT NOT NULL,
+                question_norm TEXT NOT NULL,
+                sql TEXT NOT NULL,
+                explanation TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_sql_cache_scope ON sql_cache (scope_key)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_sql_cache_last_used ON sql_cache (last_used_at)")
+        self._db.commit()
+
+    @staticmethod
+    def _scope_key(schema_key: str, limit: int, yesterday: str) -> str:
+        return hash_text(f"{schema_key}|{limit}|{yesterday}")
+
+    def get(self, question: str, schema_key: str, limit: int, yesterday: str) -> Optional[Tuple[str, str]]:
+        """Return a cached (sql, explanation) pair, or None on a miss."""
+        question_norm = normalize_question(question)
+        scope_key = self._scope_key(schema_key, limit, yesterday)
+        min_created_at = time.time() - self.ttl_seconds
+        
+        with self._lock:
+            row = self._db.execute(
+                "SELECT cache_key, sql, explanation FROM sql_cache "
+                "WHERE cache_key = ? AND created_at >= ?",
+                (hash_text(f"{scope_key}|{question_norm}"), min_created_at)
+            ).fetchone()
+            counter = "exact_hits"
+            
+            if row is None:
+                terms = question_terms(question_norm)
+                best_score, row = 0.0, None
+                candidates = self._db.execute(
+                    "SELECT cache_key, sql, explanation, question_norm FROM sql_cache "
+                    "WHERE scope_key = ? AND created_at >= ?",
+                    (scope_key, min_created_at)
+                ).fetchall()
+                for candidate in candidates:
+                    score = question_similarity(terms, question_terms(candidate[3]))
+                    if score >= self.similarity_threshold and score > best_score:
+                        best_score, row = score, candidate
+                counter = "similar_hits"
+            
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            
+            self.counters[counter] += 1
+            self._db.execute("UPDATE sql_cache SET last_used_at = ? WHERE cache_key = ?", (time.time(), row[0]))
+            self._db.commit()
+            return row[1], row[2]
+
+    def put(self, question: str, schema_key: str, limit: int, yesterday: str, sql: str, explanation: str):
+        """Store a generated query and evict expired and least recently used entries."""
+        question_norm = normalize_question(question)
+        scope_key = self._scope_key(schema_key, limit, yesterday)
+        now = time.time()
+        
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sql_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (hash_text(f"{scope_key}|{question_norm}"), scope_key, question_norm, sql, explanation, now, now)
+            )
+            self._db.execute("DELETE FROM sql_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._db.execute(
+                "DELETE FROM sql_cache WHERE cache_key NOT IN "
+                "(SELECT cache_key FROM sql_cache ORDER BY last_used_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        """Hit/miss counters plus the current number of stored entries."""
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM sql_cache").fetchone()[0]
+            return {**self.counters, "entries": size}
+
+
+@lru_cache(maxsize=None)
+def get_sql_cache() -> SqlGenerationCache:
+    """Process-wide generated SQL cache."""
+    return SqlGenerationCache(os.path.join(CACHE_DIR, "sql_cache.sqlite3"))
+
+
+# Quoted literals and identifiers, then line and block comments; one pass so each hides the others' markers
+_SQL_QUOTED_OR_COMMENT_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)""", re.DOTALL)
+
+
+def _canonicalize_sql_code(code: str) -> str:
+    code = re.sub(r"\s+", " ", code.lower())
+    return re.sub(r"\s*([(),=<>!+*/-])\s*", r"\1", code)
+
+
+def canonicalize_sql(sql: str) -> str:
+    """Canonical form of a query so formatting differences share a cache entry.
+    
+    Comments are dropped, keywords and identifiers outside quotes are
+    lower-cased, whitespace is collapsed, and literal quoting is preserved.
+    Comment markers inside literals (`'a--b'`) are part of the literal.
+    """
+    canonical, code = [], ""
+    for i, part in enumerate(_SQL_QUOTED_OR_COMMENT_PATTERN.split(sql)):
+        if i % 2 == 0:
+            code += part
+        elif part.startswith(("--", "/*")):
+            code += " "
+        else:
+            canonical.append(_canonicalize_sql_code(code))
+            canonical.append(part)
+            code = ""
+    canonical.append(_canonicalize_sql_code(code))
+    return "".join(canonical).strip().rstrip(";").strip()
+
+
+def settled_before() -> date:
+    """First day that may still receive late-arriving events; days before it no longer change."""
+    return date.today() - timedelta(days=LATE_DATA_DAYS)
+
+
+def result_cache_ttl(sql: str) -> int:
+    """Results over settled past days never change, so they are cached much longer.
+    
+    Days within LATE_DATA_DAYS of today still receive late events and get
+    the short TTL. Filters relative to the current date (CURRENT_DATE,
+    DATEADD) select a different range each day under the same SQL text, so
+    they always get the short TTL.
+    """
+    analysis = analyze_sql(sql)
+    _, last_day = analysis["date_range"]
+    if (analysis["date_predicates_simple"] and not analysis["date_is_relative"]
+            and last_day is not None and last_day < settled_before()):
+        return RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS
+    return RESULT_CACHE_OPEN_DAYS_TTL_SECONDS
+
+
+def result_cache_mode(use_rollups: bool, incremental: bool, approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> str:
+    """Execution settings that are part of a result's cache key.
+    
+    Rollup and incremental runs can answer with HyperLogLog estimates, so
+    their results must not be served to runs with those settings off.
+    """
+    return f"rollups={int(use_rollups)} incremental={int(incremental)} approximate={int(approximate)}"
+
+
+class QueryResultCache:
+    """Cross-session cache of query results keyed on canonical SQL.
+    
+    Small results stay in memory under an LRU byte budget; results larger
+    than the spill threshold are written to Parquet files under a separate
+    disk budget. Every spill gets its own file name, so replacing or
+    evicting an entry never deletes a file a newer entry points to.
+    
+    The directory may be shared with other processes (server workers,
+    cli.py), so only spill files older than max_ttl_seconds, which no
+    entry of any process can still point to, are swept.
+    
+    Cached frames are shared by every session that reads the entry: get()
+    returns a shallow copy, so adding, dropping or reordering columns is
+    safe, but values must not be modified in place.
+    """
+
+    def __init__(self, directory: str, max_memory_bytes: int = RESULT_CACHE_MAX_MEMORY_BYTES,
+                 max_disk_bytes: int = RESULT_CACHE_MAX_DISK_BYTES,
+                 spill_bytes: int = RESULT_CACHE_SPILL_BYTES,
+                 max_ttl_seconds: int = RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_bytes = spill_bytes
+        self.max_ttl_seconds = max_ttl_seconds
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "orphans_removed": 0}
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._next_sweep_at = 0.0
+        self._lock = threading.Lock()
+        self._sweep_spill_files()
+
+    def _sweep_spill_files(self):
+        """Delete spill files no entry can still point to; runs at most once per sweep interval."""
+        now = time.time()
+        with self._lock:
+            if now < self._next_sweep_at:
+                return
+            self._next_sweep_at = now + RESULT_CACHE_SWEEP_INTERVAL_SECONDS
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            with suppress(FileNotFoundError):
+                if name.endswith(".parquet") and os.path.getmtime(path) < now - self.max_ttl_seconds:
+                    os.remove(path)
+                    removed += 1
+        with self._lock:
+            self.counters["orphans_removed"] += removed
+
+    @staticmethod
+    def key_for(sql: str, mode: str = "") -> str:
+        return hash_text(f"{mode}|{canonicalize_sql(sql)}")
+
+    def get(self, sql: str, mode: str = "") -> Optional[Tuple[pd.DataFrame, dict]]:
+        """Return the cached (result, metadata) for a query run in a mode, or None if missing or expired."""
+        key = self.key_for(sql, mode)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            if entry["df"] is not None:
+                self.counters["hits"] += 1
+                return entry["df"].copy(deep=False), dict(entry["meta"])
+            path, meta = entry["path"], dict(entry["meta"])
+        try:
+            df = pd.read_parquet(path)
+        except OSError:
+            # Replaced or evicted, and its file deleted, before it could be read
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+        with self._lock:
+            self.counters["hits"] += 1
+        return df, meta
+
+    def put(self, sql: str, df: pd.DataFrame, meta: Optional[dict] = None, ttl_seconds: Optional[int] = None,
+            mode: str = ""):
+        """Store a query result, spilling it to disk if it is large.
+        
+        The frame is kept as is, so the caller must not modify it in place afterwards.
+        """
+        key = self.key_for(sql, mode)
+        meta = dict(meta or {})
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        ttl_seconds = ttl_seconds if ttl_seconds is not None else result_cache_ttl(sql)
+        ttl_seconds = min(ttl_seconds, self.max_ttl_seconds)
+        if meta.get("truncated"):
+            # The rows not held here are only retrievable while Snowflake keeps the query result
+            ttl_seconds = min(ttl_seconds, QUERY_RESULT_RETENTION_SECONDS)
+        entry = {"df": df, "meta": meta, "path": None, "bytes": size, "expires_at": time.time() + ttl_seconds}
+        
+        if size > self.spill_bytes:
+            if size > self.max_disk_bytes:
+                return
+            self._sweep_spill_files()
+            path = os.path.join(self.directory, f"{key}-{uuid.uuid4().hex[:12]}.parquet")
+            df.to_parquet(path, index=False)
+            entry.update(df=None, path=path, bytes=os.path.getsize(path))
+        elif size > self.max_memory_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            if entry["path"]:
+                self._disk_bytes += entry["bytes"]
+            else:
+                self._memory_bytes += entry["bytes"]
+            self._evict()
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        if entry["path"]:
+            self._disk_bytes -= entry["bytes"]
+            with suppress(OSError):
+                os.remove(entry["path"])
+        else:
+            self._memory_bytes -= entry["bytes"]
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e["expires_at"] < now]:
+            self._remove(key)
+        for key in list(self._entries):
+            if self._memory_bytes <= self.max_memory_bytes and self._disk_bytes <= self.max_disk_bytes:
+                break
+            entry = self._entries[key]
+            over_memory = entry["path"] is None and self._memory_bytes > self.max_memory_bytes
+            over_disk = entry["path"] is not None and self._disk_bytes > self.max_disk_bytes
+            if over_memory or over_disk:
+                self._remove(key)
+                self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries),
+                    "memory_bytes": self._memory_bytes, "disk_bytes": self._disk_bytes}
+
+
+@lru_cache(maxsize=None)
+def get_result_cache() -> QueryResultCache:
+    """Process-wide query result cache."""
+    return QueryResultCache(os.path.join(CACHE_DIR, "results"))
+
+
+@lru_cache(maxsize=None)
+def get_partial_cache() -> QueryResultCache:
+    """Process-wide cache of incremental per-day partial aggregates, keyed "<plan fingerprint> <day>"."""
+    return QueryResultCache(os.path.join(CACHE_DIR, "incremental_partials"),
+                            max_memory_bytes=INCREMENTAL_PARTIAL_CACHE_MAX_MEMORY_BYTES,
+                            max_disk_bytes=INCREMENTAL_PARTIAL_CACHE_MAX_DISK_BYTES)
@@ -0,0 +1,216 @@
+"""Chart selection and chart data: downsampling in memory or aggregation in Snowflake."""
+
+from datetime import date, datetime
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .config import CHART_MAX_POINTS, CHART_TOP_CATEGORIES
+from .caching import get_result_cache, result_cache_ttl
+from .db import query_over_result, quote_identifier
+
+
+def is_time_column(values: pd.Series) -> bool:
+    """Datetime columns, and object columns holding dates (how Snowflake DATEs arrive)."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return True
+    if values.dtype != object:
+        return False
+    sample = values.dropna().head(100)
+    return len(sample) > 0 and all(isinstance(value, (date, datetime)) for value in sample)
+
+
+def top_n_with_other(totals: pd.Series, n: int = CHART_TOP_CATEGORIES) -> pd.Series:
+    """The n largest categories, with the rest summed into one "Other" bar."""
+    totals = totals.sort_values(ascending=False)
+    if len(totals) <= n:
+        return totals
+    top = totals.head(n - 1)
+    return pd.concat([top, pd.Series({"Other": totals.iloc[n - 1:].sum()})])
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of threshold points that keep a series' visual shape."""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    # Interior points split into threshold - 2 buckets; first and last points are always kept
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[next_start:next_end].mean() if next_end > next_start else x[-1]
+        next_y = y[next_start:next_end].mean() if next_end > next_start else y[-1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def min_max_indices(values: np.ndarray, threshold: int) -> np.ndarray:
+    """Per bucket, the rows holding each series' minimum and maximum, so peaks survive downsampling."""
+    n = len(values)
+    series_count = values.shape[1]
+    # Two rows are reserved for the endpoints; each bucket adds at most a min and a max per series
+    buckets = max(1, (threshold - 2) // (2 * series_count))
+    if n <= threshold:
+        return np.arange(n)
+    
+    selected = [np.array([0, n - 1])]
+    for bucket in np.array_split(np.arange(n), buckets):
+        block = values[bucket]
+        # A series with no values in this bucket contributes the bucket's first row
+        block = np.where(np.isnan(block).all(axis=0), 0.0, block)
+        selected.append(bucket[np.nanargmin(block, axis=0)])
+        selected.append(bucket[np.nanargmax(block, axis=0)])
+    return np.unique(np.concatenate(selected))
+
+
+def downsample_series(data: pd.DataFrame, max_points: int = CHART_MAX_POINTS) -> pd.DataFrame:
+    """Reduce a time-ordered frame of numeric series to at most max_points rows.
+    
+    A single series uses LTTB; several series use min/max bucketing so every
+    series keeps its extremes.
+    """
+    if len(data) <= max_points:
+        return data
+    values = data.to_numpy(dtype=np.float64)
+    # Columns that are entirely NaN would break argmin/argmax
+    values = np.where(np.isnan(values).all(axis=0), 0.0, values)
+    if values.shape[1] == 1:
+        index = data.index
+        x = index.asi8.astype(np.float64) if isinstance(index, pd.DatetimeIndex) else np.arange(len(data), dtype=np.float64)
+        y = np.nan_to_num(values[:, 0])
+        return data.iloc[lttb_indices(x, y, max_points)]
+    return data.iloc[min_max_indices(values, max_points)]
+
+
+def chart_spec(df: pd.DataFrame) -> dict:
+    """Which chart a result gets: {"kind": "bar" | "line" | None, "dimension", "measures", "note"}.
+    
+    Only column types are looked at, so the in-memory rows of a truncated
+    result are enough. A categorical column gives a bar chart of the first
+    numeric column; otherwise numeric columns are drawn as lines over the
+    first time column (or over row order when there is none).
+    """
+    if len(df) == 0:
+        return {"kind": None, "note": "No data to visualize"}
+    numeric_cols = df.select_dtypes(include=["number"]).columns.tolist()
+    time_cols = [col for col in df.columns if col not in numeric_cols and is_time_column(df[col])]
+    categorical_cols = [col for col in df.select_dtypes(include=["object", "category"]).columns if col not in time_cols]
+    if not numeric_cols:
+        return {"kind": None, "note": "No suitable columns found for automatic visualization"}
+    if categorical_cols:
+        return {"kind": "bar", "dimension": categorical_cols[0], "measures": numeric_cols[:1], "note": None}
+    return {"kind": "line", "dimension": time_cols[0] if time_cols else None, "measures": numeric_cols, "note": None}
+
+
+def category_note(shown: int, total: int) -> Optional[str]:
+    if total <= shown:
+        return None
+    return f"Showing the top {shown - 1} of {total:,} categories; the rest are grouped as Other"
+
+
+def prepare_chart_data(df: pd.DataFrame, max_points: int = CHART_MAX_POINTS) -> dict:
+    """Pick a chart for a result and build its (bounded) data.
+    
+    Returns chart_spec() plus "data". Time series are aggregated per
+    timestamp and downsampled; categories are totalled and cut to the top
+    CHART_TOP_CATEGORIES plus "Other".
+    """
+    spec = chart_spec(df)
+    if spec["kind"] is None:
+        return {**spec, "data": None}
+    
+    if spec["kind"] == "bar":
+        num_col = spec["measures"][0]
+        totals = df.groupby(spec["dimension"], dropna=False)[num_col].sum()
+        chart_totals = top_n_with_other(totals)
+        return {**spec, "data": chart_totals.rename(num_col).to_frame(),
+                "note": category_note(len(chart_totals), len(totals))}
+    
+    if spec["dimension"] is not None:
+        time_col = spec["dimension"]
+        data = df.groupby(pd.to_datetime(df[time_col]))[spec["measures"]].sum().sort_index()
+        data.index.name = time_col
+    else:
+        data = df[spec["measures"]]
+    
+    points = len(data)
+    data = downsample_series(data, max_points)
+    note = f"Showing {len(data):,} of {points:,} points" if len(data) < points else None
+    return {**spec, "data": data, "note": note}
+
+
+def chart_aggregate_sql(source: str, spec: dict, max_points: int = CHART_MAX_POINTS) -> str:
+    """Aggregate query producing a chart's data in the warehouse from a FROM item over the result.
+    
+    Bar charts total the measure per category and fold everything past the
+    top CHART_TOP_CATEGORIES into "Other". Line charts total the measures
+    per timestamp and then sum neighbouring timestamps into at most
+    max_points buckets.
+    """
+    dimension = quote_identifier(spec["dimension"])
+    measures = [quote_identifier(measure) for measure in spec["measures"]]
+    if spec["kind"] == "bar":
+        measure = measures[0]
+        return f"""WITH totals AS (
+    SELECT {dimension} AS category, SUM({measure}) AS total FROM {source} GROUP BY 1
+), ranked AS (
+    SELECT category, total, ROW_NUMBER() OVER (ORDER BY total DESC NULLS LAST) AS rank, COUNT(*) OVER () AS categories
+    FROM totals
+)
+SELECT
+    IFF(rank < {CHART_TOP_CATEGORIES} OR categories <= {CHART_TOP_CATEGORIES}, category::VARCHAR, 'Other') AS {dimension},
+    SUM(total) AS {measure},
+    MAX(categories) AS "categories"
+FROM ranked
+GROUP BY 1
+ORDER BY MIN(rank)"""
+    
+    sums = ", ".join(f"SUM({measure}) AS {measure}" for measure in measures)
+    return f"""WITH per_time AS (
+    SELECT {dimension}::TIMESTAMP_NTZ AS {dimension}, {sums} FROM {source} GROUP BY 1
+), bucketed AS (
+    SELECT *, NTILE({max_points}) OVER (ORDER BY {dimension}) AS bucket, COUNT(*) OVER () AS "points" FROM per_time
+)
+SELECT MIN({dimension}) AS {dimension}, {sums}, MAX("points") AS "points"
+FROM bucketed
+GROUP BY bucket
+ORDER BY 1"""
+
+
+def warehouse_chart_data(sql: str, meta: dict, spec: dict) -> Optional[dict]:
+    """Chart data computed in Snowflake over the stored result, or None when the chart can't be pushed down.
+    
+    The aggregate is stored in the result cache next to the main result
+    (same TTL), so switching back to the chart doesn't query again.
+    """
+    if spec["kind"] is None or spec["dimension"] is None or not meta.get("query_id"):
+        return None
+    cache = get_result_cache()
+    cache_key = f"chart {spec['kind']} {spec['dimension']} {' '.join(spec['measures'])} over {sql}"
+    cached = cache.get(cache_key)
+    if cached is not None:
+        data = cached[0]
+    else:
+        data = query_over_result(lambda source: chart_aggregate_sql(source, spec), meta["query_id"])
+        cache.put(cache_key, data, ttl_seconds=result_cache_ttl(sql))
+    
+    if spec["kind"] == "bar":
+        total = int(data["categories"].max()) if len(data) else 0
+        chart = data.drop(columns="categories").set_index(spec["dimension"])
+        return {**spec, "data": chart, "note": category_note(len(chart), total)}
+    
+    points = int(data["points"].max()) if len(data) else 0
+    chart = data.drop(columns="points").set_index(spec["dimension"])
+    note = f"Showing {len(chart):,} time buckets over {points:,} points" if len(chart) < points else None
+    return {**spec, "data": chart, "note": note}
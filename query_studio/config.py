@@ -0,0 +1,328 @@
+"""Settings shared by the app, the CLI and the scripts: tables, limits, cache sizes and feature switches.
+
+Also reads the secrets (Snowflake and OpenAI credentials).
+"""
+
+import os
+
+
+TABLE_NAME = "mako_data_lake.public.combined_events_enriched"
+DEFAULT_LIMIT = 100
+APP_NAME = "Keshet Digital Query Studio"
+OPENAI_MODEL = "gpt-4o-mini"
+# Stream completions so the SQL can be shown and checked before the explanation is done
+OPENAI_STREAMING = True
+
+# Local cache storage (shared by all sessions of this process)
+CACHE_DIR = os.environ.get("QUERY_STUDIO_CACHE_DIR", ".query_studio_cache")
+
+# Generated SQL cache
+SQL_CACHE_MAX_ENTRIES = 500
+SQL_CACHE_TTL_SECONDS = 7 * 24 * 3600
+SQL_CACHE_SIMILARITY_THRESHOLD = 0.85
+
+# Query history and favorites (persisted per user)
+HISTORY_MAX_ENTRIES_PER_USER = 2000
+HISTORY_PAGE_SIZE = 10
+# Viewers without a signed-in identity get a history kept for their session only
+HISTORY_DEFAULT_USER = "local"
+
+# Query result cache
+RESULT_CACHE_MAX_MEMORY_BYTES = 512 * 1024 * 1024
+RESULT_CACHE_MAX_DISK_BYTES = 4 * 1024 * 1024 * 1024
+RESULT_CACHE_SPILL_BYTES = 32 * 1024 * 1024
+RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS = 7 * 24 * 3600
+RESULT_CACHE_OPEN_DAYS_TTL_SECONDS = 5 * 60
+# Spill files older than the longest TTL belong to no live cache entry (of any process) and are deleted
+RESULT_CACHE_SWEEP_INTERVAL_SECONDS = 3600
+# Events keep arriving for this many days after a day ends; refresh_rollups.py rebuilds them by default
+LATE_DATA_DAYS = 3
+
+# How results are fetched from Snowflake: "arrow" (columnar batches) or "rows" (fetchall)
+FETCH_MODE = "arrow"
+
+# Snowflake connection pool
+SNOWFLAKE_POOL_SIZE = 8
+SNOWFLAKE_POOL_TIMEOUT_SECONDS = 30
+SNOWFLAKE_CONNECTION_MAX_LIFETIME_SECONDS = 3600
+SNOWFLAKE_HEALTH_CHECK_IDLE_SECONDS = 60
+SNOWFLAKE_CONNECT_RETRIES = 4
+SNOWFLAKE_CONNECT_BACKOFF_SECONDS = 0.5
+
+# Asynchronous query execution: the progress panel refreshes every QUERY_POLL_INTERVAL_SECONDS; the
+# query status is polled with backoff, and bytes scanned (a QUERY_HISTORY lookup) less often still
+QUERY_POLL_INTERVAL_SECONDS = 1.0
+QUERY_POLL_BACKOFF = 1.5
+QUERY_POLL_MAX_INTERVAL_SECONDS = 10.0
+QUERY_BYTES_SCANNED_INTERVAL_SECONDS = 15.0
+
+# Speculative preview: run the preview query in the background right after generation
+PREVIEW_ROWS = 10
+SPECULATIVE_PREVIEW_DEFAULT = False
+SPECULATIVE_PREVIEW_MAX_PER_USER = 2
+# Pool connections always left to interactive queries; previews wait for results without holding one
+SPECULATIVE_PREVIEW_POOL_HEADROOM = 6
+SPECULATIVE_PREVIEW_WORKERS = SNOWFLAKE_POOL_SIZE - SPECULATIVE_PREVIEW_POOL_HEADROOM
+SPECULATIVE_PREVIEW_POLL_SECONDS = 0.25
+
+# Pre-execution cost estimation (EXPLAIN USING JSON)
+PLAN_CACHE_TTL_SECONDS = 3600
+COST_WARN_BYTES = 50 * 1024 ** 3
+COST_BLOCK_BYTES = 1024 ** 4
+COST_WARN_PARTITION_RATIO = 0.5
+
+# Parsed SQL trees and analyses kept in memory
+SQL_ANALYSIS_CACHE_SIZE = 1024
+
+# Daily rollup tables over TABLE_NAME; queries covered by a rollup are routed to it
+ROLLUPS_ENABLED = True
+ROLLUP_SCHEMA = "mako_data_lake.rollups"
+ROLLUP_COVERAGE_TTL_SECONDS = 600
+ROLLUP_TABLES = {
+    "daily_audience": ["SITE", "PLATFORM", "DEVICE_TYPE", "DEVICE_OS", "IL_OR_ABROAD", "ABSOLUTE_VISIT_REF", "event_name"],
+    "daily_video": ["SITE", "PLATFORM", "DEVICE_TYPE", "event_name", "action", "reason"],
+    "daily_engagement": ["SITE", "PLATFORM", "event_name", "ENGAGEMENT_TYPE", "ENGAGEMENT_DETAILS"],
+    "daily_ads": ["SITE", "PLATFORM", "DEVICE_TYPE", "event_name", "type", "sub_type"],
+}
+# Measure column -> aggregate over TABLE_NAME that fills it
+ROLLUP_MEASURES = {
+    "event_count": "COUNT(*)",
+    "visit_first_events": "SUM(visit_first_event)",
+    "users_hll": "HLL_ACCUMULATE(user_id)",
+    "visits_hll": "HLL_ACCUMULATE(calculated_visit_id)",
+}
+# Source column -> HLL measure answering COUNT(DISTINCT column)
+ROLLUP_DISTINCT_MEASURES = {"user_id": "users_hll", "calculated_visit_id": "visits_hll"}
+
+# Rollups and incremental runs can only estimate COUNT(DISTINCT) (HyperLogLog); queries with exact
+# distinct counts run as written unless estimates are allowed
+APPROXIMATE_DISTINCT_DEFAULT = False
+
+# Incremental re-execution: per-day partial aggregates of closed days are cached and merged locally
+INCREMENTAL_EXECUTION_DEFAULT = False
+INCREMENTAL_MAX_DAYS = 400
+# Incremental runs whose per-day partials hold more rows than this run as a normal query instead
+INCREMENTAL_MAX_PARTIAL_ROWS = 100_000
+# Per-day partials have their own cache, so they don't count against (or evict) query results
+INCREMENTAL_PARTIAL_CACHE_MAX_MEMORY_BYTES = 128 * 1024 * 1024
+INCREMENTAL_PARTIAL_CACHE_MAX_DISK_BYTES = 1024 * 1024 * 1024
+
+# Schema pruning: only the columns most relevant to a question are sent to the LLM
+SCHEMA_PRUNING_ENABLED = True
+SCHEMA_TOP_K = 12
+SCHEMA_MIN_COLUMNS = 4
+SCHEMA_ALWAYS_INCLUDE = ["date"]
+
+# Result paging and export
+RESULT_PAGE_ROWS = 1000
+RESULT_MEMORY_ROWS = 100_000
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_TTL_SECONDS = 24 * 3600
+# Results this large can be unloaded by Snowflake to a stage (COPY INTO) and downloaded from presigned URLs
+UNLOAD_MIN_ROWS = 1_000_000
+UNLOAD_STAGE = "mako_data_lake.public.query_studio_exports"
+UNLOAD_MAX_FILE_BYTES = 256 * 1024 * 1024
+UNLOAD_URL_EXPIRY_SECONDS = 3600
+# Export files larger than this are uploaded to UNLOAD_STAGE and downloaded from a presigned URL
+# instead of being read into the page by st.download_button
+EXPORT_DOWNLOAD_MAX_BYTES = 64 * 1024 * 1024
+# Snowflake keeps query results retrievable by query ID for 24 hours
+QUERY_RESULT_RETENTION_SECONDS = 23 * 3600
+
+# Column statistics: distinct counts are HyperLogLog estimates above this many rows
+STATS_APPROX_DISTINCT_ROWS = 200_000
+STATS_HLL_PRECISION = 12
+STATS_HLL_CHUNK_ROWS = 65_536
+# Statistics computed in Snowflake are cached per SQL for this long
+STATS_PUSHDOWN_TTL_SECONDS = 3600
+
+# Charts: at most this many points are sent to the browser
+CHART_MAX_POINTS = 2000
+CHART_TOP_CATEGORIES = 15
+
+# Tracing: spans are also exported to an OpenTelemetry collector when the SDK is installed and this is set
+OTEL_EXPORTER_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = "query-studio"
+# Prometheus metrics are served on this port (at /metrics) when set; set the address to 0.0.0.0 to expose them
+METRICS_PORT = int(os.environ.get("QUERY_STUDIO_METRICS_PORT", "0")) or None
+METRICS_ADDRESS = os.environ.get("QUERY_STUDIO_METRICS_ADDRESS", "127.0.0.1")
+METRICS_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS_ROWS_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+METRICS_BYTES_BUCKETS = tuple(1024 ** 2 * 10 ** i for i in range(7))
+# The performance panel is shown when the app is opened with ?perf=1
+PERF_PANEL_QUERY_PARAM = "perf"
+
+# Important columns with detailed descriptions
+IMPORTANT_COLUMNS = {
+    "date": {
+        "description": "Event date",
+        "type": "DATE",
+        "values": None
+    },
+    "event_time": {
+        "description": "Event timestamp",
+        "type": "TIMESTAMP_NTZ(9)",
+        "values": None
+    },
+    "event_name": {
+        "description": "The event name",
+        "type": "VARCHAR",
+        "values": "page_view, play, click, ads, engagement"
+    },
+    "calculated_visit_id": {
+        "description": "The user's visit ID calculated since start of the visit until 30 minutes of inactivity. This is the relevant visit_id to use for session analysis.",
+        "type": "NUMBER",
+        "values": None
+    },
+    "user_id": {
+        "description": "The user's ID. Users have the same ID that is dependent on the device.",
+        "type": "VARCHAR",
+        "values": None
+    },
+    "item_id": {
+        "description": "The item ID the event happened for. For example, a page view for a specific article.",
+        "type": "VARCHAR",
+        "values": None
+    },
+    "channel_id": {
+        "description": "The channel that the item is connected to.",
+        "type": "VARCHAR",
+        "values": None
+    },
+    "content_type": {
+        "description": "The content type of the item.",
+        "type": "VARCHAR",
+        "values": None
+    },
+    "visit_first_event": {
+        "description": "1 if this is the first event in the user's visit, null otherwise. Useful for counting visits.",
+        "type": "NUMBER",
+        "values": "1 or null"
+    },
+    "push_id": {
+        "description": "The ID of the push notification the user started the visit from.",
+        "type": "NUMBER",
+        "values": None
+    },
+    "play_id": {
+        "description": "The ID of the play event. Stays the same as long as the user is watching the same video.",
+        "type": "VARCHAR",
+        "values": None
+    },
+    "action": {
+        "description": "The action the user did. Mostly relevant during play events.",
+        "type": "VARCHAR",
+        "values": "skip_backwards, skip_forward, error, mute, share, display, start, resume, change_display, pause, seek, startover, complete, play, close, live_rt, fallback, change_state, unmute, skip, change_speed, continue_watch"
+    },
+    "reason": {
+        "description": "The reason for the action. Mostly relevant for the action field.",
+        "type": "VARCHAR",
+        "values": "scroll, end_manual_next_episode, user_idle, next_episode, back, auto_swipe, app_background, dvr_back, more_episodes, user, buffering, midroll, share, user_player_pause, epg, preroll, dvr, swipe, auto_next_episode, click"
+    },
+    "previous_action": {
+        "description": "The action of the previous event.",
+        "type": "VARCHAR",
+        "values": "skip_backwards, skip_forward, error, mute, share, display, start, resume, change_display, pause, seek, startover, complete, play, close, live_rt, fallback, change_state, unmute, skip, change_speed, continue_watch"
+    },
+    "previous_reason": {
+        "description": "The reason of the previous event.",
+        "type": "VARCHAR",
+        "values": "scroll, end_manual_next_episode, user_idle, next_episode, back, auto_swipe, app_background, dvr_back, more_episodes, user, buffering, midroll, share, user_player_pause, epg, preroll, dvr, swipe, auto_next_episode, click"
+    },
+    "type": {
+        "description": "The ad type.",
+        "type": "VARCHAR",
+        "values": "video, display"
+    },
+    "sub_type": {
+        "description": "The ad subtype.",
+        "type": "VARCHAR",
+        "values": "preroll, cube, article, monster, jambo, native, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast, video_paused_ad, midroll"
+    },
+    "ENGAGEMENT_TYPE": {
+        "description": "The type of engagement.",
+        "type": "VARCHAR",
+        "values": "share, comment, feelings, interaction"
+    },
+    "ENGAGEMENT_DETAILS": {
+        "description": "The details of the engagement type.",
+        "type": "VARCHAR",
+        "values": "whatsapp, open_sticky_player, twitter, allow_push_notifications, deny_push_notifications, sticky_player_off, copy_link, events_summary, contact_us, loved, comment, close_sticky_player, sticky_player_on, arrow_up, reply, didnt_love, facebook, x_sticky_player"
+    },
+    "SITE": {
+        "description": "The site where the visit happened.",
+        "type": "VARCHAR",
+        "values": "n12, 12plus, v1, mako"
+    },
+    "ABSOLUTE_VISIT_REF": {
+        "description": "The referrer website.",
+        "type": "VARCHAR",
+        "values": "facebook, google, direct, etc."
+    },
+    "DEVICE_TYPE": {
+        "description": "The device type used.",
+        "type": "VARCHAR",
+        "values": "tablet, Unknown, mobile, web, smart_tv"
+    },
+    "DEVICE_OS": {
+        "description": "The OS of the device.",
+        "type": "VARCHAR",
+        "values": "Windows, hisense, iOS, Linux, Tizen, Apple TVOS, Android, iPadOS, Chrome OS, PlayStation 4, browser, macOS, webos, tizen, tvOS"
+    },
+    "IL_OR_ABROAD": {
+        "description": "Indicator for the user's location - Israel or abroad.",
+        "type": "VARCHAR",
+        "values": "unknown, abroad, il"
+    },
+    "PLATFORM": {
+        "description": "The platform the user is visiting from.",
+        "type": "VARCHAR",
+        "values": "mobile-app, smart_tv-app, tablet-browser, unknown, browser, tablet-app, mobile-browser"
+    }
+}
+
+EXAMPLE_QUERIES = [
+    "How many unique users visited mako in the last 5 days?",
+    "What's the breakdown of events by device type?",
+    "What percentage of visits came from Israel vs abroad?",
+    "How many video plays started vs completed?",
+    "What are the top referral sources?",
+    "Show engagement breakdown by type",
+    "Average events per visit by platform"
+]
+
+
+# Secrets are read from the secrets.toml files Streamlit uses (the project file overrides the
+# user-wide one), unless the app hands over st.secrets with set_secrets()
+SECRETS_PATHS = [os.path.expanduser("~/.streamlit/secrets.toml"), os.path.join(".streamlit", "secrets.toml")]
+
+_secrets = None
+
+
+def set_secrets(secrets):
+    """Use a mapping, e.g. st.secrets, as the secrets."""
+    global _secrets
+    _secrets = secrets
+
+
+def get_secrets():
+    """Secrets given to set_secrets(), else those in SECRETS_PATHS."""
+    global _secrets
+    if _secrets is None:
+        secrets = {}
+        for path in SECRETS_PATHS:
+            if os.path.exists(path):
+                secrets.update(load_toml(path))
+        _secrets = secrets
+    return _secrets
+
+
+def load_toml(path: str) -> dict:
+    try:
+        import tomllib
+    except ImportError:
+        # Python < 3.11; toml is a Streamlit dependency
+        import toml
+        return toml.load(path)
+    with open(path, "rb") as f:
+        return tomllib.load(f)
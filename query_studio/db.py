@@ -0,0 +1,570 @@
+"""Snowflake access: the connection pool, query execution and result fetching.
+
+Also EXPLAIN-based cost estimates and reading stored results back by query ID.
+"""
+
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+import snowflake.connector
+
+from .config import (
+    COST_BLOCK_BYTES, EXPORT_CHUNK_ROWS, FETCH_MODE, PLAN_CACHE_TTL_SECONDS, RESULT_MEMORY_ROWS,
+    SNOWFLAKE_CONNECTION_MAX_LIFETIME_SECONDS, SNOWFLAKE_CONNECT_BACKOFF_SECONDS, SNOWFLAKE_CONNECT_RETRIES,
+    SNOWFLAKE_HEALTH_CHECK_IDLE_SECONDS, SNOWFLAKE_POOL_SIZE, SNOWFLAKE_POOL_TIMEOUT_SECONDS, TABLE_NAME,
+    get_secrets,
+)
+from .tracing import set_span_attributes, trace_span, traced
+from .sql_analysis import analyze_sql
+from .caching import canonicalize_sql, hash_text, memoize
+
+
+def create_snowflake_connection():
+    """Create a Snowflake connection using key-pair authentication."""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    
+    private_key_pem = get_secrets()["snowflake"]["private_key"]
+    private_key = serialization.load_pem_private_key(
+        private_key_pem.encode(),
+        password=None,
+        backend=default_backend()
+    )
+    
+    private_key_bytes = private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    
+    return snowflake.connector.connect(
+        account=get_secrets()["snowflake"]["account"],
+        user=get_secrets()["snowflake"]["user"],
+        private_key=private_key_bytes,
+        warehouse=get_secrets()["snowflake"]["warehouse"],
+        database=get_secrets()["snowflake"]["database"],
+        schema=get_secrets()["snowflake"]["schema"],
+        role=get_secrets()["snowflake"]["role"],
+        client_session_keep_alive=True
+    )
+
+
+class SnowflakeConnectionPool:
+    """Bounded pool of Snowflake connections shared by all sessions.
+    
+    Connections are checked for liveness on checkout (closed, past their
+    max lifetime, or failing a SELECT 1 after sitting idle) and replaced
+    transparently; new connections are opened with exponential backoff.
+    """
+
+    def __init__(self, connect, max_size: int = SNOWFLAKE_POOL_SIZE,
+                 timeout: float = SNOWFLAKE_POOL_TIMEOUT_SECONDS,
+                 max_lifetime: float = SNOWFLAKE_CONNECTION_MAX_LIFETIME_SECONDS,
+                 health_check_idle: float = SNOWFLAKE_HEALTH_CHECK_IDLE_SECONDS):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_idle = health_check_idle
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._waits = deque(maxlen=1000)
+        self.counters = {
+            "checkouts": 0, "waits": 0, "timeouts": 0, "connects": 0,
+            "connect_failures": 0, "recycled": 0, "health_check_failures": 0,
+        }
+
+    @contextmanager
+    def connection(self):
+        """Check out a healthy connection for the duration of the block."""
+        info = self._checkout()
+        try:
+            yield info["conn"]
+        finally:
+            self._checkin(info)
+
+    def _checkout(self) -> dict:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise TimeoutError(f"No Snowflake connection available within {self.timeout}s")
+                    waited = True
+                    self._cond.wait(remaining)
+                info = self._idle.pop() if self._idle else None
+                if info is None:
+                    self._size += 1
+                self._in_use += 1
+            
+            if info is None:
+                try:
+                    info = self._open()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._is_healthy(info):
+                self._close(info)
+                self._release_slot()
+                continue
+            
+            with self._cond:
+                wait_seconds = time.monotonic() - start
+                self._waits.append(wait_seconds)
+                self.counters["checkouts"] += 1
+                self.counters["waits"] += int(waited)
+            return info
+
+    def _checkin(self, info: dict):
+        now = time.time()
+        expired = now - info["created_at"] > self.max_lifetime
+        if expired or self._safe_is_closed(info["conn"]):
+            if expired:
+                self._count("recycled")
+            self._close(info)
+            self._release_slot()
+            return
+        with self._cond:
+            info["last_used"] = now
+            self._idle.append(info)
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _count(self, counter: str):
+        with self._cond:
+            self.counters[counter] += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _open(self) -> dict:
+        for attempt in range(SNOWFLAKE_CONNECT_RETRIES):
+            try:
+                conn = self._connect()
+                break
+            except (snowflake.connector.OperationalError, snowflake.connector.InterfaceError, OSError):
+                self._count("connect_failures")
+                if attempt == SNOWFLAKE_CONNECT_RETRIES - 1:
+                    raise
+                backoff = SNOWFLAKE_CONNECT_BACKOFF_SECONDS * (2 ** attempt)
+                time.sleep(backoff * (0.5 + random.random() / 2))
+        self._count("connects")
+        now = time.time()
+        return {"conn": conn, "created_at": now, "last_used": now}
+
+    def _is_healthy(self, info: dict) -> bool:
+        now = time.time()
+        if now - info["created_at"] > self.max_lifetime:
+            self._count("recycled")
+            return False
+        if self._safe_is_closed(info["conn"]):
+            self._count("health_check_failures")
+            return False
+        if now - info["last_used"] > self.health_check_idle:
+            try:
+                cursor = info["conn"].cursor()
+                try:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                finally:
+                    cursor.close()
+            except Exception:
+                self._count("health_check_failures")
+                return False
+        return True
+
+    @staticmethod
+    def _safe_is_closed(conn) -> bool:
+        try:
+            return conn.is_closed()
+        except Exception:
+            return True
+
+    @staticmethod
+    def _close(info: dict):
+        try:
+            info["conn"].close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        """Pool size, saturation and checkout wait times."""
+        with self._cond:
+            waits = sorted(self._waits)
+            size, in_use, idle = self._size, self._in_use, len(self._idle)
+            counters = dict(self.counters)
+        
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+        
+        return {
+            **counters,
+            "size": size,
+            "in_use": in_use,
+            "idle": idle,
+            "max_size": self.max_size,
+            "saturation": in_use / self.max_size,
+            "wait_p50_seconds": percentile(0.5),
+            "wait_p95_seconds": percentile(0.95),
+            "wait_max_seconds": waits[-1] if waits else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_connection_pool() -> SnowflakeConnectionPool:
+    """Process-wide Snowflake connection pool."""
+    return SnowflakeConnectionPool(create_snowflake_connection)
+
+
+@memoize(ttl=3600)
+def get_all_columns():
+    """Fetch all columns from the table; errors are raised (and not cached)."""
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"DESCRIBE TABLE {TABLE_NAME}")
+            columns = cursor.fetchall()
+        finally:
+            cursor.close()
+    return [(col[0], col[1]) for col in columns]
+
+
+def execute_query(sql: str, fetch_mode: str = FETCH_MODE) -> pd.DataFrame:
+    """Execute SQL query and return results as a dataframe."""
+    return execute_query_paged(sql, max_rows=None, fetch_mode=fetch_mode)[0]
+
+
+def execute_query_paged(sql: str, max_rows: Optional[int] = RESULT_MEMORY_ROWS, fetch_mode: str = FETCH_MODE) -> Tuple[pd.DataFrame, dict]:
+    """Execute SQL and keep at most max_rows of the result in memory.
+    
+    Returns the in-memory rows and metadata describing the full result. When
+    the result is truncated, the remaining rows stay in Snowflake and can be
+    streamed later by query ID (see iter_result_batches).
+    """
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            with trace_span("snowflake.execute") as span:
+                cursor.execute(sql)
+                span["query_id"] = cursor.sfqid
+            df, meta = read_cursor_result(cursor, max_rows, fetch_mode)
+        finally:
+            cursor.close()
+    
+    meta["result_id"] = meta["query_id"] or hash_text(canonicalize_sql(sql))
+    return df, meta
+
+
+def read_cursor_result(cursor, max_rows: Optional[int], fetch_mode: str) -> Tuple[pd.DataFrame, dict]:
+    """Read up to max_rows of an executed cursor's result, plus metadata describing the full result."""
+    if fetch_mode == "arrow":
+        df = fetch_arrow_dataframe(cursor, max_rows=max_rows)
+    else:
+        df = fetch_rows_dataframe(cursor, max_rows=max_rows)
+    total_rows = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else len(df)
+    meta = {
+        "query_id": cursor.sfqid,
+        "result_id": cursor.sfqid,
+        "total_rows": max(total_rows, len(df)),
+        "truncated": total_rows > len(df),
+        "from_cache": False,
+    }
+    return df, meta
+
+
+def submit_query(sql: str) -> str:
+    """Submit a query without waiting for it and return its Snowflake query ID."""
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute_async(sql)
+            return cursor.sfqid
+        finally:
+            cursor.close()
+
+
+def is_query_running(query_id: str) -> bool:
+    """Whether a submitted query is still queued or running; holds a pool connection only for the status call."""
+    with get_connection_pool().connection() as conn:
+        return conn.is_still_running(conn.get_query_status(query_id))
+
+
+def get_query_progress(query_id: str, with_bytes_scanned: bool = True) -> dict:
+    """Current status of a submitted query, plus bytes scanned so far when asked for and available.
+    
+    The status comes from the connector's status API; bytes scanned needs a
+    QUERY_HISTORY_BY_USER query, which is skipped while the query runs
+    unless asked for. A finished query always gets its final figure.
+    """
+    with get_connection_pool().connection() as conn:
+        status = conn.get_query_status(query_id)
+        progress = {
+            "running": conn.is_still_running(status),
+            "failed": conn.is_an_error(status),
+            "status": status.name,
+            "bytes_scanned": None,
+        }
+        if progress["running"] and not with_bytes_scanned:
+            return progress
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT bytes_scanned FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_USER(RESULT_LIMIT => 100)) "
+                "WHERE query_id = %s",
+                (query_id,)
+            )
+            row = cursor.fetchone()
+            if row:
+                progress["bytes_scanned"] = row[0]
+        except snowflake.connector.Error:
+            pass
+        finally:
+            cursor.close()
+    return progress
+
+
+def cancel_query(query_id: str):
+    """Abort a running query in the warehouse."""
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (query_id,))
+        finally:
+            cursor.close()
+
+
+def fetch_query_result(query_id: str, max_rows: Optional[int] = RESULT_MEMORY_ROWS,
+                       fetch_mode: str = FETCH_MODE) -> Tuple[pd.DataFrame, dict]:
+    """Fetch the result of a finished query by ID, keeping at most max_rows in memory.
+    
+    Raises the query's error if it failed.
+    """
+    with get_connection_pool().connection() as conn:
+        conn.get_query_status_throw_if_error(query_id)
+        cursor = conn.cursor()
+        try:
+            cursor.get_results_from_sfqid(query_id)
+            df, meta = read_cursor_result(cursor, max_rows, fetch_mode)
+        finally:
+            cursor.close()
+    
+    meta["query_id"] = meta["result_id"] = query_id
+    return df, meta
+
+
+def fetch_rows_dataframe(cursor, max_rows: Optional[int] = None) -> pd.DataFrame:
+    """Build a dataframe from row tuples (one Python object per cell)."""
+    columns = [desc[0] for desc in cursor.description]
+    with trace_span("snowflake.fetch", mode="rows") as span:
+        data = cursor.fetchall() if max_rows is None else cursor.fetchmany(max_rows)
+        span["rows"] = len(data)
+    with trace_span("dataframe_build"):
+        return pd.DataFrame(data, columns=columns)
+
+
+def fetch_arrow_dataframe(cursor, max_rows: Optional[int] = None) -> pd.DataFrame:
+    """Build a dataframe directly from the cursor's Arrow result batches.
+    
+    Avoids materializing a list of row tuples. Results that Snowflake does
+    not return in Arrow format (e.g. SHOW/DESCRIBE) fall back to fetchall.
+    When max_rows is given, batches past that many rows are never downloaded.
+    """
+    import pyarrow as pa
+    
+    try:
+        batch_iter = cursor.fetch_arrow_batches()
+    except snowflake.connector.NotSupportedError:
+        return fetch_rows_dataframe(cursor, max_rows=max_rows)
+    
+    tables, rows = [], 0
+    with trace_span("snowflake.fetch", mode="arrow") as span:
+        for table in batch_iter:
+            tables.append(table)
+            rows += table.num_rows
+            if max_rows is not None and rows >= max_rows:
+                break
+        span.update(rows=rows, batches=len(tables))
+    
+    if not tables:
+        return pd.DataFrame(columns=[desc[0] for desc in cursor.description])
+    
+    with trace_span("dataframe_build"):
+        table = pa.concat_tables(tables)
+        del tables
+        if max_rows is not None and table.num_rows > max_rows:
+            table = table.slice(0, max_rows)
+        return arrow_table_to_pandas(table)
+
+
+def normalize_arrow_table(table):
+    """Give an Arrow result batch the column types every batch of the result shares.
+    
+    Fixed-point NUMBER columns with a scale arrive as Arrow decimals and are
+    cast to float64 so they don't become columns of Decimal objects. Integer
+    columns are widened to int64, since Snowflake picks the narrowest integer
+    width per batch.
+    """
+    import pyarrow as pa
+    
+    def normalized_type(field_type):
+        if pa.types.is_decimal(field_type):
+            return pa.float64()
+        if pa.types.is_integer(field_type):
+            return pa.int64()
+        return field_type
+    
+    schema = pa.schema([field.with_type(normalized_type(field.type)) for field in table.schema])
+    if schema != table.schema:
+        table = table.cast(schema)
+    return table
+
+
+def arrow_table_to_pandas(table) -> pd.DataFrame:
+    """Convert an Arrow result table to pandas with numeric dtypes (see normalize_arrow_table)."""
+    return normalize_arrow_table(table).to_pandas(split_blocks=True, self_destruct=True)
+
+
+def iter_result_batches(df: pd.DataFrame, meta: dict, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Yield the full result of a query as Arrow tables of at most chunk_rows rows.
+    
+    Results held entirely in memory are converted once and sliced without
+    copying; truncated results are re-read from Snowflake by query ID, one
+    Arrow result batch at a time, and never go through pandas. A pool
+    connection is only held to list the result batches, which download
+    from presigned URLs, so a consumer that stalls or stops early doesn't
+    keep a connection from other sessions.
+    """
+    import pyarrow as pa
+    
+    if not meta.get("truncated"):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # An empty result still yields one (empty) batch so exports keep their header
+        for start in range(0, max(table.num_rows, 1), chunk_rows):
+            yield table.slice(start, chunk_rows)
+        return
+    
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.get_results_from_sfqid(meta["query_id"])
+            result_batches = cursor.get_result_batches() or []
+        finally:
+            cursor.close()
+    for result_batch in result_batches:
+        table = normalize_arrow_table(result_batch.to_arrow())
+        for start in range(0, table.num_rows, chunk_rows):
+            yield table.slice(start, chunk_rows)
+
+
+def parse_explain_plan(plan: dict) -> dict:
+    """Extract partition pruning and scan size figures from an EXPLAIN USING JSON plan."""
+    global_stats = plan.get("GlobalStats", {})
+    partitions_total = global_stats.get("partitionsTotal")
+    partitions_assigned = global_stats.get("partitionsAssigned")
+    return {
+        "partitions_total": partitions_total,
+        "partitions_assigned": partitions_assigned,
+        "bytes_assigned": global_stats.get("bytesAssigned"),
+        "partition_ratio": partitions_assigned / partitions_total if partitions_total else None,
+    }
+
+
+@memoize(ttl=PLAN_CACHE_TTL_SECONDS, max_entries=500)
+def explain_query(canonical_sql: str, _sql: str) -> dict:
+    """Run EXPLAIN USING JSON for a query; plans are cached by canonical SQL."""
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"EXPLAIN USING JSON {_sql.strip().rstrip(';')}")
+            return json.loads(cursor.fetchone()[0])
+        finally:
+            cursor.close()
+
+
+@traced("estimate_cost")
+def estimate_query_cost(sql: str, plan: Optional[dict] = None) -> dict:
+    """Estimate query cost/size before execution.
+    
+    Combines static checks on the SQL with the partition and byte counts
+    from the query plan. A plan can be passed in directly (e.g. a saved
+    fixture); otherwise it is fetched with EXPLAIN.
+    """
+    sql_canonical = canonicalize_sql(sql)
+    analysis = analyze_sql(sql)
+    
+    cost_info = {
+        "has_date_filter": analysis["has_date_predicate"],
+        "date_range": analysis["date_range"],
+        "has_limit": analysis["outer_limit"] is not None,
+        "limit_value": analysis["outer_limit"],
+        "partitions_total": None,
+        "partitions_assigned": None,
+        "bytes_assigned": None,
+        "partition_ratio": None,
+        "plan_error": None,
+        "blocked": False,
+        "block_reason": None,
+    }
+    
+    try:
+        if plan is None:
+            plan = explain_query(sql_canonical, sql)
+        cost_info.update(parse_explain_plan(plan))
+    except Exception as e:
+        cost_info["plan_error"] = str(e)
+    set_span_attributes(bytes_estimated=cost_info["bytes_assigned"])
+    
+    if cost_info["bytes_assigned"] is not None and cost_info["bytes_assigned"] > COST_BLOCK_BYTES:
+        cost_info["blocked"] = True
+        cost_info["block_reason"] = (
+            f"Query would scan {format_bytes(cost_info['bytes_assigned'])}, "
+            f"above the {format_bytes(COST_BLOCK_BYTES)} limit — narrow the date range"
+        )
+    
+    return cost_info
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class ResultNotStored(Exception):
+    """A result has no stored copy in Snowflake to read back (see query_over_result)."""
+
+
+def query_over_result(build_sql: Callable[[str], str], query_id: Optional[str]) -> pd.DataFrame:
+    """Run a query built over a finished query's stored result, given the FROM item to read it from.
+    
+    The result is read with RESULT_SCAN. Results without a query ID
+    (incremental merges) raise ResultNotStored; the query is never re-run
+    as a subquery, which could scan the source tables again.
+    """
+    if not query_id:
+        raise ResultNotStored("The result is not stored in Snowflake")
+    return execute_query(build_sql(f"TABLE(RESULT_SCAN('{query_id}'))"))
+
+
+def format_bytes(num_bytes: Optional[float]) -> str:
+    """Human readable byte count."""
+    if num_bytes is None:
+        return "unknown"
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(num_bytes) < 1024 or unit == "TB":
+            return f"{num_bytes:,.0f} {unit}" if unit == "B" else f"{num_bytes:,.1f} {unit}"
+        num_bytes /= 1024
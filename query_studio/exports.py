@@ -0,0 +1,190 @@
+"""Export files (CSV, JSON, Parquet, Arrow IPC) and unloads of large results to a Snowflake stage."""
+
+import os
+import time
+from contextlib import suppress
+from typing import Optional
+
+import pandas as pd
+
+from .config import (
+    CACHE_DIR, EXPORT_TTL_SECONDS, UNLOAD_MAX_FILE_BYTES, UNLOAD_STAGE, UNLOAD_URL_EXPIRY_SECONDS,
+)
+from .tracing import traced
+from .caching import memoize
+from .db import execute_query, iter_result_batches, query_over_result
+
+
+EXPORT_FORMATS = {
+    "CSV": {"extension": "csv", "mime": "text/csv",
+            "unload_format": "TYPE = CSV COMPRESSION = GZIP FIELD_OPTIONALLY_ENCLOSED_BY = '\"'"},
+    "JSON": {"extension": "json", "mime": "application/json",
+             "unload_format": "TYPE = JSON COMPRESSION = GZIP"},
+    "Parquet": {"extension": "parquet", "mime": "application/vnd.apache.parquet",
+                "unload_format": "TYPE = PARQUET COMPRESSION = SNAPPY"},
+    # Snowflake can't unload Arrow IPC files
+    "Arrow": {"extension": "arrow", "mime": "application/vnd.apache.arrow.file", "unload_format": None},
+}
+
+
+def iter_csv_chunks(batches):
+    """Encode Arrow batches as one CSV document, batch by batch."""
+    header = True
+    for batch in batches:
+        yield batch.to_pandas().to_csv(index=False, header=header).encode("utf-8")
+        header = False
+
+
+def iter_json_chunks(batches):
+    """Encode Arrow batches as one JSON array of records, batch by batch."""
+    yield b"["
+    first = True
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        records = batch.to_pandas().to_json(orient="records", date_format="iso")[1:-1]
+        yield (records if first else "," + records).encode("utf-8")
+        first = False
+    yield b"]"
+
+
+def write_parquet_batches(batches, path: str):
+    """Write Arrow batches to a Parquet file, one row group per batch."""
+    import pyarrow.parquet as pq
+    
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema, compression="snappy")
+            writer.write_table(batch.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pd.DataFrame().to_parquet(path, index=False)
+
+
+def write_arrow_batches(batches, path: str):
+    """Write Arrow batches to a (zstd-compressed) Arrow IPC file."""
+    import pyarrow as pa
+    
+    writer, schema = None, None
+    try:
+        for batch in batches:
+            if writer is None:
+                schema = batch.schema
+                writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+            writer.write_table(batch.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pa.ipc.new_file(path, pa.schema([])).close()
+
+
+def export_path(result_id: str, export_format: str) -> str:
+    """Location of the prepared export file for a result."""
+    extension = EXPORT_FORMATS[export_format]["extension"]
+    return os.path.join(CACHE_DIR, "exports", f"{result_id}.{extension}")
+
+
+@traced("export")
+def prepare_export(df: pd.DataFrame, meta: dict, export_format: str) -> str:
+    """Stream a result into an export file and return its path.
+    
+    Exports are written batch by batch to disk, so memory stays bounded by
+    the batch size regardless of how many rows the query returned.
+    """
+    path = export_path(meta["result_id"], export_format)
+    if os.path.exists(path):
+        return path
+    
+    export_dir = os.path.dirname(path)
+    os.makedirs(export_dir, exist_ok=True)
+    for name in os.listdir(export_dir):
+        old_path = os.path.join(export_dir, name)
+        # Another session may be cleaning up the same file
+        with suppress(FileNotFoundError):
+            if os.path.getmtime(old_path) < time.time() - EXPORT_TTL_SECONDS:
+                os.remove(old_path)
+    
+    write_export(iter_result_batches(df, meta), export_format, path)
+    return path
+
+
+def write_export(batches, export_format: str, path: str):
+    """Write Arrow batches to path in the given export format.
+    
+    The file is written under a temporary name and moved into place when
+    complete, so a partially written export is never picked up.
+    """
+    tmp_path = path + ".tmp"
+    if export_format == "Parquet":
+        write_parquet_batches(batches, tmp_path)
+    elif export_format == "Arrow":
+        write_arrow_batches(batches, tmp_path)
+    else:
+        encoder = iter_csv_chunks if export_format == "CSV" else iter_json_chunks
+        with open(tmp_path, "wb") as f:
+            for data in encoder(batches):
+                f.write(data)
+    os.replace(tmp_path, path)
+
+
+def unload_sql(source: str, export_format: str, prefix: str) -> str:
+    """COPY INTO statement unloading a result to compressed files under a prefix of UNLOAD_STAGE."""
+    file_format = EXPORT_FORMATS[export_format]["unload_format"]
+    if export_format == "JSON":
+        # JSON unloads take a single VARIANT column
+        return (f"COPY INTO @{UNLOAD_STAGE}/{prefix}/ FROM (SELECT OBJECT_CONSTRUCT(*) FROM {source}) "
+                f"FILE_FORMAT = ({file_format}) OVERWRITE = TRUE MAX_FILE_SIZE = {UNLOAD_MAX_FILE_BYTES}")
+    return (f"COPY INTO @{UNLOAD_STAGE}/{prefix}/ FROM (SELECT * FROM {source}) "
+            f"FILE_FORMAT = ({file_format}) HEADER = TRUE OVERWRITE = TRUE MAX_FILE_SIZE = {UNLOAD_MAX_FILE_BYTES}")
+
+
+# Cached for half the URL lifetime, so a link that is handed out stays valid for a while
+@memoize(ttl=UNLOAD_URL_EXPIRY_SECONDS // 2, max_entries=100)
+def unload_export(result_id: str, export_format: str, _query_id: Optional[str]) -> list:
+    """Unload a full result to UNLOAD_STAGE in Snowflake and return presigned URLs of the files.
+    
+    The rows go from the warehouse to the stage and from there straight to
+    the browser; nothing passes through this process. Returns a list of
+    {"file", "bytes", "url"}, one per unloaded file.
+    """
+    prefix = f"{result_id}/{EXPORT_FORMATS[export_format]['extension']}"
+    query_over_result(lambda source: unload_sql(source, export_format, prefix), _query_id)
+    return presigned_stage_files(prefix)
+
+
+@memoize(ttl=UNLOAD_URL_EXPIRY_SECONDS // 2, max_entries=100)
+def stage_export_file(result_id: str, export_format: str, path: str) -> list:
+    """Upload a prepared export file to UNLOAD_STAGE and return a presigned URL for it.
+    
+    The connector streams the file from disk, so a large export never has
+    to be read into memory to be downloaded. Returns the same list as
+    unload_export().
+    """
+    prefix = f"{result_id}/{EXPORT_FORMATS[export_format]['extension']}-file"
+    file_url = "file://" + path.replace("\\", "/").replace("'", "\\'")
+    execute_query(f"PUT '{file_url}' @{UNLOAD_STAGE}/{prefix}/ AUTO_COMPRESS = FALSE OVERWRITE = TRUE")
+    return presigned_stage_files(prefix)
+
+
+def presigned_stage_files(prefix: str) -> list:
+    """Presigned URLs of the files under a prefix of UNLOAD_STAGE, as {"file", "bytes", "url"}."""
+    listing = execute_query(f"LIST @{UNLOAD_STAGE}/{prefix}/")
+    if listing.empty:
+        return []
+    # LIST names start with the stage name; presigned URLs take the path within the stage
+    paths = [name.split("/", 1)[1] for name in listing["name"]]
+    values = ", ".join("('" + path.replace("'", "''") + "')" for path in paths)
+    urls = execute_query(
+        f"SELECT column1 AS path, GET_PRESIGNED_URL(@{UNLOAD_STAGE}, column1, {UNLOAD_URL_EXPIRY_SECONDS}) AS url "
+        f"FROM VALUES {values}"
+    )
+    url_by_path = dict(zip(urls.iloc[:, 0], urls.iloc[:, 1]))
+    return [
+        {"file": path.rsplit("/", 1)[-1], "bytes": int(size), "url": url_by_path[path]}
+        for path, size in zip(paths, listing["size"])
+    ]
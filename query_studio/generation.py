@@ -0,0 +1,555 @@
+"""Natural language to SQL with OpenAI: schema descriptions, column pruning, prompts and streaming."""
+
+import json
+import math
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+import openai
+
+from .config import (
+    IMPORTANT_COLUMNS, OPENAI_MODEL, OPENAI_STREAMING, SCHEMA_ALWAYS_INCLUDE, SCHEMA_MIN_COLUMNS,
+    SCHEMA_TOP_K, TABLE_NAME, get_secrets,
+)
+from .tracing import trace_span
+from .sql_analysis import validate_sql_safety
+from .caching import get_sql_cache, hash_text
+
+
+def build_schema_description(all_columns: list) -> str:
+    """Build a schema description for the LLM."""
+    lines = []
+    for col_name, col_type in all_columns:
+        important_info = IMPORTANT_COLUMNS.get(col_name) or IMPORTANT_COLUMNS.get(col_name.upper()) or IMPORTANT_COLUMNS.get(col_name.lower())
+        if important_info:
+            desc = f"- {col_name} ({important_info['type']}): {important_info['description']}"
+            if important_info['values']:
+                desc += f" Possible values: {important_info['values']}"
+            lines.append(desc)
+        else:
+            lines.append(f"- {col_name} ({col_type})")
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=8)
+def _schema_description_for(columns: tuple) -> str:
+    return build_schema_description(list(columns))
+
+
+def get_schema_description(all_columns: list) -> str:
+    """Schema description for a column list, built once per schema version."""
+    return _schema_description_for(tuple(tuple(col) for col in all_columns))
+
+
+def get_schema_key(all_columns: list) -> str:
+    """Hash identifying a schema version, e.g. to scope cached SQL to the full table schema."""
+    return hash_text(get_schema_description(all_columns))
+
+
+_STEM_SUFFIXES = ["ations", "ation", "ings", "ing", "ers", "er", "als", "al", "s", "ed"]
+
+
+def stem_term(word: str) -> str:
+    """Crude suffix stripping so e.g. referral/referrer and visits/visited match."""
+    for suffix in _STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            word = word[:-len(suffix)]
+            break
+    if word.endswith("e") and len(word) > 4:
+        word = word[:-1]
+    return word
+
+
+def text_terms(text: str) -> list:
+    """Lower-cased, stemmed terms of a text; identifiers are split on underscores."""
+    return [stem_term(word) for word in re.findall(r"[^\W_]+", text.lower())]
+
+
+class ColumnIndex:
+    """BM25 index over table columns for retrieving the ones relevant to a question.
+    
+    Each column is indexed by its name (weighted double), its description
+    and its enumerated values from IMPORTANT_COLUMNS.
+    """
+
+    def __init__(self, all_columns: list, k1: float = 1.2, b: float = 0.75):
+        self.columns = list(all_columns)
+        self.k1 = k1
+        self.b = b
+        self.documents = []
+        for col_name, _ in self.columns:
+            info = IMPORTANT_COLUMNS.get(col_name) or IMPORTANT_COLUMNS.get(col_name.upper()) or IMPORTANT_COLUMNS.get(col_name.lower())
+            terms = text_terms(col_name) * 2
+            if info:
+                terms += text_terms(info["description"]) + text_terms(info["values"] or "")
+            self.documents.append(terms)
+        
+        self.average_length = sum(len(doc) for doc in self.documents) / max(len(self.documents), 1)
+        self.term_counts = []
+        document_frequency = {}
+        for doc in self.documents:
+            counts = {}
+            for term in doc:
+                counts[term] = counts.get(term, 0) + 1
+            self.term_counts.append(counts)
+            for term in counts:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        n = len(self.documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+    def scores(self, question: str) -> list:
+        """BM25 score of every column for a question, in column order."""
+        query_terms = set(text_terms(question))
+        scores = []
+        for doc, counts in zip(self.documents, self.term_counts):
+            score = 0.0
+            for term in query_terms:
+                tf = counts.get(term)
+                if tf:
+                    norm = tf + self.k1 * (1 - self.b + self.b * len(doc) / self.average_length)
+                    score += self.idf[term] * tf * (self.k1 + 1) / norm
+            scores.append(score)
+        return scores
+
+    def select(self, question: str, k: int = SCHEMA_TOP_K) -> list:
+        """The k most relevant columns plus SCHEMA_ALWAYS_INCLUDE, in table order.
+        
+        If too few columns match, the documented IMPORTANT_COLUMNS fill the
+        selection so the model still sees the core schema.
+        """
+        scores = self.scores(question)
+        always = {name.lower() for name in SCHEMA_ALWAYS_INCLUDE}
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        selected = {i for i, (col_name, _) in enumerate(self.columns) if col_name.lower() in always}
+        selected.update(ranked[:k])
+        if len(selected) < SCHEMA_MIN_COLUMNS:
+            important = {name.lower() for name in IMPORTANT_COLUMNS}
+            for i, (col_name, _) in enumerate(self.columns):
+                if len(selected) >= k:
+                    break
+                if col_name.lower() in important:
+                    selected.add(i)
+        return [self.columns[i] for i in sorted(selected)]
+
+
+@lru_cache(maxsize=8)
+def _column_index_for(columns: tuple) -> ColumnIndex:
+    return ColumnIndex(list(columns))
+
+
+def select_relevant_columns(question: str, all_columns: list, k: int = SCHEMA_TOP_K) -> list:
+    """Columns to describe to the LLM for a question; the index is built once per schema version."""
+    return _column_index_for(tuple(tuple(col) for col in all_columns)).select(question, k)
+
+
+# Business rules and data relationships
+GENERATION_BUSINESS_RULES = """
+BUSINESS RULES AND DATA RELATIONSHIPS:
+
+1. AD TYPES AND SUB-TYPES:
+   - type = 'video' includes sub_types: preroll, midroll, video_paused_ad, native, bumper, 
+   - type = 'display' includes sub_types: cube, article, monster, jambo, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast
+   - When querying for a specific ad format (e.g., "native ads"), always filter by BOTH type AND sub_type
+
+2. VISIT COUNTING:
+   - Use COUNT(DISTINCT calculated_visit_id) for visit counts
+
+3. USER COUNTING:
+   - user_id is device-dependent, meaning the same person on different devices will have different user_ids
+   - For unique user counts, use COUNT(DISTINCT user_id)
+
+4. VIDEO PLAY ANALYSIS:
+   - play_id stays constant for an entire video viewing session
+   - action = 'start' indicates video play started
+   - action = 'complete' indicates video was watched to completion
+   - To calculate completion rate: COUNT(action='complete') / COUNT(action='start')
+   - To calculate the play duration for each play_id you need to sum play_time_from_last_event across the play_id. Relevant for play events only
+
+5. SITES:
+   - SITE values: 'mako', 'n12', '12plus', 'v1'
+   - These are different properties/brands under Keshet Media Group
+"""
+
+FIX_BUSINESS_RULES = """
+BUSINESS RULES AND DATA RELATIONSHIPS:
+
+1. AD TYPES AND SUB-TYPES:
+   - type = 'video' includes sub_types: preroll, midroll, video_paused_ad
+   - type = 'display' includes sub_types: cube, article, monster, jambo, native, parallax, standard, full_screen, prime, banner, ozen, poster, inboard, coast2coast
+   - When querying for a specific ad format (e.g., "native ads"), always filter by BOTH type AND sub_type
+
+2. VISIT COUNTING:
+   - To count visits/sessions, use: SUM(visit_first_event) or COUNT(*) WHERE visit_first_event = 1
+   - Do NOT use COUNT(DISTINCT calculated_visit_id) for visit counts, use visit_first_event instead
+
+3. USER COUNTING:
+   - user_id is device-dependent, meaning the same person on different devices will have different user_ids
+   - For unique user counts, use COUNT(DISTINCT user_id)
+
+4. VIDEO PLAY ANALYSIS:
+   - play_id stays constant for an entire video viewing session
+   - action = 'start' indicates video play started
+   - action = 'complete' indicates video was watched to completion
+   - To calculate completion rate: COUNT(action='complete') / COUNT(action='start')
+
+5. SITES:
+   - SITE values: 'mako', 'n12', '12plus', 'v1'
+   - These are different properties/brands under Keshet Media Group
+"""
+
+
+@lru_cache(maxsize=16)
+def build_generation_prompt(schema_description: str) -> str:
+    """Static system prompt for SQL generation.
+    
+    Everything that changes per request (question, default date, row limit)
+    goes in the user message instead, and the schema, which varies with
+    schema pruning, comes last. The rules before it are byte-identical
+    across calls and can be served from the provider's prompt cache.
+    """
+    return f"""You are a Snowflake SQL expert. Generate SQL queries based on natural language questions.
+
+Table: {TABLE_NAME}
+
+{GENERATION_BUSINESS_RULES}
+
+QUERY RULES:
+1. Always use the exact table name: {TABLE_NAME}
+2. CRITICAL: Always filter by a date range. Default to date = <yesterday> using the "Yesterday" date given with the question, unless the user specifies a different date range. Every query MUST have a date filter.
+3. Always add LIMIT <row limit> at the end, using the "Row limit" given with the question, unless the user specifies a different limit
+4. Use ONLY SELECT statements. Never use INSERT, UPDATE, DELETE, DROP, CREATE, ALTER, or any other modifying statements.
+5. Use valid Snowflake SQL syntax
+6. Column names are case-insensitive in Snowflake but preserve the case as shown in the schema
+7. Apply the business rules above when constructing queries
+8. IMPORTANT: Format the SQL query with proper line breaks for readability:
+   - SELECT clause on its own line(s)
+   - FROM clause on its own line
+   - WHERE clause on its own line
+   - GROUP BY on its own line (if used)
+   - ORDER BY on its own line (if used)
+   - LIMIT on its own line
+
+Example format:
+SELECT 
+    column1,
+    column2,
+    COUNT(*) as count
+FROM table_name
+WHERE date = '2024-01-01'
+GROUP BY column1, column2
+ORDER BY count DESC
+LIMIT 100
+
+Respond in JSON format:
+{{
+    "sql": "YOUR SQL QUERY HERE with proper newlines using \\n",
+    "explanation": "A brief, clear explanation of what this query does and why you structured it this way"
+}}
+
+Schema (columns relevant to the question; the table may have more):
+{schema_description}
+"""
+
+
+@lru_cache(maxsize=16)
+def build_fix_prompt(schema_description: str) -> str:
+    """Static system prompt for fixing a failed query (see build_generation_prompt).
+    
+    The failed SQL and its error go in the user message; the schema comes
+    last, so the rules and instructions before it are a stable prefix.
+    """
+    return f"""You are a Snowflake SQL expert. A query failed and you need to fix it.
+
+Table: {TABLE_NAME}
+
+{FIX_BUSINESS_RULES}
+
+Rules:
+1. Fix the SQL to resolve the error
+2. Keep the original intent of the query
+3. Always include a date filter (default: date = the "Yesterday" date given with the failed query)
+4. Always add LIMIT with the "Row limit" given with the failed query
+5. Use ONLY SELECT statements
+6. Apply the business rules above
+7. Format the SQL query with proper line breaks:
+   - SELECT clause on its own line(s)
+   - FROM clause on its own line
+   - WHERE clause on its own line
+   - GROUP BY on its own line (if used)
+   - ORDER BY on its own line (if used)
+   - LIMIT on its own line
+
+Respond in JSON format:
+{{
+    "sql": "YOUR FIXED SQL QUERY HERE with proper newlines using \\n",
+    "explanation": "What was wrong and how you fixed it"
+}}
+
+Schema:
+{schema_description}
+"""
+
+
+@lru_cache(maxsize=None)
+def get_openai_client():
+    """Process-wide OpenAI client, so HTTP connections are reused across calls."""
+    return openai.OpenAI(api_key=get_secrets()["OPENAI_API_KEY"])
+
+
+_prompt_usage = threading.local()
+
+
+@lru_cache(maxsize=None)
+def get_prompt_usage_log() -> deque:
+    """Token usage of recent LLM calls across all sessions."""
+    return deque(maxlen=1000)
+
+
+def record_prompt_usage(kind: str, system_prompt: str, usage) -> dict:
+    """Record token counts for one LLM call.
+    
+    The record is appended to the shared log and kept as the calling
+    thread's last usage (see last_prompt_usage).
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    record = {
+        "kind": kind,
+        "timestamp": time.time(),
+        "prefix_hash": hash_text(system_prompt),
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "cached_prompt_tokens": getattr(details, "cached_tokens", None) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+    }
+    get_prompt_usage_log().append(record)
+    _prompt_usage.last = record
+    return record
+
+
+def last_prompt_usage() -> Optional[dict]:
+    """Token usage of the last LLM call made by this thread (None if it was served from cache)."""
+    return getattr(_prompt_usage, "last", None)
+
+
+class JsonFieldStream:
+    """Incremental parser for a streamed flat JSON object of string fields.
+    
+    Fed the completion text chunk by chunk, it reports each field as soon
+    as its closing quote arrives, and exposes the partial value of the
+    field still being streamed.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.current_key = None
+        self._state = "object"  # object, key, colon, value, string
+        self._buffer = []
+        self._escaped = False
+        self._reading_key = False
+
+    def feed(self, text: str) -> list:
+        """Consume a chunk; returns the keys completed by it."""
+        completed = []
+        for char in text:
+            if self._state == "string":
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    value = json.loads('"' + "".join(self._buffer) + '"')
+                    self._buffer = []
+                    if self._reading_key:
+                        self.current_key = value
+                        self._state = "colon"
+                    else:
+                        self.fields[self.current_key] = value
+                        completed.append(self.current_key)
+                        self.current_key = None
+                        self._state = "object"
+                    continue
+                self._buffer.append(char)
+            elif char == '"':
+                self._reading_key = self._state == "object"
+                self._state = "string"
+            elif char == ":" and self._state == "colon":
+                self._state = "value"
+        return completed
+
+    def partial(self, key: str) -> Optional[str]:
+        """Value of a field so far: complete, partially streamed, or None if not started."""
+        if key in self.fields:
+            return self.fields[key]
+        if self.current_key == key and self._state == "string" and not self._reading_key:
+            raw = "".join(self._buffer)
+            if self._escaped:
+                raw = raw[:-1]
+            try:
+                return json.loads('"' + raw + '"')
+            except ValueError:
+                # A \uXXXX escape cut mid-way; show the text before it
+                return json.loads('"' + raw[:raw.rfind("\\")] + '"')
+        return None
+
+
+def generate_sql(user_question: str, schema_description: str, limit: int,
+                 on_sql: Optional[Callable[[str], None]] = None,
+                 on_explanation: Optional[Callable[[str], None]] = None,
+                 schema_key: Optional[str] = None) -> Tuple[str, str]:
+    """Generate SQL and explanation, reusing cached answers for repeated questions.
+    
+    With OPENAI_STREAMING, on_sql is called as soon as the SQL is complete
+    and on_explanation with the explanation text so far as it streams in.
+    Cached answers are scoped by schema_key (see get_schema_key), which
+    should identify the full schema when schema_description is pruned per
+    question; it defaults to a hash of schema_description.
+    """
+    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    _prompt_usage.last = None
+    if schema_key is None:
+        schema_key = hash_text(schema_description)
+    
+    cache = get_sql_cache()
+    with trace_span("sql_cache_lookup") as span:
+        cached = cache.get(user_question, schema_key, limit, yesterday)
+        span["hit"] = cached is not None
+    if cached:
+        if on_sql:
+            on_sql(cached[0])
+        return cached
+    
+    if OPENAI_STREAMING:
+        sql, explanation = stream_sql_generation(user_question, schema_description, limit, yesterday,
+                                                 on_sql, on_explanation)
+    else:
+        sql, explanation = request_sql_generation(user_question, schema_description, limit, yesterday)
+        if on_sql:
+            on_sql(sql)
+    
+    is_safe, _ = validate_sql_safety(sql)
+    if is_safe:
+        cache.put(user_question, schema_key, limit, yesterday, sql, explanation)
+    
+    return sql, explanation
+
+
+def request_sql_generation(user_question: str, schema_description: str, limit: int, yesterday: str) -> Tuple[str, str]:
+    """Generate SQL and explanation from natural language using OpenAI."""
+    with trace_span("prompt_build"):
+        system_prompt = build_generation_prompt(schema_description)
+    user_message = f"""Yesterday: {yesterday}
+Row limit: {limit}
+
+Question: {user_question}"""
+    
+    with trace_span("openai", model=OPENAI_MODEL) as span:
+        response = get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        usage = record_prompt_usage("generate", system_prompt, response.usage)
+        span.update(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+    
+    result = json.loads(response.choices[0].message.content)
+    return result.get("sql", ""), result.get("explanation", "")
+
+
+def stream_sql_generation(user_question: str, schema_description: str, limit: int, yesterday: str,
+                          on_sql: Optional[Callable[[str], None]] = None,
+                          on_explanation: Optional[Callable[[str], None]] = None) -> Tuple[str, str]:
+    """Streaming variant of request_sql_generation.
+    
+    The prompt asks for "sql" before "explanation", so the SQL is usually
+    complete well before the response is.
+    """
+    with trace_span("prompt_build"):
+        system_prompt = build_generation_prompt(schema_description)
+    user_message = f"""Yesterday: {yesterday}
+Row limit: {limit}
+
+Question: {user_question}"""
+    
+    with trace_span("openai", model=OPENAI_MODEL, streaming=True) as span:
+        started = time.perf_counter()
+        stream = get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=0,
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        
+        parser = JsonFieldStream()
+        content = []
+        usage = None
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            text = chunk.choices[0].delta.content
+            content.append(text)
+            completed = parser.feed(text)
+            if "sql" in completed:
+                span["sql_ready_seconds"] = time.perf_counter() - started
+                if on_sql:
+                    on_sql(parser.fields["sql"])
+            if on_explanation and (parser.current_key == "explanation" or "explanation" in completed):
+                on_explanation(parser.partial("explanation") or "")
+        record = record_prompt_usage("generate", system_prompt, usage)
+        span.update(prompt_tokens=record["prompt_tokens"], completion_tokens=record["completion_tokens"])
+    
+    # The full text is authoritative; the incremental parser only drives early callbacks
+    result = json.loads("".join(content))
+    sql = result.get("sql", "")
+    if on_sql and "sql" not in parser.fields:
+        on_sql(sql)
+    return sql, result.get("explanation", "")
+
+
+def fix_failed_query(original_question: str, failed_sql: str, error_message: str, schema_description: str, limit: int) -> Tuple[str, str]:
+    """Attempt to fix a failed query."""
+    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    with trace_span("prompt_build"):
+        system_prompt = build_fix_prompt(schema_description)
+    user_message = f"""Yesterday: {yesterday}
+Row limit: {limit}
+
+Original question: {original_question}
+
+Failed SQL:
+{failed_sql}
+
+Error message:
+{error_message}
+
+Please fix this query"""
+    
+    with trace_span("openai", model=OPENAI_MODEL, kind="fix") as span:
+        response = get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        usage = record_prompt_usage("fix", system_prompt, response.usage)
+        span.update(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+    
+    result = json.loads(response.choices[0].message.content)
+    return result.get("sql", ""), result.get("explanation", "")
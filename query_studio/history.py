@@ -0,0 +1,153 @@
+"""Persistent per-user query history and favorites (SQLite)."""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from .config import CACHE_DIR, HISTORY_MAX_ENTRIES_PER_USER, HISTORY_PAGE_SIZE
+from .caching import canonicalize_sql, hash_text, normalize_question
+
+
+class QueryHistoryStore:
+    """Persistent per-user query history and favorites.
+    
+    History rows carry execution metadata (duration, rows, bytes scanned)
+    and are searchable by question and SQL through an FTS5 index, with a
+    LIKE fallback when SQLite was built without FTS5. Each user keeps at
+    most max_entries history rows.
+    """
+
+    def __init__(self, path: str, max_entries: int = HISTORY_MAX_ENTRIES_PER_USER):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                user TEXT NOT NULL,
+                question TEXT NOT NULL,
+                question_norm TEXT NOT NULL,
+                sql TEXT NOT NULL,
+                explanation TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                duration_seconds REAL,
+                total_rows INTEGER,
+                bytes_scanned INTEGER,
+                query_id TEXT,
+                from_cache INTEGER NOT NULL DEFAULT 0,
+                rollup TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_user_created ON history (user, created_at);
+            CREATE INDEX IF NOT EXISTS idx_history_question_norm ON history (question_norm);
+            
+            CREATE TABLE IF NOT EXISTS favorites (
+                id INTEGER PRIMARY KEY,
+                user TEXT NOT NULL,
+                sql_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                question_norm TEXT NOT NULL,
+                sql TEXT NOT NULL,
+                explanation TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                UNIQUE (user, sql_key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_favorites_question_norm ON favorites (question_norm);
+        """)
+        try:
+            self._db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                    question, sql, content='history', content_rowid='id'
+                );
+                CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts (rowid, question, sql) VALUES (new.id, new.question, new.sql);
+                END;
+                CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, question, sql)
+                    VALUES ('delete', old.id, old.question, old.sql);
+                END;
+            """)
+            self.full_text = True
+        except sqlite3.OperationalError:
+            self.full_text = False
+        self._db.commit()
+
+    def add(self, user: str, question: str, sql: str, explanation: str, meta: Optional[dict] = None,
+            duration_seconds: Optional[float] = None, bytes_scanned: Optional[int] = None) -> int:
+        """Record an executed query and trim the user's oldest entries; returns the new row ID."""
+        meta = meta or {}
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO history (user, question, question_norm, sql, explanation, created_at, duration_seconds, "
+                "total_rows, bytes_scanned, query_id, from_cache, rollup) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user, question, normalize_question(question), sql, explanation or "", time.time(), duration_seconds,
+                 meta.get("total_rows"), bytes_scanned, meta.get("query_id"), int(bool(meta.get("from_cache"))),
+                 meta.get("rollup"))
+            )
+            self._db.execute(
+                "DELETE FROM history WHERE user = ? AND id NOT IN "
+                "(SELECT id FROM history WHERE user = ? ORDER BY created_at DESC LIMIT ?)",
+                (user, user, self.max_entries)
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def _search_clause(self, search: Optional[str]) -> Tuple[str, tuple]:
+        terms = re.findall(r"\w+", search or "")
+        if not terms:
+            return "", ()
+        if self.full_text:
+            match = " ".join(f'"{term}"*' for term in terms)
+            return " AND id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)", (match,)
+        clause = "".join(" AND (question LIKE ? OR sql LIKE ?)" for _ in terms)
+        return clause, tuple(value for term in terms for value in (f"%{term}%", f"%{term}%"))
+
+    def page(self, user: str, offset: int = 0, limit: int = HISTORY_PAGE_SIZE, search: Optional[str] = None) -> list:
+        """Most recent history entries first, optionally filtered by a full-text search."""
+        clause, params = self._search_clause(search)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM history WHERE user = ?{clause} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (user, *params, limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, user: str, search: Optional[str] = None) -> int:
+        clause, params = self._search_clause(search)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM history WHERE user = ?{clause}", (user, *params)).fetchone()[0]
+
+    def add_favorite(self, user: str, question: str, sql: str, explanation: str) -> bool:
+        """Star a query; returns False if the user already has it (matched by canonical SQL)."""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO favorites (user, sql_key, question, question_norm, sql, explanation, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user, hash_text(canonicalize_sql(sql)), question, normalize_question(question), sql,
+                 explanation or "", time.time())
+            )
+            self._db.commit()
+            return cursor.rowcount > 0
+
+    def remove_favorite(self, user: str, favorite_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM favorites WHERE user = ? AND id = ?", (user, favorite_id))
+            self._db.commit()
+
+    def favorites(self, user: str) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM favorites WHERE user = ? ORDER BY created_at", (user,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def get_history_store() -> QueryHistoryStore:
+    """Process-wide query history store."""
+    return QueryHistoryStore(os.path.join(CACHE_DIR, "history.sqlite3"))
@@ -0,0 +1,291 @@
+"""Incremental re-execution of rolling-window aggregates from cached per-day partials."""
+
+import json
+import math
+import time
+from datetime import date, timedelta
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+
+from .config import (
+    APPROXIMATE_DISTINCT_DEFAULT, INCREMENTAL_MAX_DAYS, INCREMENTAL_MAX_PARTIAL_ROWS,
+    RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS, TABLE_NAME,
+)
+from .sql_analysis import DATE_COLUMN, analyze_sql, date_predicate_bounds, literal_int, outer_limit, parse_sql
+from .caching import canonicalize_sql, get_partial_cache, hash_text, settled_before
+from .db import execute_query_paged
+
+
+class IncrementalNotApplicable(Exception):
+    """The query can't be split into per-day partial aggregates."""
+
+
+def _output_name(expression) -> str:
+    """Name Snowflake gives the result column of a select expression."""
+    if isinstance(expression, exp.Alias):
+        identifier = expression.args["alias"]
+        return identifier.name if identifier.quoted else identifier.name.upper()
+    if isinstance(expression, exp.Column):
+        return expression.name if expression.this.quoted else expression.name.upper()
+    return expression.sql(dialect="snowflake").upper()
+
+
+def _partial_aggregate(node) -> Tuple[str, exp.Expression]:
+    """How one aggregate is computed per day and merged: (merge kind, per-day expression)."""
+    if isinstance(node, exp.Count) and isinstance(node.this, exp.Distinct):
+        if len(node.this.expressions) != 1:
+            raise IncrementalNotApplicable("COUNT(DISTINCT) over several columns")
+        column = node.this.expressions[0].sql(dialect="snowflake")
+        return "hll", sqlglot.parse_one(f"HLL_EXPORT(HLL_ACCUMULATE({column}))", read="snowflake")
+    if isinstance(node, exp.ApproxDistinct):
+        column = node.this.sql(dialect="snowflake")
+        return "hll", sqlglot.parse_one(f"HLL_EXPORT(HLL_ACCUMULATE({column}))", read="snowflake")
+    if isinstance(node, (exp.Count, exp.CountIf)):
+        return "count", node.copy()
+    if isinstance(node, exp.Sum) and not isinstance(node.this, exp.Distinct):
+        return "sum", node.copy()
+    if isinstance(node, exp.Min):
+        return "min", node.copy()
+    if isinstance(node, exp.Max):
+        return "max", node.copy()
+    raise IncrementalNotApplicable(f"Unsupported aggregate: {node.sql(dialect='snowflake')}")
+
+
+def _build_incremental_plan(root, today: date) -> dict:
+    select = root.expressions
+    dimensions, measures, outputs = [], [], []
+    for expression in select:
+        inner = expression.this if isinstance(expression, exp.Alias) else expression
+        if inner.find(exp.AggFunc) is None:
+            outputs.append((_output_name(expression), f"d{len(dimensions)}"))
+            dimensions.append(inner)
+        elif isinstance(inner, exp.AggFunc):
+            outputs.append((_output_name(expression), f"m{len(measures)}"))
+            measures.append(_partial_aggregate(inner))
+        else:
+            # Expressions over aggregates (ratios, rounding) don't merge from per-day parts
+            raise IncrementalNotApplicable(f"Aggregate inside an expression: {inner.sql(dialect='snowflake')}")
+    
+    aliases = {expression.alias.lower(): expression.this for expression in select if isinstance(expression, exp.Alias)}
+    group = root.args.get("group")
+    grouped = set()
+    for node in (group.expressions if group else []):
+        position = literal_int(node)
+        if position is not None and 1 <= position <= len(select):
+            node = select[position - 1]
+            node = node.this if isinstance(node, exp.Alias) else node
+        elif isinstance(node, exp.Column) and not node.table and node.name.lower() in aliases:
+            node = aliases[node.name.lower()]
+        grouped.add(node.sql(dialect="snowflake"))
+    if grouped != {dimension.sql(dialect="snowflake") for dimension in dimensions}:
+        raise IncrementalNotApplicable("GROUP BY must match the non-aggregate select columns")
+    
+    order = []
+    names = {name.lower(): name for name, _ in outputs}
+    expressions = {
+        (expression.this if isinstance(expression, exp.Alias) else expression).sql(dialect="snowflake"): name
+        for expression, (name, _) in zip(select, outputs)
+    }
+    for ordered in (root.args["order"].expressions if root.args.get("order") else []):
+        key = ordered.this
+        position = literal_int(key)
+        if position is not None and 1 <= position <= len(outputs):
+            name = outputs[position - 1][0]
+        elif isinstance(key, exp.Column) and not key.table and key.name.lower() in names:
+            name = names[key.name.lower()]
+        elif key.sql(dialect="snowflake") in expressions:
+            name = expressions[key.sql(dialect="snowflake")]
+        else:
+            raise IncrementalNotApplicable(f"Unsupported ORDER BY: {key.sql(dialect='snowflake')}")
+        order.append((name, not ordered.args.get("desc")))
+    
+    limit = None
+    if root.args.get("limit") is not None:
+        limit = outer_limit(root)
+        if limit is None:
+            raise IncrementalNotApplicable("Non-literal LIMIT")
+    
+    # Per-day partial query; the date filter is replaced by the list of days to fetch
+    where = root.args.get("where")
+    conjuncts = []
+    if where is not None:
+        conjuncts = list(where.this.flatten()) if isinstance(where.this, exp.And) else [where.this]
+    template = exp.select(
+        exp.alias_(exp.column(DATE_COLUMN), "__day", quoted=True),
+        *[exp.alias_(dimension.copy(), f"d{i}", quoted=True) for i, dimension in enumerate(dimensions)],
+        *[exp.alias_(expression, f"m{i}", quoted=True) for i, (_, expression) in enumerate(measures)],
+    ).from_(root.find(exp.Table).copy())
+    for conjunct in conjuncts:
+        if date_predicate_bounds(conjunct, today) is None:
+            template = template.where(conjunct.copy())
+    template = template.group_by(exp.column(DATE_COLUMN), *[dimension.copy() for dimension in dimensions])
+    
+    return {
+        "template": template,
+        "fingerprint": hash_text(canonicalize_sql(template.sql(dialect="snowflake"))),
+        "dimensions": [f"d{i}" for i in range(len(dimensions))],
+        "measures": {f"m{i}": kind for i, (kind, _) in enumerate(measures)},
+        "outputs": outputs,
+        "order": order,
+        "limit": limit,
+    }
+
+
+def plan_incremental(sql: str, approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Optional[dict]:
+    """Plan per-day execution of an aggregate query, or None if it doesn't decompose.
+    
+    Applies to single-table aggregates over TABLE_NAME with a simple date
+    range (open-ended ranges run through today), whose select list is grouping columns plus bare COUNT,
+    COUNT_IF, SUM, MIN, MAX or distinct-count aggregates. Distinct counts
+    become HyperLogLog estimates, so exact ones are only planned when
+    approximate is set. ORDER BY and LIMIT are applied locally after merging.
+    """
+    analysis = analyze_sql(sql)
+    first_day, last_day = analysis["date_range"]
+    if not analysis["is_read_only"] or not analysis["date_predicates_simple"] or first_day is None:
+        return None
+    if analysis["counts_distinct"] and not approximate:
+        return None
+    # An open-ended range ("last 5 days") runs through today
+    last_day = last_day or date.today()
+    if first_day > last_day or (last_day - first_day).days >= INCREMENTAL_MAX_DAYS:
+        return None
+    
+    root = parse_sql(sql)[0]
+    if (not isinstance(root, exp.Select) or root.args.get("with") or root.args.get("joins")
+            or root.args.get("having") or root.args.get("qualify") or root.args.get("offset")
+            or root.args.get("distinct") or root.find(exp.Subquery) or root.find(exp.Window)
+            or root.find(exp.AggFunc) is None):
+        return None
+    tables = list(root.find_all(exp.Table))
+    if len(tables) != 1 or tables[0].name.lower() != TABLE_NAME.split(".")[-1]:
+        return None
+    
+    try:
+        plan = _build_incremental_plan(root, date.today())
+    except IncrementalNotApplicable:
+        return None
+    plan["days"] = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    plan["approximate"] = analysis["counts_distinct"]
+    return plan
+
+
+def merge_hll_exports(values) -> Optional[np.ndarray]:
+    """Union HLL_EXPORT states (JSON objects) into one register array by taking register-wise maxima."""
+    registers = None
+    for value in values:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        state = json.loads(value) if isinstance(value, str) else value
+        if registers is None:
+            registers = np.zeros(1 << state["precision"], dtype=np.int64)
+        if "dense" in state:
+            np.maximum(registers, np.asarray(state["dense"], dtype=np.int64), out=registers)
+        else:
+            indices = np.asarray(state["sparse"]["indices"], dtype=np.int64)
+            counts = np.asarray(state["sparse"]["maxLzCounts"], dtype=np.int64)
+            np.maximum.at(registers, indices, counts)
+    return registers
+
+
+def hll_estimate(registers: Optional[np.ndarray]) -> int:
+    """Cardinality estimate from HLL registers, with the small-range linear counting correction."""
+    if registers is None:
+        return 0
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.power(2.0, -registers))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+_PARTIAL_MERGES = {
+    "count": lambda values: values.sum(),
+    "sum": lambda values: values.sum(min_count=1),
+    "min": lambda values: values.min(),
+    "max": lambda values: values.max(),
+    "hll": lambda values: hll_estimate(merge_hll_exports(values)),
+}
+
+
+def merge_partials(parts: list, plan: dict) -> pd.DataFrame:
+    """Combine per-day partial aggregates into the result the original query would return."""
+    columns = plan["dimensions"] + list(plan["measures"])
+    frames = [part for part in parts if len(part)]
+    combined = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    merges = {column: _PARTIAL_MERGES[kind] for column, kind in plan["measures"].items()}
+    
+    if plan["dimensions"]:
+        merged = combined.groupby(plan["dimensions"], dropna=False, sort=False).agg(merges).reset_index()
+    else:
+        # A global aggregate returns one row even when no day has any rows
+        merged = pd.DataFrame([{column: merge(combined[column]) for column, merge in merges.items()}])
+    
+    merged = merged[[column for _, column in plan["outputs"]]]
+    merged.columns = [name for name, _ in plan["outputs"]]
+    if plan["order"]:
+        merged = merged.sort_values([name for name, _ in plan["order"]],
+                                    ascending=[ascending for _, ascending in plan["order"]], na_position="last")
+    if plan["limit"] is not None:
+        merged = merged.head(plan["limit"])
+    return merged.reset_index(drop=True)
+
+
+def execute_incremental(sql: str, plan: dict) -> Tuple[pd.DataFrame, dict]:
+    """Run a planned query, reusing cached per-day partials for settled days.
+    
+    Only days without a cached partial (and the last LATE_DATA_DAYS days,
+    which still receive late events) are queried, in one statement grouped
+    by day. Raises IncrementalNotApplicable when the partials would hold
+    more than INCREMENTAL_MAX_PARTIAL_ROWS rows; run the query as a whole
+    then.
+    """
+    cache = get_partial_cache()
+    closed_before = settled_before()
+    partial_key = lambda day: f"{plan['fingerprint']} {day.isoformat()}"
+    
+    parts, missing = [], []
+    for day in plan["days"]:
+        cached = cache.get(partial_key(day)) if day < closed_before else None
+        if cached is None:
+            missing.append(day)
+        else:
+            parts.append(cached[0])
+    cached_rows = sum(len(part) for part in parts)
+    if cached_rows > INCREMENTAL_MAX_PARTIAL_ROWS:
+        raise IncrementalNotApplicable(f"Cached partials hold {cached_rows:,} rows")
+    
+    if missing:
+        partial_sql = plan["template"].where(
+            exp.column(DATE_COLUMN).isin(*[exp.Literal.string(day.isoformat()) for day in missing]), copy=True
+        ).sql(dialect="snowflake")
+        fresh, fresh_meta = execute_query_paged(partial_sql, max_rows=INCREMENTAL_MAX_PARTIAL_ROWS - cached_rows)
+        if fresh_meta["truncated"]:
+            raise IncrementalNotApplicable(f"Partials hold more than {INCREMENTAL_MAX_PARTIAL_ROWS:,} rows")
+        fresh_days = pd.to_datetime(fresh["__day"]).dt.date
+        fresh = fresh.drop(columns="__day")
+        for day in missing:
+            if day < closed_before:
+                cache.put(partial_key(day), fresh[fresh_days == day].reset_index(drop=True),
+                          ttl_seconds=RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS)
+        parts.append(fresh)
+    
+    df = merge_partials(parts, plan)
+    meta = {
+        "query_id": None,
+        "result_id": hash_text(f"{sql}|{time.time()}"),
+        "total_rows": len(df),
+        "truncated": False,
+        "from_cache": False,
+        "approximate": plan["approximate"],
+        "incremental": {
+            "days": len(plan["days"]),
+            "days_queried": len(missing),
+        },
+    }
+    return df, meta
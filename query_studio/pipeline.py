@@ -0,0 +1,161 @@
+"""Question to result, outside the UI: generation with concurrent checks, and cached execution."""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+
+from .config import APPROXIMATE_DISTINCT_DEFAULT, ROLLUPS_ENABLED, SCHEMA_PRUNING_ENABLED, SNOWFLAKE_POOL_SIZE
+from .tracing import in_current_context, trace_span, traced
+from .sql_analysis import validate_sql_safety
+from .caching import get_result_cache, result_cache_mode
+from .db import estimate_query_cost, execute_query_paged
+from .incremental import IncrementalNotApplicable, execute_incremental, plan_incremental
+from .rollups import resolve_execution_sql, rollup_estimates_distinct_counts
+from .generation import generate_sql, get_schema_description, get_schema_key, select_relevant_columns
+
+
+_sql_checks = threading.local()
+
+
+@lru_cache(maxsize=None)
+def get_check_executor() -> ThreadPoolExecutor:
+    """Worker threads that validate and EXPLAIN SQL while the LLM is still streaming."""
+    return ThreadPoolExecutor(max_workers=SNOWFLAKE_POOL_SIZE, thread_name_prefix="sql-check")
+
+
+@traced()
+def check_sql(sql: str, use_rollups: bool = ROLLUPS_ENABLED, approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> dict:
+    """Safety validation plus, for safe SQL, the cost estimate of what will actually run.
+    
+    The estimate is for the SQL after rollup routing (see resolve_execution_sql).
+    """
+    is_safe, safety_msg = validate_sql_safety(sql)
+    execution_sql = resolve_execution_sql(sql, use_rollups, approximate)[0] if is_safe else None
+    return {
+        "sql": sql,
+        "use_rollups": use_rollups,
+        "approximate": approximate,
+        "is_safe": is_safe,
+        "safety_msg": safety_msg,
+        "execution_sql": execution_sql,
+        "cost_info": estimate_query_cost(execution_sql) if is_safe else None,
+    }
+
+
+def generate_checked_sql(question: str, all_columns: list, limit: int,
+                         on_sql: Optional[Callable[[str], None]] = None,
+                         on_explanation: Optional[Callable[[str], None]] = None,
+                         use_rollups: bool = ROLLUPS_ENABLED,
+                         approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Tuple[str, str, bool, str]:
+    """Generate SQL for a question and check that it is safe to run.
+    
+    Returns (sql, explanation, is_safe, safety_message). Checks (see
+    check_sql) start in the background as soon as the SQL is complete; the
+    finished checks are available from last_sql_checks().
+    """
+    # Cached SQL is scoped to the full schema, so rephrasings that select different columns share it
+    schema_key = get_schema_key(all_columns)
+    with trace_span("schema_prune", columns=len(all_columns)) as span:
+        if SCHEMA_PRUNING_ENABLED:
+            all_columns = select_relevant_columns(question, all_columns)
+        schema_description = get_schema_description(all_columns)
+        span["selected_columns"] = len(all_columns)
+    
+    checks = {}
+    
+    def start_checks(sql):
+        checks["future"] = get_check_executor().submit(in_current_context(check_sql), sql, use_rollups, approximate)
+        if on_sql:
+            on_sql(sql)
+    
+    _sql_checks.last = None
+    sql, explanation = generate_sql(question, schema_description, limit, start_checks, on_explanation, schema_key)
+    future: Optional[Future] = checks.get("future")
+    result = future.result() if future is not None else check_sql(sql, use_rollups, approximate)
+    _sql_checks.last = result
+    return sql, explanation, result["is_safe"], result["safety_msg"]
+
+
+def last_sql_checks() -> Optional[dict]:
+    """Checks started by this thread's last generate_checked_sql() call (keys of check_sql)."""
+    return getattr(_sql_checks, "last", None)
+
+
+def run_pipeline(all_columns: list, limit: int, question: Optional[str] = None, sql: Optional[str] = None,
+                 use_rollups: bool = ROLLUPS_ENABLED,
+                 approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Tuple[Optional[pd.DataFrame], dict]:
+    """Run question -> SQL -> validation -> cost check -> execution without a UI.
+    
+    Either a question or ready-made SQL must be given. Returns the
+    in-memory result (None unless the run succeeded) and a report with the
+    status, SQL, result metadata and per-stage timings in seconds.
+    """
+    report = {"question": question, "sql": sql, "explanation": None, "status": "ok", "error": None,
+              "timings": {}, "meta": {}}
+    
+    def timed(stage, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            report["timings"][stage] = time.perf_counter() - started
+    
+    try:
+        if sql is None:
+            sql, explanation, is_safe, safety_msg = timed("generate", generate_checked_sql, question, all_columns, limit,
+                                                          use_rollups=use_rollups, approximate=approximate)
+            report.update(sql=sql, explanation=explanation)
+        else:
+            is_safe, safety_msg = timed("validate", validate_sql_safety, sql)
+        if not is_safe:
+            report.update(status="unsafe", error=safety_msg)
+            return None, report
+        
+        execution_sql, _ = resolve_execution_sql(sql, use_rollups, approximate)
+        cost_info = timed("estimate", estimate_query_cost, execution_sql)
+        if cost_info["blocked"]:
+            report.update(status="blocked", error=cost_info["block_reason"])
+            return None, report
+        
+        df, meta = timed("execute", execute_query_cached, sql, use_rollups, approximate=approximate)
+        report["meta"] = meta
+        return df, report
+    except Exception as e:
+        report.update(status="error", error=str(e))
+        return None, report
+
+
+def execute_query_cached(sql: str, use_rollups: bool = ROLLUPS_ENABLED, incremental: bool = False,
+                         approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Tuple[pd.DataFrame, dict]:
+    """Execute a query through the result cache.
+    
+    Returns the in-memory result and its metadata; meta["from_cache"] tells
+    whether it was served from the cache, meta["rollup"] which rollup
+    table answered it, meta["incremental"] how many days were re-queried
+    when it ran incrementally and meta["approximate"] whether distinct
+    counts are estimates.
+    """
+    cache = get_result_cache()
+    mode = result_cache_mode(use_rollups, incremental, approximate)
+    cached = cache.get(sql, mode)
+    if cached is not None:
+        df, meta = cached
+        meta["from_cache"] = True
+        return df, meta
+    execution_sql, rollup = resolve_execution_sql(sql, use_rollups, approximate)
+    plan = plan_incremental(sql, approximate) if incremental and rollup is None else None
+    if plan is not None:
+        try:
+            df, meta = execute_incremental(sql, plan)
+        except IncrementalNotApplicable:
+            plan = None
+    if plan is None:
+        df, meta = execute_query_paged(execution_sql)
+        meta["approximate"] = rollup_estimates_distinct_counts(sql, rollup)
+    meta["rollup"] = rollup
+    cache.put(sql, df, meta, mode=mode)
+    return df, meta
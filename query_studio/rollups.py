@@ -0,0 +1,214 @@
+"""Daily rollup tables and routing of covered queries to them."""
+
+from datetime import date, timedelta
+from typing import Optional, Tuple
+
+import snowflake.connector
+import sqlglot
+from sqlglot import exp
+
+from .config import (
+    APPROXIMATE_DISTINCT_DEFAULT, IMPORTANT_COLUMNS, ROLLUPS_ENABLED, ROLLUP_COVERAGE_TTL_SECONDS,
+    ROLLUP_DISTINCT_MEASURES, ROLLUP_MEASURES, ROLLUP_SCHEMA, ROLLUP_TABLES, TABLE_NAME,
+)
+from .sql_analysis import DATE_COLUMN, analyze_sql, parse_sql
+from .caching import memoize
+from .db import get_connection_pool
+
+
+class RollupNotApplicable(Exception):
+    """The query can't be answered from a rollup table."""
+
+
+def rollup_table_name(name: str) -> str:
+    return f"{ROLLUP_SCHEMA}.{name}"
+
+
+def rollup_refresh_statements(name: str, day: date) -> list:
+    """SQL statements that (re)build one day of a rollup table."""
+    dimensions = ROLLUP_TABLES[name]
+    table = rollup_table_name(name)
+    dimension_types = []
+    for dimension in dimensions:
+        info = IMPORTANT_COLUMNS.get(dimension) or IMPORTANT_COLUMNS.get(dimension.upper()) or IMPORTANT_COLUMNS.get(dimension.lower())
+        dimension_types.append(f"{dimension} {info['type'] if info else 'VARCHAR'}")
+    measure_types = ["event_count NUMBER", "visit_first_events NUMBER", "users_hll BINARY", "visits_hll BINARY"]
+    dimension_list = ", ".join(dimensions)
+    measure_list = ", ".join(ROLLUP_MEASURES.values())
+    
+    return [
+        f"CREATE SCHEMA IF NOT EXISTS {ROLLUP_SCHEMA}",
+        f"CREATE TABLE IF NOT EXISTS {table} (date DATE, {', '.join(dimension_types + measure_types)})",
+        f"CREATE TABLE IF NOT EXISTS {rollup_table_name('refresh_log')} "
+        f"(rollup_name VARCHAR, date DATE, refreshed_at TIMESTAMP_NTZ, row_count NUMBER)",
+        "BEGIN",
+        f"DELETE FROM {table} WHERE date = '{day.isoformat()}'",
+        f"INSERT INTO {table} (date, {dimension_list}, {', '.join(ROLLUP_MEASURES)}) "
+        f"SELECT date, {dimension_list}, {measure_list} FROM {TABLE_NAME} "
+        f"WHERE date = '{day.isoformat()}' GROUP BY date, {dimension_list}",
+        f"DELETE FROM {rollup_table_name('refresh_log')} WHERE rollup_name = '{name}' AND date = '{day.isoformat()}'",
+        f"INSERT INTO {rollup_table_name('refresh_log')} "
+        f"SELECT '{name}', '{day.isoformat()}', CURRENT_TIMESTAMP()::TIMESTAMP_NTZ, COUNT(*) "
+        f"FROM {table} WHERE date = '{day.isoformat()}'",
+        "COMMIT",
+    ]
+
+
+def refresh_rollups(days: list, names: Optional[list] = None):
+    """Rebuild the given days of the rollup tables (all rollups by default)."""
+    with get_connection_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            for name in names or list(ROLLUP_TABLES):
+                for day in days:
+                    for statement in rollup_refresh_statements(name, day):
+                        cursor.execute(statement)
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+
+
+@memoize(ttl=ROLLUP_COVERAGE_TTL_SECONDS)
+def get_rollup_coverage() -> dict:
+    """Days that have been refreshed, per rollup table."""
+    coverage = {name: set() for name in ROLLUP_TABLES}
+    try:
+        with get_connection_pool().connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT rollup_name, date FROM {rollup_table_name('refresh_log')}")
+                for name, day in cursor.fetchall():
+                    if name in coverage:
+                        coverage[name].add(day)
+            finally:
+                cursor.close()
+    except snowflake.connector.Error:
+        pass
+    return coverage
+
+
+def _column_name(node) -> Optional[str]:
+    return node.name.lower() if isinstance(node, exp.Column) else None
+
+
+def _rollup_aggregate(node):
+    """Rewrite one aggregate over raw events into the equivalent over rollup measures."""
+    if not isinstance(node, exp.AggFunc) or isinstance(node.parent, exp.Window):
+        return node
+    
+    if isinstance(node, exp.Count) and isinstance(node.this, exp.Star):
+        return sqlglot.parse_one("SUM(event_count)", read="snowflake")
+    
+    distinct_column = None
+    if isinstance(node, exp.Count) and isinstance(node.this, exp.Distinct) and len(node.this.expressions) == 1:
+        distinct_column = _column_name(node.this.expressions[0])
+    elif isinstance(node, exp.ApproxDistinct):
+        distinct_column = _column_name(node.this)
+    if distinct_column in ROLLUP_DISTINCT_MEASURES:
+        measure = ROLLUP_DISTINCT_MEASURES[distinct_column]
+        return sqlglot.parse_one(f"HLL_ESTIMATE(HLL_COMBINE({measure}))", read="snowflake")
+    
+    if isinstance(node, exp.Sum) and _column_name(node.this) == "visit_first_event":
+        return sqlglot.parse_one("SUM(visit_first_events)", read="snowflake")
+    
+    if isinstance(node, exp.CountIf):
+        condition = node.this.sql(dialect="snowflake")
+        return sqlglot.parse_one(f"SUM(IFF({condition}, event_count, 0))", read="snowflake")
+    
+    if isinstance(node, (exp.Min, exp.Max)) and isinstance(node.this, exp.Column):
+        return node
+    
+    raise RollupNotApplicable(f"Unsupported aggregate: {node.sql(dialect='snowflake')}")
+
+
+def _rewrite_for_rollup(root) -> Tuple[exp.Select, set]:
+    """Rewrite aggregates of a query to rollup measures.
+    
+    Returns the rewritten query and the source columns it still needs
+    (which must all be rollup dimensions).
+    """
+    rewritten = root.copy()
+    
+    new_expressions = []
+    for expression in rewritten.expressions:
+        has_aggregate = expression.find(exp.AggFunc) is not None
+        new_expression = expression.transform(_rollup_aggregate)
+        if has_aggregate and not isinstance(expression, exp.Alias):
+            # Keep the output column name the raw query would have produced
+            new_expression = exp.alias_(new_expression, expression.sql(dialect="snowflake").upper(), quoted=True)
+        new_expressions.append(new_expression)
+    rewritten.set("expressions", new_expressions)
+    for arg in ["having", "order"]:
+        if rewritten.args.get(arg) is not None:
+            rewritten.set(arg, rewritten.args[arg].transform(_rollup_aggregate))
+    
+    aliases = {expression.alias.lower() for expression in new_expressions if isinstance(expression, exp.Alias)}
+    measures = set(ROLLUP_MEASURES)
+    needed = {
+        column.name.lower() for column in rewritten.find_all(exp.Column)
+        if column.name.lower() not in measures and column.name.lower() not in aliases
+    }
+    needed.discard(DATE_COLUMN)
+    return rewritten, needed
+
+
+def route_to_rollup(sql: str, approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Optional[Tuple[str, str]]:
+    """Rewrite an aggregate query over TABLE_NAME to read a rollup table.
+    
+    Applies when the query is a single-table aggregate whose grouping and
+    filter columns are all dimensions of a rollup, whose aggregates map to
+    rollup measures, and whose closed date range has been refreshed.
+    Returns (rewritten_sql, rollup_name), or None if no rollup applies.
+    Distinct counts become HyperLogLog estimates, so queries with exact
+    ones are only routed when approximate is set.
+    """
+    analysis = analyze_sql(sql)
+    first_day, last_day = analysis["date_range"]
+    if not analysis["is_read_only"] or not analysis["date_predicates_simple"] or first_day is None or last_day is None:
+        return None
+    if analysis["counts_distinct"] and not approximate:
+        return None
+    if last_day >= date.today():
+        return None
+    
+    root = parse_sql(sql)[0]
+    if (not isinstance(root, exp.Select) or root.args.get("with") or root.args.get("joins")
+            or root.find(exp.Subquery) or root.find(exp.AggFunc) is None):
+        return None
+    tables = list(root.find_all(exp.Table))
+    if len(tables) != 1 or tables[0].name.lower() != TABLE_NAME.split(".")[-1]:
+        return None
+    
+    try:
+        rewritten, needed = _rewrite_for_rollup(root)
+    except RollupNotApplicable:
+        return None
+    
+    candidates = sorted(
+        (name for name, dimensions in ROLLUP_TABLES.items() if needed <= {d.lower() for d in dimensions}),
+        key=lambda name: len(ROLLUP_TABLES[name])
+    )
+    days = {first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)}
+    coverage = get_rollup_coverage() if candidates else {}
+    for name in candidates:
+        if days <= coverage.get(name, set()):
+            rewritten.find(exp.Table).replace(exp.to_table(rollup_table_name(name)))
+            return rewritten.sql(dialect="snowflake", pretty=True), name
+    return None
+
+
+def resolve_execution_sql(sql: str, use_rollups: bool = ROLLUPS_ENABLED,
+                          approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Tuple[str, Optional[str]]:
+    """SQL to actually run for a query, and the rollup it was routed to (if any)."""
+    if use_rollups:
+        routed = route_to_rollup(sql, approximate)
+        if routed is not None:
+            return routed
+    return sql, None
+
+
+def rollup_estimates_distinct_counts(sql: str, rollup: Optional[str]) -> bool:
+    """Whether answering sql from rollup turned its exact distinct counts into estimates."""
+    return rollup is not None and analyze_sql(sql)["counts_distinct"]
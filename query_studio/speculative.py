@@ -0,0 +1,124 @@
+"""Speculative background previews of generated SQL."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from .config import (
+    APPROXIMATE_DISTINCT_DEFAULT, COST_WARN_BYTES, PREVIEW_ROWS, QUERY_POLL_BACKOFF,
+    QUERY_POLL_MAX_INTERVAL_SECONDS, ROLLUPS_ENABLED, SPECULATIVE_PREVIEW_MAX_PER_USER,
+    SPECULATIVE_PREVIEW_POLL_SECONDS, SPECULATIVE_PREVIEW_WORKERS,
+)
+from .sql_analysis import rewrite_outer_limit
+from .caching import get_result_cache, result_cache_mode
+from .db import cancel_query, fetch_query_result, is_query_running, submit_query
+from .rollups import resolve_execution_sql, rollup_estimates_distinct_counts
+
+
+class SpeculativePreviewRunner:
+    """Runs preview queries ahead of the user clicking Preview.
+    
+    The preview is submitted asynchronously so it can be cancelled by query
+    ID, and a worker thread waits for it and stores the result in the
+    result cache, where the regular Preview path finds it. Workers poll
+    the status until the preview is done and only then check out a pool
+    connection to fetch it, so waiting previews never hold connections
+    interactive queries need. Each user may have at most max_per_user
+    previews in flight across all their sessions; further ones are simply
+    not started.
+    """
+
+    def __init__(self, max_per_user: int = SPECULATIVE_PREVIEW_MAX_PER_USER,
+                 workers: int = SPECULATIVE_PREVIEW_WORKERS):
+        self.max_per_user = max_per_user
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculative-preview")
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {"started": 0, "completed": 0, "cancelled": 0, "skipped": 0}
+
+    def start(self, user: str, sql: str, use_rollups: bool = ROLLUPS_ENABLED,
+              incremental: bool = False, approximate: bool = APPROXIMATE_DISTINCT_DEFAULT) -> Optional[dict]:
+        """Start previewing sql for a user; returns a handle, or None if over the cap or submission failed.
+        
+        The preview always runs as one query; incremental and approximate
+        only select the cache entry the Preview button will look for.
+        """
+        try:
+            preview_sql = rewrite_outer_limit(sql, PREVIEW_ROWS)
+        except Exception:
+            return None
+        mode = result_cache_mode(use_rollups, incremental, approximate)
+        if get_result_cache().get(preview_sql, mode) is not None:
+            return {"sql": sql, "preview_sql": preview_sql, "query_id": None, "future": None}
+        
+        with self._lock:
+            if self._in_flight.get(user, 0) >= self.max_per_user:
+                self._stats["skipped"] += 1
+                return None
+            self._in_flight[user] = self._in_flight.get(user, 0) + 1
+        try:
+            execution_sql, rollup = resolve_execution_sql(preview_sql, use_rollups, approximate)
+            query_id = submit_query(execution_sql)
+        except Exception:
+            self._release(user)
+            return None
+        
+        with self._lock:
+            self._stats["started"] += 1
+        future = self._executor.submit(self._collect, user, query_id, preview_sql, rollup, mode)
+        return {"sql": sql, "preview_sql": preview_sql, "query_id": query_id, "future": future}
+
+    def cancel(self, preview: dict):
+        """Abort a preview that is still running; its worker then finishes with the query's error."""
+        future = preview.get("future")
+        if future is None or future.done():
+            return
+        try:
+            cancel_query(preview["query_id"])
+            with self._lock:
+                self._stats["cancelled"] += 1
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, in_flight=sum(self._in_flight.values()))
+
+    def _collect(self, user: str, query_id: str, preview_sql: str, rollup: Optional[str], mode: str):
+        try:
+            polls = 0
+            while is_query_running(query_id):
+                time.sleep(min(SPECULATIVE_PREVIEW_POLL_SECONDS * QUERY_POLL_BACKOFF ** polls,
+                               QUERY_POLL_MAX_INTERVAL_SECONDS))
+                polls += 1
+            df, meta = fetch_query_result(query_id, max_rows=PREVIEW_ROWS)
+            meta["rollup"] = rollup
+            meta["approximate"] = rollup_estimates_distinct_counts(preview_sql, rollup)
+            get_result_cache().put(preview_sql, df, meta, mode=mode)
+            with self._lock:
+                self._stats["completed"] += 1
+        finally:
+            self._release(user)
+
+    def _release(self, user: str):
+        with self._lock:
+            self._in_flight[user] -= 1
+            if not self._in_flight[user]:
+                del self._in_flight[user]
+
+
+@lru_cache(maxsize=None)
+def get_speculative_preview_runner() -> SpeculativePreviewRunner:
+    """Speculative preview runner shared by all sessions."""
+    return SpeculativePreviewRunner()
+
+
+def speculation_allowed(cost_info: dict) -> bool:
+    """Only speculate on queries whose plan is known and under the cost warning threshold."""
+    return (
+        not cost_info.get("blocked")
+        and cost_info.get("bytes_assigned") is not None
+        and cost_info["bytes_assigned"] <= COST_WARN_BYTES
+    )
@@ -0,0 +1,257 @@
+"""SQL parsing with sqlglot: safety validation, date-range analysis and LIMIT rewriting."""
+
+import re
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+
+from .config import SQL_ANALYSIS_CACHE_SIZE
+from .tracing import traced
+
+
+DATE_COLUMN = "date"
+
+_WRITE_EXPRESSIONS = tuple(
+    getattr(exp, name) for name in [
+        "Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "TruncateTable",
+        "Grant", "Revoke", "Copy", "Command", "Use", "Set", "Transaction", "Commit", "Rollback"
+    ] if hasattr(exp, name)
+)
+
+_FLIPPED_COMPARISONS = {exp.GT: exp.LT, exp.GTE: exp.LTE, exp.LT: exp.GT, exp.LTE: exp.GTE, exp.EQ: exp.EQ}
+
+_DAYS_PER_UNIT = {"day": 1, "days": 1, "d": 1, "dd": 1, "week": 7, "weeks": 7, "w": 7, "wk": 7}
+
+
+@lru_cache(maxsize=SQL_ANALYSIS_CACHE_SIZE)
+def parse_sql(sql: str) -> tuple:
+    """Parse SQL into Snowflake-dialect syntax trees.
+    
+    Trees are cached and shared, so callers must copy() before modifying them.
+    """
+    return tuple(statement for statement in sqlglot.parse(sql, read="snowflake") if statement is not None)
+
+
+def is_date_column(node) -> bool:
+    return isinstance(node, exp.Column) and node.name.lower() == DATE_COLUMN
+
+
+def literal_int(node) -> Optional[int]:
+    if isinstance(node, exp.Neg):
+        value = literal_int(node.this)
+        return -value if value is not None else None
+    if isinstance(node, exp.Literal) and not node.is_string:
+        try:
+            return int(node.this)
+        except ValueError:
+            return None
+    return None
+
+
+def resolve_date(node, today: date) -> Tuple[Optional[date], bool]:
+    """Resolve a date expression to a day.
+    
+    Handles literals, casts, CURRENT_DATE and day/week offsets from it.
+    Returns (day, relative) where relative tells whether the day depends on
+    the current date; day is None if the expression can't be resolved.
+    """
+    if isinstance(node, (exp.Paren, exp.Cast, exp.TryCast, exp.TsOrDsToDate, exp.StrToDate)):
+        return resolve_date(node.this, today)
+    if isinstance(node, exp.Literal) and node.is_string:
+        try:
+            return date.fromisoformat(node.this[:10]), False
+        except ValueError:
+            return None, False
+    if isinstance(node, (exp.CurrentDate, exp.CurrentTimestamp)):
+        return today, True
+    if isinstance(node, (exp.DateAdd, exp.DateSub)):
+        base, _ = resolve_date(node.this, today)
+        amount = literal_int(node.expression)
+        days_per_unit = _DAYS_PER_UNIT.get(node.text("unit").lower() or "day")
+        if base is None or amount is None or days_per_unit is None:
+            return None, True
+        sign = -1 if isinstance(node, exp.DateSub) else 1
+        return base + timedelta(days=sign * amount * days_per_unit), True
+    if isinstance(node, (exp.Add, exp.Sub)):
+        base, relative = resolve_date(node.this, today)
+        amount = literal_int(node.expression)
+        if base is None or amount is None:
+            return None, relative
+        sign = -1 if isinstance(node, exp.Sub) else 1
+        return base + timedelta(days=sign * amount), relative
+    return None, False
+
+
+def date_predicate_bounds(node, today: date) -> Optional[dict]:
+    """Bounds implied by a single predicate on the date column, or None if it isn't one."""
+    if isinstance(node, exp.Between):
+        if not is_date_column(node.this):
+            return None
+        low, low_relative = resolve_date(node.args["low"], today)
+        high, high_relative = resolve_date(node.args["high"], today)
+        return {"lower": low, "upper": high, "relative": low_relative or high_relative,
+                "resolved": low is not None and high is not None}
+    
+    if isinstance(node, exp.In):
+        if not is_date_column(node.this) or not node.expressions:
+            return None
+        days = [resolve_date(value, today) for value in node.expressions]
+        resolved = [day for day, _ in days if day is not None]
+        complete = len(resolved) == len(days)
+        return {"lower": min(resolved) if complete else None, "upper": max(resolved) if complete else None,
+                "relative": any(relative for _, relative in days), "resolved": complete}
+    
+    comparison = type(node)
+    left, right = node.this, node.expression
+    if is_date_column(right) and not is_date_column(left):
+        left, right, comparison = right, left, _FLIPPED_COMPARISONS[comparison]
+    if not is_date_column(left):
+        return None
+    day, relative = resolve_date(right, today)
+    bounds = {"lower": None, "upper": None, "relative": relative, "resolved": day is not None}
+    if day is not None:
+        if comparison in (exp.EQ, exp.GTE):
+            bounds["lower"] = day
+        elif comparison is exp.GT:
+            bounds["lower"] = day + timedelta(days=1)
+        if comparison in (exp.EQ, exp.LTE):
+            bounds["upper"] = day
+        elif comparison is exp.LT:
+            bounds["upper"] = day - timedelta(days=1)
+    return bounds
+
+
+def _analyze_date_filter(root, today: date) -> dict:
+    """Date range selected by the outermost WHERE clause.
+    
+    The range is only reported as "simple" when every date predicate in the
+    query is an AND-ed condition of the outer WHERE, so the range is exact.
+    """
+    predicates = [
+        bounds for node in root.find_all(exp.EQ, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between, exp.In)
+        if (bounds := date_predicate_bounds(node, today)) is not None
+    ]
+    
+    where = root.args.get("where")
+    conjuncts = []
+    if where is not None:
+        conjuncts = list(where.this.flatten()) if isinstance(where.this, exp.And) else [where.this]
+    outer = [bounds for node in conjuncts if (bounds := date_predicate_bounds(node, today)) is not None]
+    
+    lowers = [b["lower"] for b in outer if b["lower"] is not None]
+    uppers = [b["upper"] for b in outer if b["upper"] is not None]
+    return {
+        "has_date_predicate": bool(predicates),
+        "date_range": (max(lowers) if lowers else None, min(uppers) if uppers else None),
+        "date_is_relative": any(b["relative"] for b in predicates),
+        "date_predicates_simple": bool(predicates) and len(outer) == len(predicates) and all(b["resolved"] for b in outer),
+    }
+
+
+def outer_limit(root) -> Optional[int]:
+    limit = root.args.get("limit")
+    if limit is None:
+        return None
+    return literal_int(limit.expression)
+
+
+@lru_cache(maxsize=SQL_ANALYSIS_CACHE_SIZE)
+def _analyze_sql(sql: str, today: date) -> dict:
+    analysis = {
+        "parse_error": None,
+        "statement_count": 0,
+        "is_read_only": False,
+        "forbidden": None,
+        "tables": [],
+        "has_date_predicate": False,
+        "date_range": (None, None),
+        "date_is_relative": False,
+        "date_predicates_simple": False,
+        "outer_limit": None,
+        "counts_distinct": False,
+    }
+    try:
+        statements = parse_sql(sql)
+    except sqlglot.errors.SqlglotError as e:
+        analysis["parse_error"] = str(e)
+        return analysis
+    
+    analysis["statement_count"] = len(statements)
+    for statement in statements:
+        forbidden = statement if isinstance(statement, _WRITE_EXPRESSIONS) else statement.find(*_WRITE_EXPRESSIONS)
+        if forbidden is not None:
+            kind = forbidden.name if isinstance(forbidden, exp.Command) else type(forbidden).__name__
+            analysis["forbidden"] = kind.upper()
+            return analysis
+    if len(statements) != 1 or not isinstance(statements[0], exp.Query):
+        return analysis
+    
+    root = statements[0]
+    cte_names = {cte.alias_or_name.lower() for cte in root.find_all(exp.CTE)}
+    analysis["is_read_only"] = True
+    analysis["tables"] = sorted({
+        table.sql(dialect="snowflake").lower() for table in root.find_all(exp.Table)
+        if table.name.lower() not in cte_names
+    })
+    analysis["outer_limit"] = outer_limit(root)
+    analysis["counts_distinct"] = any(isinstance(node.this, exp.Distinct) for node in root.find_all(exp.Count))
+    analysis.update(_analyze_date_filter(root, today))
+    return analysis
+
+
+def analyze_sql(sql: str) -> dict:
+    """Parse a query once and describe it.
+    
+    Reports whether it is a single read-only query, the tables it reads,
+    the date range selected by its outer WHERE clause, the outer LIMIT and
+    whether it has exact COUNT(DISTINCT) aggregates.
+    Results are cached per SQL string (and day, since relative dates such
+    as CURRENT_DATE resolve differently each day); treat them as read-only.
+    """
+    return _analyze_sql(sql, date.today())
+
+
+def rewrite_outer_limit(sql: str, limit: int) -> str:
+    """Cap the outermost LIMIT of a query, leaving subqueries and CTEs untouched."""
+    statements = parse_sql(sql)
+    if len(statements) != 1 or not isinstance(statements[0], exp.Query):
+        raise ValueError("Expected a single query")
+    root = statements[0]
+    current = outer_limit(root)
+    new_limit = limit if current is None else min(current, limit)
+    return root.copy().limit(new_limit).sql(dialect="snowflake", pretty=True)
+
+
+@traced("validate_sql")
+def validate_sql_safety(sql: str) -> Tuple[bool, str]:
+    """Validate that SQL is safe (a single read-only query)."""
+    analysis = analyze_sql(sql)
+    if analysis["parse_error"]:
+        # Snowflake syntax the parser doesn't know; fall back to the stricter keyword check
+        return validate_sql_keywords(sql)
+    if analysis["forbidden"]:
+        return False, f"Query contains forbidden statement: {analysis['forbidden']}"
+    if analysis["statement_count"] > 1:
+        return False, "Only a single query is allowed"
+    if not analysis["is_read_only"]:
+        return False, "Only SELECT queries are allowed"
+    return True, "Query is safe"
+
+
+def validate_sql_keywords(sql: str) -> Tuple[bool, str]:
+    """Keyword-based safety check for SQL that cannot be parsed."""
+    sql_upper = sql.upper().strip()
+    
+    dangerous_keywords = ['INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 'TRUNCATE', 'EXEC', 'EXECUTE', 'GRANT', 'REVOKE']
+    
+    for keyword in dangerous_keywords:
+        if re.search(rf'\b{keyword}\b', sql_upper):
+            return False, f"Query contains forbidden keyword: {keyword}"
+    
+    if not sql_upper.startswith('SELECT'):
+        return False, "Only SELECT queries are allowed"
+    
+    return True, "Query is safe"
@@ -0,0 +1,112 @@
+"""Column statistics of a result, computed locally (vectorized, sampled) or in Snowflake."""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .config import (
+    STATS_APPROX_DISTINCT_ROWS, STATS_HLL_CHUNK_ROWS, STATS_HLL_PRECISION, STATS_PUSHDOWN_TTL_SECONDS,
+)
+from .tracing import traced
+from .caching import memoize
+from .db import query_over_result, quote_identifier
+from .incremental import hll_estimate
+
+
+def approx_distinct(values: np.ndarray, precision: int = STATS_HLL_PRECISION) -> int:
+    """HyperLogLog distinct count of non-null values, computed with vectorized hashing.
+    
+    Strings that look low-cardinality from a sample are counted exactly
+    instead, since factorizing them is cheaper than hashing every value.
+    """
+    if len(values) == 0:
+        return 0
+    if values.dtype == object and len(set(values[:1000])) < 100:
+        return len(pd.unique(values))
+    remaining_bits = 64 - precision
+    registers = np.zeros(1 << precision, dtype=np.int64)
+    # Hash in chunks so the working memory stays bounded regardless of result size
+    for start in range(0, len(values), STATS_HLL_CHUNK_ROWS):
+        hashes = pd.util.hash_array(values[start:start + STATS_HLL_CHUNK_ROWS], categorize=False)
+        indices = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+        # The remaining bits fit in a float64 mantissa, so frexp gives their exact bit length
+        _, bit_length = np.frexp((hashes & np.uint64((1 << remaining_bits) - 1)).astype(np.float64))
+        np.maximum.at(registers, indices, (remaining_bits - bit_length + 1).astype(np.int64))
+    return hll_estimate(registers)
+
+
+@traced("column_stats")
+def get_column_stats(df: pd.DataFrame) -> pd.DataFrame:
+    """Distinct/null counts for every column and min/max/mean for numeric ones.
+    
+    Numeric aggregates are computed for all columns in one vectorized call.
+    Above STATS_APPROX_DISTINCT_ROWS rows, distinct counts are HyperLogLog
+    estimates (the "Approximate" column) computed from the same null mask
+    as the null counts, which keeps memory bounded for high-cardinality
+    columns.
+    """
+    approximate = len(df) > STATS_APPROX_DISTINCT_ROWS
+    if approximate:
+        distinct, nulls = [], []
+        for col in df.columns:
+            values = df[col].to_numpy()
+            missing = pd.isna(values)
+            nulls.append(int(missing.sum()))
+            distinct.append(approx_distinct(values[~missing]))
+    else:
+        distinct = df.nunique().to_numpy()
+        nulls = (len(df) - df.count()).to_numpy()
+    stats = pd.DataFrame({"Column": df.columns, "Distinct Values": distinct, "Null Count": nulls})
+    
+    numeric = df.select_dtypes(include="number")
+    if not numeric.empty:
+        aggregates = numeric.agg(["min", "max", "mean"]).T.reindex(df.columns)
+        stats["Min"] = aggregates["min"].to_numpy()
+        stats["Max"] = aggregates["max"].to_numpy()
+        stats["Mean"] = aggregates["mean"].round(2).to_numpy()
+    stats["Approximate"] = approximate
+    return stats
+
+
+def column_stats_sql(source: str, columns: list, numeric_columns: set) -> str:
+    """One aggregate query computing every column's statistics over a query result.
+    
+    source is a FROM item, e.g. a RESULT_SCAN of a finished query.
+    """
+    expressions = ['COUNT(*) AS "rows"']
+    for i, column in enumerate(columns):
+        identifier = quote_identifier(column)
+        expressions.append(f'APPROX_COUNT_DISTINCT({identifier}) AS "distinct_{i}"')
+        expressions.append(f'COUNT_IF({identifier} IS NULL) AS "nulls_{i}"')
+        if column in numeric_columns:
+            expressions.append(f'MIN({identifier}) AS "min_{i}"')
+            expressions.append(f'MAX({identifier}) AS "max_{i}"')
+            expressions.append(f'AVG({identifier}) AS "mean_{i}"')
+    return f"SELECT {', '.join(expressions)} FROM {source}"
+
+
+@memoize(ttl=STATS_PUSHDOWN_TTL_SECONDS, max_entries=200)
+def pushdown_column_stats(sql_hash: str, columns: tuple, numeric_columns: tuple,
+                          _query_id: Optional[str]) -> pd.DataFrame:
+    """Column statistics over the full result of a query, computed in Snowflake.
+    
+    Returns the same table as get_column_stats() (see query_over_result
+    for how the result is read). Cached by SQL hash; distinct counts are
+    always estimates.
+    """
+    numeric = set(numeric_columns)
+    row = query_over_result(lambda source: column_stats_sql(source, list(columns), numeric), _query_id).iloc[0]
+    
+    stats = pd.DataFrame({
+        "Column": list(columns),
+        "Distinct Values": [row[f"distinct_{i}"] for i in range(len(columns))],
+        "Null Count": [row[f"nulls_{i}"] for i in range(len(columns))],
+    })
+    if numeric:
+        for label, prefix in [("Min", "min"), ("Max", "max"), ("Mean", "mean")]:
+            stats[label] = [row.get(f"{prefix}_{i}") for i in range(len(columns))]
+        stats["Mean"] = pd.to_numeric(stats["Mean"]).round(2)
+    stats["Approximate"] = True
+    stats.attrs["rows"] = row["rows"]
+    return stats
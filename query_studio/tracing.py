@@ -0,0 +1,264 @@
+"""Per-rerun tracing, latency histograms and the Prometheus metrics endpoint.
+
+Spans are recorded with trace_span() or @traced() into the current Trace,
+feed the process-wide histograms and are optionally exported to an
+OpenTelemetry collector.
+"""
+
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from typing import Callable, Optional
+
+from .config import (
+    METRICS_ADDRESS, METRICS_BYTES_BUCKETS, METRICS_ROWS_BUCKETS, METRICS_SECONDS_BUCKETS,
+    OTEL_EXPORTER_ENDPOINT, OTEL_SERVICE_NAME,
+)
+
+
+class Histogram:
+    """Prometheus-style histogram with cumulative buckets, one series per label set."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, label: str = "stage"):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str):
+        with self._lock:
+            series = self._series.setdefault(label_value, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def exposition(self) -> list:
+        """Lines of the Prometheus text format for this histogram."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return lines
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> dict:
+    """Process-wide histograms fed by every finished span."""
+    return {
+        "seconds": Histogram("query_studio_stage_duration_seconds", "Time spent per pipeline stage",
+                             METRICS_SECONDS_BUCKETS),
+        "rows": Histogram("query_studio_stage_rows", "Rows produced per pipeline stage", METRICS_ROWS_BUCKETS),
+        "bytes": Histogram("query_studio_stage_bytes_scanned", "Bytes scanned in Snowflake per pipeline stage",
+                           METRICS_BYTES_BUCKETS),
+    }
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in get_metrics().values():
+        lines.extend(histogram.exposition())
+    return "\n".join(lines) + "\n"
+
+
+@lru_cache(maxsize=None)
+def start_metrics_server(port: int, address: str = METRICS_ADDRESS):
+    """Serve render_metrics() at http://<address>:<port>/metrics from a background thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+@lru_cache(maxsize=None)
+def get_otel_tracer():
+    """OpenTelemetry tracer exporting over OTLP/HTTP, or None when not configured or not installed."""
+    if not OTEL_EXPORTER_ENDPOINT:
+        return None
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        return None
+    # The exporter reads OTEL_EXPORTER_OTLP_ENDPOINT itself
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    return provider.get_tracer("query_studio")
+
+
+class Trace:
+    """Spans recorded during one unit of work (a rerun of the app, a CLI item).
+    
+    Spans are plain dicts: name, span_id, parent_id, start (seconds from the
+    start of the trace), duration, cpu (CPU seconds of the thread that ran
+    the span), attributes and error.
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        self.duration = None
+        self.cpu = None
+        self.spans = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        self.cpu = time.thread_time() - self.cpu_started
+        tracer = get_otel_tracer()
+        if tracer is not None:
+            export_otel_trace(tracer, self)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "attributes": dict(self.attributes),
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "cpu": self.cpu,
+            "spans": sorted(self.spans, key=lambda span: span["start"]),
+        }
+
+
+_current_trace = contextvars.ContextVar("query_studio_trace", default=None)
+_current_span = contextvars.ContextVar("query_studio_span", default=None)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """Record the spans of everything run inside the block into a new Trace."""
+    trace = Trace(name, **attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Time a stage as a span of the current trace and feed the stage histograms.
+    
+    Yields the span's attribute dict so the block can tag it with what it
+    finds out along the way (query ID, rows, bytes scanned). Without a
+    current trace only the histograms are updated.
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    started, cpu_started = time.perf_counter(), time.thread_time()
+    span = {
+        "name": name,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "start": started - trace.started if trace else 0.0,
+        "duration": None,
+        "cpu": None,
+        "attributes": attributes,
+        "error": None,
+    }
+    token = _current_span.set(span)
+    try:
+        yield attributes
+    except Exception as e:
+        span["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span["duration"] = time.perf_counter() - started
+        span["cpu"] = time.thread_time() - cpu_started
+        _current_span.reset(token)
+        if trace is not None:
+            trace.spans.append(span)
+        metrics = get_metrics()
+        metrics["seconds"].observe(span["duration"], name)
+        if isinstance(attributes.get("rows"), int):
+            metrics["rows"].observe(attributes["rows"], name)
+        if isinstance(attributes.get("bytes_scanned"), int):
+            metrics["bytes"].observe(attributes["bytes_scanned"], name)
+
+
+def set_span_attributes(**attributes):
+    """Tag the innermost open span (e.g. from inside a @traced function)."""
+    span = _current_span.get()
+    if span is not None:
+        span["attributes"].update(attributes)
+
+
+def traced(name: Optional[str] = None):
+    """Decorator running a function inside trace_span (named after the function by default)."""
+    def decorator(func):
+        span_name = name or func.__name__
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_current_context(func: Callable) -> Callable:
+    """Bind func to the caller's trace context, for work handed to a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+def export_otel_trace(tracer, trace: Trace):
+    """Send a finished trace to OpenTelemetry, with the original timings and parent links."""
+    from opentelemetry import trace as otel_trace
+    
+    to_ns = lambda offset: int((trace.started_at + offset) * 1e9)
+    root = tracer.start_span(trace.name, start_time=to_ns(0), attributes=otel_attributes(trace.attributes))
+    exported = {None: root}
+    for span in sorted(trace.spans, key=lambda span: span["start"]):
+        parent = exported.get(span["parent_id"], root)
+        otel_span = tracer.start_span(span["name"], context=otel_trace.set_span_in_context(parent),
+                                      start_time=to_ns(span["start"]), attributes=otel_attributes(span["attributes"]))
+        if span["error"]:
+            otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span["error"]))
+        otel_span.end(end_time=to_ns(span["start"] + span["duration"]))
+        exported[span["span_id"]] = otel_span
+    root.end(end_time=to_ns(trace.duration))
+
+
+def otel_attributes(attributes: dict) -> dict:
+    """Span attributes restricted to the primitive types OpenTelemetry accepts."""
+    return {key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))}
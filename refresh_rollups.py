@@ -0,0 +1,41 @@
+"""Rebuild the daily rollup tables used to answer common aggregate questions.
+
+Meant to run on a schedule (e.g. daily, shortly after the events table is
+loaded). By default it rebuilds the last few closed days so late-arriving
+events are picked up. Uses the same secrets as the app and needs write
+access to ROLLUP_SCHEMA.
+
+Usage:
+    python refresh_rollups.py                      # last LATE_DATA_DAYS (3) closed days, all rollups
+    python refresh_rollups.py --start 2024-01-01 --end 2024-01-31
+    python refresh_rollups.py --rollup daily_audience --days 1
+"""
+import argparse
+import time
+from datetime import date, timedelta
+
+from query_studio import config, rollups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=config.LATE_DATA_DAYS,
+                        help="Number of closed days to rebuild, ending yesterday")
+    parser.add_argument("--start", type=date.fromisoformat, help="First day to rebuild (overrides --days)")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last day to rebuild (default: yesterday)")
+    parser.add_argument("--rollup", action="append", choices=list(config.ROLLUP_TABLES), help="Rollup to rebuild (repeatable)")
+    args = parser.parse_args()
+
+    end = args.end or date.today() - timedelta(days=1)
+    start = args.start or end - timedelta(days=args.days - 1)
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    for name in args.rollup or list(config.ROLLUP_TABLES):
+        for day in days:
+            started = time.perf_counter()
+            rollups.refresh_rollups([day], [name])
+            print(f"{name} {day.isoformat()} refreshed in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
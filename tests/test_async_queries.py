@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+from enum import Enum
+
+import pytest
+import snowflake.connector
+
+from query_studio import db
+
+
+class Status(Enum):
+    RUNNING = 1
+    SUCCESS = 2
+    FAILED_WITH_ERROR = 3
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.sfqid = None
+        self.rowcount = None
+        self.description = [("site",), ("views",)]
+
+    def execute_async(self, sql):
+        self.conn.executed.append(sql)
+        self.sfqid = "01abc"
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+        if "QUERY_HISTORY_BY_USER" in sql and self.conn.history_error:
+            raise snowflake.connector.ProgrammingError("no access")
+
+    def fetchone(self):
+        return (4096,)
+
+    def get_results_from_sfqid(self, query_id):
+        self.sfqid = query_id
+        self.rowcount = 3
+
+    def fetchmany(self, size):
+        return [("mako", 1), ("n12", 2), ("ynet", 3)][:size]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, status):
+        self.status = status
+        self.executed = []
+        self.history_error = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_query_status(self, query_id):
+        return self.status
+
+    def get_query_status_throw_if_error(self, query_id):
+        if self.status is Status.FAILED_WITH_ERROR:
+            raise snowflake.connector.ProgrammingError("division by zero")
+        return self.status
+
+    def is_still_running(self, status):
+        return status is Status.RUNNING
+
+    def is_an_error(self, status):
+        return status is Status.FAILED_WITH_ERROR
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    conn = FakeConnection(Status.RUNNING)
+
+    class Pool:
+        @contextmanager
+        def connection(self):
+            yield conn
+
+    monkeypatch.setattr(db, "get_connection_pool", lambda: Pool())
+    return conn
+
+
+def test_submit_returns_the_query_id(connection):
+    assert db.submit_query("SELECT 1") == "01abc"
+    assert connection.executed == ["SELECT 1"]
+
+
+def test_running_query_skips_bytes_scanned_unless_asked(connection):
+    progress = db.get_query_progress("01abc", with_bytes_scanned=False)
+    assert progress == {"running": True, "failed": False, "status": "RUNNING", "bytes_scanned": None}
+    assert connection.executed == []
+    assert db.get_query_progress("01abc")["bytes_scanned"] == 4096
+
+
+def test_finished_query_always_reports_bytes_scanned(connection):
+    connection.status = Status.SUCCESS
+    progress = db.get_query_progress("01abc", with_bytes_scanned=False)
+    assert not progress["running"]
+    assert progress["bytes_scanned"] == 4096
+
+
+def test_bytes_scanned_is_optional(connection):
+    connection.history_error = True
+    assert db.get_query_progress("01abc")["bytes_scanned"] is None
+
+
+def test_is_query_running(connection):
+    assert db.is_query_running("01abc")
+    connection.status = Status.SUCCESS
+    assert not db.is_query_running("01abc")
+
+
+def test_cancel_query(connection):
+    db.cancel_query("01abc")
+    assert connection.executed == [("SELECT SYSTEM$CANCEL_QUERY(%s)", ("01abc",))]
+
+
+def test_fetch_result_by_query_id(connection):
+    connection.status = Status.SUCCESS
+    df, meta = db.fetch_query_result("01abc", max_rows=2, fetch_mode="rows")
+    assert df["site"].tolist() == ["mako", "n12"]
+    assert meta == {"query_id": "01abc", "result_id": "01abc", "total_rows": 3, "truncated": True,
+                    "from_cache": False}
+
+
+def test_fetch_result_raises_the_query_error(connection):
+    connection.status = Status.FAILED_WITH_ERROR
+    with pytest.raises(snowflake.connector.ProgrammingError):
+        db.fetch_query_result("01abc")
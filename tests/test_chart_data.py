@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from query_studio import charts
+
+
+def test_buckets_where_a_series_has_no_values_are_kept():
+    values = np.column_stack([np.arange(100, dtype=np.float64), np.arange(100, dtype=np.float64)])
+    values[:50, 1] = np.nan
+    indices = charts.min_max_indices(values, threshold=20)
+    # The all-NaN buckets of the second series fall back to their first row
+    assert indices.tolist() == [0, 24, 25, 49, 50, 74, 75, 99]
+
+
+def test_downsampling_series_with_gaps():
+    data = pd.DataFrame(
+        {"a": np.arange(1000, dtype=np.float64), "b": np.where(np.arange(1000) < 500, np.nan, 1.0)},
+        index=pd.date_range("2024-01-01", periods=1000, freq="h"),
+    )
+    assert len(charts.downsample_series(data, max_points=100)) <= 100
+
+
+def test_downsampling_several_series_keeps_endpoints_within_budget():
+    rng = np.random.default_rng(0)
+    for series_count in (2, 3, 5):
+        data = pd.DataFrame(rng.normal(size=(5000, series_count)))
+        for max_points in (12, 25, 100):
+            sampled = charts.downsample_series(data, max_points=max_points)
+            assert len(sampled) <= max_points
+            assert sampled.index[0] == 0
+            assert sampled.index[-1] == 4999
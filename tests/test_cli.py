@@ -0,0 +1,23 @@
+import cli
+
+
+def test_statements_keep_their_original_text():
+    text = "select a, 'x;y' as b -- one; two\nfrom t where date = '2024-01-01';\n\n/* next; */ SELECT 2;\n-- done\n"
+    assert cli.split_sql_statements(text) == [
+        "select a, 'x;y' as b -- one; two\nfrom t where date = '2024-01-01'",
+        "/* next; */ SELECT 2",
+    ]
+
+
+def test_text_that_does_not_tokenize_is_split_at_line_ends():
+    assert cli.split_sql_statements("SELECT 1;\nSELECT 'unterminated;\nSELECT 3;") == \
+        ["SELECT 1", "SELECT 'unterminated", "SELECT 3"]
+
+
+def test_invalid_statements_fail_on_their_own(tmp_path):
+    path = tmp_path / "queries.sql"
+    path.write_text("SELEC 1 FROM t;\nSELECT 1;\n")
+    items = cli.load_items(str(path), as_sql=False)
+    assert [item["sql"] for item in items] == ["SELEC 1 FROM t", "SELECT 1"]
+    _, report = cli.pipeline.run_pipeline([], 100, sql=items[0]["sql"])
+    assert report["status"] == "unsafe"
@@ -0,0 +1,161 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+import snowflake.connector
+
+from query_studio import config, db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        if self.conn.broken:
+            raise snowflake.connector.OperationalError("connection lost")
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class Connector:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.opened = []
+
+    def __call__(self):
+        if self.failures:
+            self.failures -= 1
+            raise snowflake.connector.OperationalError("connect failed")
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def test_connections_are_reused():
+    connect = Connector()
+    pool = db.SnowflakeConnectionPool(connect, max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(connect.opened) == 1
+    assert pool.stats()["checkouts"] == 2
+
+
+def test_checkout_times_out_when_pool_is_exhausted():
+    pool = db.SnowflakeConnectionPool(Connector(), max_size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+    with pool.connection():
+        pass
+
+
+def test_waiter_gets_connection_when_released():
+    pool = db.SnowflakeConnectionPool(Connector(), max_size=1, timeout=2)
+    acquired = []
+
+    def borrow():
+        with pool.connection() as conn:
+            acquired.append(conn)
+
+    with pool.connection() as held:
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        time.sleep(0.05)
+        assert not acquired
+    thread.join()
+    assert acquired == [held]
+    assert pool.stats()["waits"] == 1
+
+
+def test_closed_connection_is_replaced_on_checkout():
+    connect = Connector()
+    pool = db.SnowflakeConnectionPool(connect, max_size=1)
+    with pool.connection() as first:
+        pass
+    first.closed = True
+    with pool.connection() as second:
+        pass
+    assert second is not first
+    assert pool.stats()["size"] == 1
+
+
+def test_idle_connection_failing_health_check_is_replaced():
+    pool = db.SnowflakeConnectionPool(Connector(), max_size=1, health_check_idle=0)
+    with pool.connection() as first:
+        pass
+    first.broken = True
+    with pool.connection() as second:
+        pass
+    assert second is not first
+    assert first.closed
+    assert pool.stats()["health_check_failures"] == 1
+
+
+def test_expired_connection_is_recycled():
+    pool = db.SnowflakeConnectionPool(Connector(), max_size=1, max_lifetime=0)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert second is not first
+    assert pool.stats()["recycled"] >= 1
+
+
+def test_connect_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(config, "SNOWFLAKE_CONNECT_BACKOFF_SECONDS", 0)
+    connect = Connector(failures=2)
+    pool = db.SnowflakeConnectionPool(connect, max_size=1)
+    with pool.connection():
+        pass
+    assert pool.stats()["connect_failures"] == 2
+    assert pool.stats()["connects"] == 1
+
+
+def test_failed_connect_releases_its_slot(monkeypatch):
+    monkeypatch.setattr(config, "SNOWFLAKE_CONNECT_BACKOFF_SECONDS", 0)
+    pool = db.SnowflakeConnectionPool(Connector(failures=config.SNOWFLAKE_CONNECT_RETRIES), max_size=1)
+    with pytest.raises(snowflake.connector.OperationalError):
+        with pool.connection():
+            pass
+    assert pool.stats()["size"] == 0
+    with pool.connection():
+        pass
+
+
+def test_execute_query_is_unpaged_execute_query_paged(monkeypatch):
+    calls = []
+
+    def execute_query_paged(sql, max_rows=config.RESULT_MEMORY_ROWS, fetch_mode=config.FETCH_MODE):
+        calls.append((sql, max_rows, fetch_mode))
+        return pd.DataFrame({"a": [1]}), {}
+
+    monkeypatch.setattr(db, "execute_query_paged", execute_query_paged)
+    df = db.execute_query("SELECT 1", fetch_mode="rows")
+    assert df["a"].tolist() == [1]
+    assert calls == [("SELECT 1", None, "rows")]
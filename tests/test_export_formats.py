@@ -0,0 +1,50 @@
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from query_studio import config, db, exports
+
+
+def batches():
+    # Snowflake picks the integer width per batch; every format must take the mix
+    yield pa.table({"site": ["mako", "n12"], "views": pa.array([1, 2], type=pa.int8())})
+    yield pa.table({"site": ["ynet"], "views": pa.array([300], type=pa.int16())})
+
+
+def read_export(path, export_format):
+    if export_format == "CSV":
+        return pd.read_csv(path)
+    if export_format == "JSON":
+        with open(path) as f:
+            return pd.DataFrame(json.load(f))
+    if export_format == "Parquet":
+        return pq.read_table(path).to_pandas()
+    with pa.ipc.open_file(path) as reader:
+        return reader.read_all().to_pandas()
+
+
+@pytest.mark.parametrize("export_format", list(exports.EXPORT_FORMATS))
+def test_every_format_holds_all_batches(tmp_path, export_format):
+    path = str(tmp_path / f"export.{exports.EXPORT_FORMATS[export_format]['extension']}")
+    exports.write_export((db.normalize_arrow_table(batch) for batch in batches()), export_format, path)
+    df = read_export(path, export_format)
+    assert df["site"].tolist() == ["mako", "n12", "ynet"]
+    assert df["views"].tolist() == [1, 2, 300]
+    assert [p.name for p in tmp_path.iterdir()] == [f"export.{exports.EXPORT_FORMATS[export_format]['extension']}"]
+
+
+def test_json_export_of_empty_batches_is_an_empty_array():
+    chunks = exports.iter_json_chunks([pa.table({"a": pa.array([], type=pa.int64())})])
+    assert b"".join(chunks) == b"[]"
+
+
+def test_unload_statements():
+    csv = exports.unload_sql("TABLE(RESULT_SCAN('01abc'))", "CSV", "r1/csv")
+    assert csv.startswith(f"COPY INTO @{config.UNLOAD_STAGE}/r1/csv/ FROM (SELECT * FROM TABLE(RESULT_SCAN('01abc')))")
+    assert "HEADER = TRUE" in csv
+    json_unload = exports.unload_sql("TABLE(RESULT_SCAN('01abc'))", "JSON", "r1/json")
+    assert "SELECT OBJECT_CONSTRUCT(*)" in json_unload
+    assert "HEADER" not in json_unload
@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+
+from query_studio import config, db, exports
+
+
+class FakeResultBatch:
+    def __init__(self, table):
+        self.table = table
+
+    def to_arrow(self, connection=None):
+        return self.table
+
+
+class FakeCursor:
+    def get_results_from_sfqid(self, query_id):
+        pass
+
+    def get_result_batches(self):
+        return [FakeResultBatch(pa.table({"a": list(range(start, start + 3))})) for start in (0, 3)]
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.in_use = 0
+
+    @contextmanager
+    def connection(self):
+        self.in_use += 1
+        try:
+            yield type("Connection", (), {"cursor": lambda self: FakeCursor()})()
+        finally:
+            self.in_use -= 1
+
+
+def test_truncated_results_are_streamed_without_holding_a_connection(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db, "get_connection_pool", lambda: pool)
+    batches = db.iter_result_batches(pd.DataFrame({"a": [0]}), {"query_id": "q", "truncated": True}, chunk_rows=2)
+    first = next(batches)
+    assert first.column("a").to_pylist() == [0, 1]
+    assert pool.in_use == 0
+    assert [value for batch in batches for value in batch.column("a").to_pylist()] == [2, 3, 4, 5]
+
+
+def test_results_in_memory_are_sliced_into_chunks():
+    batches = list(db.iter_result_batches(pd.DataFrame({"a": range(5)}), {"truncated": False}, chunk_rows=2))
+    assert [batch.num_rows for batch in batches] == [2, 2, 1]
+
+
+def test_empty_results_still_yield_a_batch():
+    batches = list(db.iter_result_batches(pd.DataFrame({"a": []}), {"truncated": False}))
+    assert len(batches) == 1 and batches[0].num_rows == 0
+
+
+def test_large_export_file_is_served_from_the_stage(monkeypatch):
+    queries = []
+
+    def execute_query(sql, fetch_mode=config.FETCH_MODE):
+        queries.append(sql)
+        if sql.startswith("LIST"):
+            return pd.DataFrame({"name": ["query_studio_exports/r1/csv-file/export.csv"], "size": [123]})
+        if "GET_PRESIGNED_URL" in sql:
+            return pd.DataFrame({"PATH": ["r1/csv-file/export.csv"], "URL": ["https://stage/export.csv"]})
+        return pd.DataFrame({"status": ["UPLOADED"]})
+
+    monkeypatch.setattr(exports, "execute_query", execute_query)
+    files = exports.stage_export_file.__wrapped__("r1", "CSV", "/tmp/exports/export.csv")
+    assert queries[0].startswith("PUT 'file:///tmp/exports/export.csv' @")
+    assert files == [{"file": "export.csv", "bytes": 123, "url": "https://stage/export.csv"}]
@@ -0,0 +1,62 @@
+from query_studio import caching, generation
+
+
+COLUMNS = [("date", "DATE"), ("site", "TEXT"), ("device_type", "TEXT"), ("user_id", "TEXT"), ("page_views", "NUMBER")]
+
+
+def test_rephrasings_that_prune_different_columns_share_a_scope(tmp_path):
+    cache = caching.SqlGenerationCache(str(tmp_path / "sql_cache.sqlite3"))
+    schema_key = generation.get_schema_key(COLUMNS)
+    cache.put("How many users visited mako by device yesterday?", schema_key, 100, "2024-01-01",
+              "SELECT 1", "explanation")
+    assert cache.get("how many users visited mako yesterday by device", schema_key, 100, "2024-01-01") == \
+        ("SELECT 1", "explanation")
+    assert cache.get("How many users visited mako by device yesterday?", generation.get_schema_key(COLUMNS[:3]), 100,
+                     "2024-01-01") is None
+
+
+def make_cache(tmp_path, **kwargs):
+    return caching.SqlGenerationCache(str(tmp_path / "sql_cache.sqlite3"), **kwargs)
+
+
+def test_exact_hit_ignores_case_and_punctuation(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Page views per site?", "schema", 100, "2024-01-01", "SELECT 1", "explanation")
+    assert cache.get("page views per site", "schema", 100, "2024-01-01") == ("SELECT 1", "explanation")
+    assert cache.stats()["exact_hits"] == 1
+
+
+def test_similar_question_hits_in_the_same_scope_only(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("show me page views per site", "schema", 100, "2024-01-01", "SELECT 1", "explanation")
+    assert cache.get("page views for each site", "schema", 100, "2024-01-01") is None
+    assert cache.get("what are the page views per site", "schema", 100, "2024-01-01") == ("SELECT 1", "explanation")
+    assert cache.stats()["similar_hits"] == 1
+    assert cache.get("what are the page views per site", "schema", 50, "2024-01-01") is None
+    assert cache.get("what are the page views per site", "schema", 100, "2024-01-02") is None
+
+
+def test_numbers_and_negations_are_never_similar(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("page views per site in the last 7 days", "schema", 100, "2024-01-01", "SELECT 7", "")
+    cache.put("page views per site excluding mobile", "schema", 100, "2024-01-01", "SELECT 2", "")
+    assert cache.get("show page views per site in the last 30 days", "schema", 100, "2024-01-01") is None
+    assert cache.get("show page views per site mobile", "schema", 100, "2024-01-01") is None
+
+
+def test_expired_entries_miss(tmp_path):
+    cache = make_cache(tmp_path, ttl_seconds=-1)
+    cache.put("page views per site", "schema", 100, "2024-01-01", "SELECT 1", "")
+    assert cache.get("page views per site", "schema", 100, "2024-01-01") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.put("first question", "schema", 100, "2024-01-01", "SELECT 1", "")
+    cache.put("second question", "schema", 100, "2024-01-01", "SELECT 2", "")
+    assert cache.get("first question", "schema", 100, "2024-01-01") is not None
+    cache.put("third question", "schema", 100, "2024-01-01", "SELECT 3", "")
+    assert cache.get("second question", "schema", 100, "2024-01-01") is None
+    assert cache.get("first question", "schema", 100, "2024-01-01") is not None
+    assert cache.stats()["entries"] == 2
@@ -0,0 +1,34 @@
+import app
+from query_studio import config, history
+
+
+def test_history_and_favorites_are_per_user(tmp_path):
+    store = history.QueryHistoryStore(str(tmp_path / "history.sqlite3"))
+    store.add("a@example.com", "daily users", "SELECT 1", "")
+    store.add_favorite("a@example.com", "daily users", "SELECT 1", "")
+    assert store.count("a@example.com") == 1
+    assert store.count("b@example.com") == 0
+    assert store.favorites("b@example.com") == []
+
+
+def test_anonymous_sessions_do_not_share_history(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "current_user", lambda: config.HISTORY_DEFAULT_USER)
+    monkeypatch.setattr(app, "get_history_store", lambda: history.QueryHistoryStore(str(tmp_path / "history.sqlite3")))
+    
+    monkeypatch.setattr(app.st, "session_state", {})
+    first = app.user_history_store()
+    first.add(config.HISTORY_DEFAULT_USER, "daily users", "SELECT 1", "")
+    assert app.user_history_store() is first
+    
+    monkeypatch.setattr(app.st, "session_state", {})
+    second = app.user_history_store()
+    assert second is not first
+    assert second.count(config.HISTORY_DEFAULT_USER) == 0
+    assert not (tmp_path / "history.sqlite3").exists()
+
+
+def test_signed_in_viewers_use_the_persistent_store(monkeypatch):
+    shared = object()
+    monkeypatch.setattr(app, "current_user", lambda: "a@example.com")
+    monkeypatch.setattr(app, "get_history_store", lambda: shared)
+    assert app.user_history_store() is shared
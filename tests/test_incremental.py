@@ -0,0 +1,82 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from query_studio import caching, config, incremental, pipeline
+
+
+def events_sql(select: str, tail: str = "") -> str:
+    return (f"SELECT {select}\nFROM {config.TABLE_NAME}\n"
+            f"WHERE date BETWEEN '2024-01-01' AND '2024-01-03'\n{tail}")
+
+
+SQL = events_sql("site, COUNT(*) AS events, MAX(page_views) AS peak", "GROUP BY site ORDER BY events DESC LIMIT 2")
+
+
+def partial(site, events, peak):
+    return pd.DataFrame({"d0": site, "m0": events, "m1": peak})
+
+
+def test_plan_splits_the_query_per_day():
+    plan = incremental.plan_incremental(SQL)
+    assert plan["days"] == [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)]
+    assert plan["measures"] == {"m0": "count", "m1": "max"}
+    assert plan["outputs"] == [("SITE", "d0"), ("EVENTS", "m0"), ("PEAK", "m1")]
+    assert plan["order"] == [("EVENTS", False)] and plan["limit"] == 2
+    assert not plan["approximate"]
+
+
+@pytest.mark.parametrize("sql", [
+    events_sql("site, ROUND(SUM(page_views) / COUNT(*), 2) AS ratio", "GROUP BY site"),
+    events_sql("site, COUNT(*) AS events", "GROUP BY site HAVING COUNT(*) > 10"),
+    events_sql("site, device_type, COUNT(*) AS events", "GROUP BY site"),
+    f"SELECT COUNT(*) FROM {config.TABLE_NAME}",
+])
+def test_queries_that_do_not_decompose_are_not_planned(sql):
+    assert incremental.plan_incremental(sql) is None
+
+
+def test_exact_distinct_counts_are_only_estimated_when_allowed():
+    sql = events_sql("site, COUNT(DISTINCT user_id) AS users", "GROUP BY site")
+    assert incremental.plan_incremental(sql) is None
+    plan = incremental.plan_incremental(sql, approximate=True)
+    assert plan["measures"] == {"m0": "hll"} and plan["approximate"]
+
+
+def test_partials_merge_into_the_query_result():
+    plan = incremental.plan_incremental(SQL)
+    merged = incremental.merge_partials([
+        partial(["mako", "n12"], [10, 3], [5, 9]),
+        partial(["mako", "ynet"], [1, 4], [7, 2]),
+        partial([], [], []),
+    ], plan)
+    assert merged.to_dict("records") == [
+        {"SITE": "mako", "EVENTS": 11, "PEAK": 7},
+        {"SITE": "ynet", "EVENTS": 4, "PEAK": 2},
+    ]
+
+
+def test_global_aggregate_over_no_rows_returns_one_row():
+    plan = incremental.plan_incremental(events_sql("COUNT(*) AS events"))
+    merged = incremental.merge_partials([], plan)
+    assert merged["EVENTS"].tolist() == [0]
+
+
+def test_runs_in_full_when_partials_are_too_large(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "get_result_cache", lambda: caching.QueryResultCache(str(tmp_path / "results")))
+    monkeypatch.setattr(incremental, "get_partial_cache", lambda: caching.QueryResultCache(str(tmp_path / "partials")))
+    executed = []
+    
+    def execute_query_paged(sql, max_rows=config.RESULT_MEMORY_ROWS):
+        executed.append((sql, max_rows))
+        if len(executed) == 1:
+            return partial(["mako"], [1], [1]).assign(__day="2024-01-01"), {"truncated": True}
+        return pd.DataFrame({"SITE": ["mako"]}), {"query_id": "q", "truncated": False, "from_cache": False}
+    
+    monkeypatch.setattr(pipeline, "execute_query_paged", execute_query_paged)
+    monkeypatch.setattr(incremental, "execute_query_paged", execute_query_paged)
+    df, meta = pipeline.execute_query_cached(SQL, use_rollups=False, incremental=True)
+    assert executed[0][1] == config.INCREMENTAL_MAX_PARTIAL_ROWS
+    assert executed[1][0] == SQL
+    assert "incremental" not in meta and not meta["approximate"]
@@ -0,0 +1,40 @@
+import json
+
+from query_studio import generation
+
+
+RESPONSE = json.dumps({"sql": "SELECT \"site\", 'a\\b' FROM t\nLIMIT 10", "explanation": "Counts per site — ok"})
+
+
+def test_fields_complete_in_order_whatever_the_chunking():
+    for size in (1, 3, 7, len(RESPONSE)):
+        parser = generation.JsonFieldStream()
+        completed = []
+        for start in range(0, len(RESPONSE), size):
+            completed += parser.feed(RESPONSE[start:start + size])
+        assert completed == ["sql", "explanation"]
+        assert parser.fields == json.loads(RESPONSE)
+
+
+def test_sql_completes_before_the_explanation_arrives():
+    parser = generation.JsonFieldStream()
+    cut = RESPONSE.index('"explanation"')
+    assert parser.feed(RESPONSE[:cut]) == ["sql"]
+    assert parser.partial("explanation") is None
+
+
+def test_partial_value_while_streaming():
+    parser = generation.JsonFieldStream()
+    parser.feed('{"sql": "SELECT 1", "explanation": "Counts \\"each')
+    assert parser.partial("explanation") == 'Counts "each'
+    assert parser.partial("sql") == "SELECT 1"
+
+
+def test_partial_value_cut_inside_an_escape():
+    parser = generation.JsonFieldStream()
+    parser.feed('{"explanation": "caf\\u00')
+    assert parser.partial("explanation") == "caf"
+    parser.feed('e9 ok\\')
+    assert parser.partial("explanation") == "café ok"
+    parser.feed('n"}')
+    assert parser.fields["explanation"] == "café ok\n"
@@ -0,0 +1,95 @@
+import os
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from query_studio import caching, config
+
+
+def test_comment_markers_inside_literals_are_kept():
+    assert caching.canonicalize_sql("SELECT * FROM t WHERE x = 'a--b'") != \
+        caching.canonicalize_sql("SELECT * FROM t WHERE x = 'a--zzz'")
+    assert caching.canonicalize_sql("SELECT * FROM t WHERE x = 'a/*b*/c'") != \
+        caching.canonicalize_sql("SELECT * FROM t WHERE x = 'a/*zzz*/c'")
+    assert caching.canonicalize_sql("SELECT * FROM t WHERE x = 'a--b'") == "select*from t where x='a--b'"
+
+
+def test_comments_are_dropped():
+    assert caching.canonicalize_sql("SELECT a -- it's a comment\nFROM t /* don't */ WHERE b = 'x';") == \
+        caching.canonicalize_sql("select a from t where b='x'")
+
+
+def spilling_cache(directory) -> caching.QueryResultCache:
+    return caching.QueryResultCache(str(directory), spill_bytes=0)
+
+
+def test_putting_a_spilled_result_again_keeps_it_readable(tmp_path):
+    cache = spilling_cache(tmp_path)
+    sql = "SELECT a FROM t WHERE date = '2024-01-01'"
+    cache.put(sql, pd.DataFrame({"a": [1]}))
+    cache.put(sql, pd.DataFrame({"a": [2]}))
+    df, _ = cache.get(sql)
+    assert df["a"].tolist() == [2]
+    assert len(list(tmp_path.glob("*.parquet"))) == 1
+
+
+def test_missing_spill_file_is_a_miss(tmp_path):
+    cache = spilling_cache(tmp_path)
+    sql = "SELECT a FROM t WHERE date = '2024-01-01'"
+    cache.put(sql, pd.DataFrame({"a": [1]}))
+    for path in tmp_path.glob("*.parquet"):
+        path.unlink()
+    assert cache.get(sql) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_spill_files_of_other_processes_are_kept(tmp_path):
+    running = spilling_cache(tmp_path)
+    sql = "SELECT a FROM t"
+    running.put(sql, pd.DataFrame({"a": [1]}))
+    assert spilling_cache(tmp_path).stats()["orphans_removed"] == 0
+    assert running.get(sql)[0]["a"].tolist() == [1]
+
+
+def test_spill_files_older_than_any_entry_are_removed(tmp_path):
+    spilling_cache(tmp_path).put("SELECT a FROM t", pd.DataFrame({"a": [1]}))
+    for path in tmp_path.glob("*.parquet"):
+        stale = time.time() - config.RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS - 60
+        os.utime(path, (stale, stale))
+    cache = spilling_cache(tmp_path)
+    assert cache.stats()["orphans_removed"] == 1
+    assert not list(tmp_path.glob("*.parquet"))
+
+
+def test_cached_results_are_not_shared_with_callers(tmp_path):
+    cache = caching.QueryResultCache(str(tmp_path))
+    sql = "SELECT a FROM t"
+    meta = {"rows": 1}
+    cache.put(sql, pd.DataFrame({"a": [1]}), meta)
+    meta["rows"] = 2
+    df, cached_meta = cache.get(sql)
+    cached_meta["from_cache"] = True
+    df["b"] = 2
+    df, cached_meta = cache.get(sql)
+    assert cached_meta == {"rows": 1}
+    assert list(df.columns) == ["a"]
+
+
+def test_results_are_cached_per_execution_mode(tmp_path):
+    cache = caching.QueryResultCache(str(tmp_path))
+    sql = "SELECT COUNT(DISTINCT user_id) FROM t WHERE date = '2024-01-01'"
+    cache.put(sql, pd.DataFrame({"users": [99]}), {"rollup": "daily_site"},
+              mode=caching.result_cache_mode(use_rollups=True, incremental=False))
+    assert cache.get(sql, caching.result_cache_mode(use_rollups=False, incremental=False)) is None
+    assert cache.get(sql, caching.result_cache_mode(use_rollups=True, incremental=False)) is not None
+
+
+def test_days_that_may_still_receive_late_events_get_the_short_ttl():
+    def ttl(days_ago: int) -> int:
+        day = (date.today() - timedelta(days=days_ago)).isoformat()
+        return caching.result_cache_ttl(f"SELECT COUNT(*) FROM t WHERE date = '{day}'")
+
+    assert ttl(1) == config.RESULT_CACHE_OPEN_DAYS_TTL_SECONDS
+    assert ttl(config.LATE_DATA_DAYS) == config.RESULT_CACHE_OPEN_DAYS_TTL_SECONDS
+    assert ttl(config.LATE_DATA_DAYS + 1) == config.RESULT_CACHE_CLOSED_DAYS_TTL_SECONDS
@@ -0,0 +1,66 @@
+import os
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+import pyarrow as pa
+
+from query_studio import config, db, exports
+
+
+class FakeCursor:
+    description = [("a",)]
+
+    def __init__(self, batches, rowcount):
+        self.batches = batches
+        self.rowcount = rowcount
+        self.sfqid = "01abc"
+        self.downloaded = 0
+
+    def execute(self, sql):
+        pass
+
+    def fetch_arrow_batches(self):
+        for batch in self.batches:
+            self.downloaded += 1
+            yield batch
+
+    def close(self):
+        pass
+
+
+def arrow_batches(count, rows):
+    return [pa.table({"a": list(range(i * rows, (i + 1) * rows))}) for i in range(count)]
+
+
+def test_batches_past_max_rows_are_never_downloaded():
+    cursor = FakeCursor(arrow_batches(5, 10), 50)
+    df = db.fetch_arrow_dataframe(cursor, max_rows=15)
+    assert df["a"].tolist() == list(range(15))
+    assert cursor.downloaded == 2
+
+
+def test_paged_execution_describes_the_full_result(monkeypatch):
+    cursor = FakeCursor(arrow_batches(5, 10), 50)
+    connection = type("Connection", (), {"cursor": lambda self: cursor})()
+    pool = type("Pool", (), {"connection": lambda self: nullcontext(connection)})()
+    monkeypatch.setattr(db, "get_connection_pool", lambda: pool)
+    df, meta = db.execute_query_paged("SELECT a FROM t", max_rows=20, fetch_mode="arrow")
+    assert len(df) == 20
+    assert meta == {"query_id": "01abc", "result_id": "01abc", "total_rows": 50, "truncated": True,
+                    "from_cache": False}
+
+
+def test_prepared_exports_are_reused_and_expired_ones_removed(monkeypatch, tmp_path):
+    monkeypatch.setattr(exports, "CACHE_DIR", str(tmp_path))
+    os.makedirs(tmp_path / "exports")
+    stale = tmp_path / "exports" / "old.csv"
+    stale.write_text("a\n1\n")
+    os.utime(stale, (time.time() - config.EXPORT_TTL_SECONDS - 60,) * 2)
+    
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    path = exports.prepare_export(df, {"result_id": "r1", "truncated": False}, "CSV")
+    assert pd.read_csv(path)["a"].tolist() == [1, 2, 3]
+    assert not stale.exists()
+    assert exports.prepare_export(pd.DataFrame({"a": [9]}), {"result_id": "r1", "truncated": False}, "CSV") == path
+    assert pd.read_csv(path)["a"].tolist() == [1, 2, 3]
@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+
+from query_studio import charts, config, db, stats
+
+
+@pytest.fixture
+def executed(monkeypatch):
+    queries = []
+
+    def execute_query(sql, fetch_mode=config.FETCH_MODE):
+        queries.append(sql)
+        return pd.DataFrame({"day": ["2024-01-01"], "total": [1], "points": [1]})
+
+    monkeypatch.setattr(db, "execute_query", execute_query)
+    return queries
+
+
+def test_stored_result_is_read_with_result_scan(executed):
+    db.query_over_result(lambda source: f"SELECT COUNT(*) FROM {source}", "01abc")
+    assert executed == ["SELECT COUNT(*) FROM TABLE(RESULT_SCAN('01abc'))"]
+
+
+def test_result_without_query_id_is_not_rerun(executed):
+    with pytest.raises(db.ResultNotStored):
+        db.query_over_result(lambda source: f"SELECT COUNT(*) FROM {source}", None)
+    assert executed == []
+
+
+def test_chart_is_not_pushed_down_without_query_id(executed):
+    spec = {"kind": "line", "dimension": "day", "measures": ["total"], "note": None}
+    assert charts.warehouse_chart_data("SELECT day, total FROM t", {"query_id": None}, spec) is None
+    assert executed == []
+
+
+def test_column_stats_are_not_pushed_down_without_query_id(executed):
+    with pytest.raises(db.ResultNotStored):
+        stats.pushdown_column_stats("no-query-id", ("total",), ("total",), None)
+    assert executed == []
@@ -0,0 +1,62 @@
+from datetime import date, timedelta
+
+import pytest
+
+from query_studio import config, rollups
+
+
+@pytest.fixture(autouse=True)
+def refreshed_days(monkeypatch):
+    days = {date(2024, 1, 1) + timedelta(days=i) for i in range(7)}
+    monkeypatch.setattr(rollups, "get_rollup_coverage", lambda: {name: set(days) for name in config.ROLLUP_TABLES})
+
+
+def events_sql(select: str, where: str = "date BETWEEN '2024-01-01' AND '2024-01-03'", tail: str = "") -> str:
+    return f"SELECT {select}\nFROM {config.TABLE_NAME}\nWHERE {where}\n{tail}"
+
+
+def test_aggregates_are_rewritten_to_rollup_measures():
+    sql = events_sql("site, COUNT(*) AS events, SUM(visit_first_event) AS visits, "
+                     "COUNT_IF(device_type = 'mobile') AS mobile", tail="GROUP BY site")
+    routed, name = rollups.route_to_rollup(sql)
+    assert name in config.ROLLUP_TABLES
+    assert rollups.rollup_table_name(name) in routed
+    assert "SUM(event_count) AS events" in routed
+    assert "SUM(visit_first_events) AS visits" in routed
+    assert "SUM(IFF(device_type = 'mobile', event_count, 0)) AS mobile" in routed
+
+
+def test_smallest_covering_rollup_is_used():
+    sql = events_sql("site, ENGAGEMENT_TYPE, COUNT(*) AS events", tail="GROUP BY site, ENGAGEMENT_TYPE")
+    assert rollups.route_to_rollup(sql)[1] == "daily_engagement"
+
+
+def test_exact_distinct_counts_are_only_estimated_when_allowed():
+    sql = events_sql("site, COUNT(DISTINCT user_id) AS users", tail="GROUP BY site")
+    assert rollups.route_to_rollup(sql) is None
+    assert rollups.resolve_execution_sql(sql, use_rollups=True) == (sql, None)
+    routed, name = rollups.route_to_rollup(sql, approximate=True)
+    assert "HLL_ESTIMATE(HLL_COMBINE(users_hll)) AS users" in routed
+    assert rollups.rollup_estimates_distinct_counts(sql, name)
+    assert not rollups.rollup_estimates_distinct_counts(sql, None)
+
+
+@pytest.mark.parametrize("sql", [
+    # A dimension no rollup has
+    events_sql("page_url, COUNT(*) AS events", tail="GROUP BY page_url"),
+    # Not an aggregate
+    events_sql("site, event_name"),
+    # Days that haven't been refreshed
+    events_sql("site, COUNT(*) AS events", where="date BETWEEN '2024-01-01' AND '2024-01-20'", tail="GROUP BY site"),
+    # A range that runs through today
+    events_sql("site, COUNT(*) AS events", where="date >= DATEADD(day, -2, CURRENT_DATE())", tail="GROUP BY site"),
+    # Aggregates without a rollup measure
+    events_sql("site, AVG(page_views) AS views", tail="GROUP BY site"),
+])
+def test_queries_rollups_cannot_answer_are_not_routed(sql):
+    assert rollups.route_to_rollup(sql, approximate=True) is None
+
+
+def test_rollups_can_be_turned_off():
+    sql = events_sql("site, COUNT(*) AS events", tail="GROUP BY site")
+    assert rollups.resolve_execution_sql(sql, use_rollups=False) == (sql, None)
@@ -0,0 +1,70 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from query_studio import caching, speculative
+
+
+@pytest.fixture
+def warehouse(tmp_path, monkeypatch):
+    """Submitted previews keep running until finished; records which calls need a connection."""
+    state = {"running": set(), "calls": [], "submitted": 0}
+    lock = threading.Lock()
+    cache = caching.QueryResultCache(str(tmp_path))
+    
+    def submit_query(sql):
+        with lock:
+            state["submitted"] += 1
+            query_id = f"q{state['submitted']}"
+            state["running"].add(query_id)
+        return query_id
+    
+    def is_query_running(query_id):
+        state["calls"].append(("status", query_id))
+        return query_id in state["running"]
+    
+    def fetch_query_result(query_id, max_rows=None):
+        assert query_id not in state["running"], "fetched before the preview finished"
+        state["calls"].append(("fetch", query_id))
+        return pd.DataFrame({"a": [1]}), {"query_id": query_id, "truncated": False}
+    
+    monkeypatch.setattr(speculative, "submit_query", submit_query)
+    monkeypatch.setattr(speculative, "is_query_running", is_query_running)
+    monkeypatch.setattr(speculative, "fetch_query_result", fetch_query_result)
+    monkeypatch.setattr(speculative, "get_result_cache", lambda: cache)
+    monkeypatch.setattr(speculative, "SPECULATIVE_PREVIEW_POLL_SECONDS", 0.01)
+    return state
+
+
+def preview_sql(n: int) -> str:
+    return f"SELECT a FROM t WHERE date = '2024-01-0{n}'"
+
+
+def test_previews_are_fetched_only_once_finished(warehouse):
+    runner = speculative.SpeculativePreviewRunner(max_per_user=2, workers=1)
+    preview = runner.start("ana@example.com", preview_sql(1), use_rollups=False)
+    assert preview is not None
+    warehouse["running"].clear()
+    preview["future"].result(timeout=5)
+    assert [call for call, _ in warehouse["calls"]][-1] == "fetch"
+    assert speculative.get_result_cache().get(preview["preview_sql"], caching.result_cache_mode(False, False)) is not None
+    assert runner.stats()["completed"] == 1
+
+
+def test_each_user_has_a_cap_across_sessions(warehouse):
+    runner = speculative.SpeculativePreviewRunner(max_per_user=2, workers=1)
+    started = [runner.start("ana@example.com", preview_sql(n), use_rollups=False) for n in (1, 2, 3)]
+    assert [preview is not None for preview in started] == [True, True, False]
+    assert runner.start("ben@example.com", preview_sql(4), use_rollups=False) is not None
+    warehouse["running"].clear()
+    for preview in started[:2]:
+        preview["future"].result(timeout=5)
+    assert runner.stats()["in_flight"] <= 1
+
+
+def test_sql_that_does_not_parse_is_not_speculated_on(warehouse):
+    runner = speculative.SpeculativePreviewRunner()
+    assert runner.start("ana@example.com", "SELECT (", use_rollups=False) is None
+    assert warehouse["submitted"] == 0
+
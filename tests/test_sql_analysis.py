@@ -0,0 +1,52 @@
+import pytest
+
+from query_studio import sql_analysis
+
+
+def flat(sql):
+    return " ".join(sql.split())
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT site FROM t",
+    "SELECT 'drop table x' AS note FROM t -- delete",
+    "WITH a AS (SELECT 1 AS x) SELECT x FROM a",
+    "SELECT * FROM t QUALIFY ROW_NUMBER() OVER (PARTITION BY a ORDER BY b) = 1",
+])
+def test_read_only_queries_are_safe(sql):
+    assert sql_analysis.validate_sql_safety(sql) == (True, "Query is safe")
+
+
+@pytest.mark.parametrize("sql, message", [
+    ("DROP TABLE t", "forbidden statement: DROP"),
+    ("INSERT INTO t SELECT 1", "forbidden statement: INSERT"),
+    ("UPDATE t SET a = 1", "forbidden statement: UPDATE"),
+    ("SELECT 1; DELETE FROM t", "forbidden statement: DELETE"),
+    ("SELECT 1 FROM t; SELECT 2 FROM t", "Only a single query is allowed"),
+])
+def test_writes_and_multiple_statements_are_rejected(sql, message):
+    is_safe, reason = sql_analysis.validate_sql_safety(sql)
+    assert not is_safe
+    assert message in reason
+
+
+@pytest.mark.parametrize("sql, limit, expected", [
+    ("SELECT a FROM t", 100, "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t LIMIT 500", 100, "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t LIMIT 5", 100, "SELECT a FROM t LIMIT 5"),
+    ("SELECT a FROM t UNION ALL SELECT a FROM u", 10, "SELECT a FROM t UNION ALL SELECT a FROM u LIMIT 10"),
+])
+def test_outer_limit_is_capped(sql, limit, expected):
+    assert flat(sql_analysis.rewrite_outer_limit(sql, limit)) == expected
+
+
+def test_inner_limits_are_left_alone():
+    rewritten = flat(sql_analysis.rewrite_outer_limit("SELECT a FROM (SELECT a FROM t LIMIT 1000) AS s", 100))
+    assert rewritten == "SELECT a FROM ( SELECT a FROM t LIMIT 1000 ) AS s LIMIT 100"
+    rewritten = flat(sql_analysis.rewrite_outer_limit("WITH c AS (SELECT a FROM t LIMIT 3) SELECT a FROM c", 10))
+    assert rewritten == "WITH c AS ( SELECT a FROM t LIMIT 3 ) SELECT a FROM c LIMIT 10"
+
+
+def test_outer_limit_needs_a_single_query():
+    with pytest.raises(ValueError):
+        sql_analysis.rewrite_outer_limit("SELECT 1; SELECT 2", 1)